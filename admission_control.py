@@ -4,13 +4,18 @@ import request
 import scheduling
 import astar
 import fare
+from travel_matrix import travel_time_matrix, routing_graph
+from assignment import hungarian, genetic_assignment
+import numpy as np
+import instrument
 
 # Determine set of requests suitable for scheduling.
 
 maximum_radius = 3000
 
 
-def admission_control(request, vehicles, G):
+@instrument.timed("admission_control")
+def admission_control(request, vehicles, G, fleet=None):
     """
     Given an admissible or inadmissible request: Use a GA to maximize profit and return an optimal request, vehicle pair
     if admissible.
@@ -19,17 +24,21 @@ def admission_control(request, vehicles, G):
     ==Parameters==
     request: Request() object
     vehicles: list of vehicles (total fleet)  
+    fleet: Fleet() holding every vehicle, its grid is used for the radius filter instead of scanning vehicles
     """
    
     final_trip = {}
     tabu_vehicles = [] # Build a distance based Tabu list for possible vehicles
     # G, t = astar.load_data(reset=False, graph=False, trip=False, abbr=False)
 
-    for i in range(0, len(vehicles)):
-        v = vehicles[i]
-        loc = request.start
-        if v.available and astar.distance_to_meters(v.position, loc) < maximum_radius:
-            tabu_vehicles.append(v)
+    if fleet is not None:
+        tabu_vehicles = [fleet.vehicles[i] for i in fleet.within(request.start, maximum_radius)]
+    else:
+        available = [v for v in vehicles if v.available]
+        if available:
+            distances = astar.haversine(np.array([v.position for v in available]), request.start)
+            tabu_vehicles = [available[i] for i in np.flatnonzero(distances < maximum_radius)]
+    instrument.count("admission.candidates", len(tabu_vehicles))
 
     solution = genetic_algorithm(request, tabu_vehicles, G)
     final_trip[solution[1]] = solution[0]  # will not store invalid trips!!
@@ -52,27 +61,151 @@ def genetic_algorithm(request, tabu, G):
     tabu: a list of valid potential vehicles
     G: a networkx graph 
     """
-    current_fitness = -1
-    vehicle_id = -1
     try:
-        path = nx.astar_path(G, request.start, request.stop, astar.diste)
+        path = astar.find_path(G, request.start, request.stop, astar.default_heuristic(G), request.pickup_time)[1]
         main_distance = get_distance(path, request.start, request.stop, G)
     except:
         return [request, -1]
+    if not tabu:
+        return [request, -1]
+
+    best = best_candidate(request, tabu, G, main_distance)[0]
+    return [request, tabu[best].id if best >= 0 else -1]
+
+
+def candidate_bounds(request, tabu, G):
+    """
+    First stage of the candidate evaluation. Snaps the vehicles and the pickup to the graph and returns
+    (nodes, start, bound): the node of every vehicle, the pickup node and a lower bound on the length in metres
+    of the route of every vehicle to the pickup, the straight line distance between the nodes.
+    The bound is inf for the vehicles in another connected component and for those that can't make it to the
+    pickup within request.max_time minutes even at the top speed of the graph (max_time 0 is no limit).
+
+    ==Parameters==
+    request: Request() object
+    tabu: list of vehicles
+    G: a networkx graph
+    """
+    csr = routing_graph(G)
+    start = astar.find_closest_node(G, request.start)
+    nodes = astar.find_closest_nodes(G, [v.position for v in tabu])
+    bound = astar.haversine(np.array(nodes, dtype=np.float64).reshape(-1, 2), start)
+    s = csr.ids[start]
+    bound[[not csr.connected(csr.ids[n], s) for n in nodes]] = np.inf
+    if request.max_time and len(csr.speed):
+        top = max(float(np.max(csr.speed)), 1e-9)
+        bound[bound / top / 60 > request.max_time] = np.inf
+    return nodes, start, bound
+
+
+def best_candidate(request, tabu, G, main_distance):
+    """
+    Returns (index in tabu of the most profitable vehicle or -1, its profit, number of vehicles routed).
+    Vehicles are routed to the pickup in order of candidate_bounds and the search stops as soon as the bound
+    of the next vehicle can't beat the best profit found: the profit only goes down with the arrival distance,
+    so with a fleet around the pickup only the few closest vehicles are routed.
+
+    ==Parameters==
+    request: Request() object
+    tabu: list of vehicles
+    G: a networkx graph
+    main_distance: float (metres), road distance of the trip itself
+    """
+    nodes, start, bound = candidate_bounds(request, tabu, G)
+    heuristic = astar.default_heuristic(G)
+    best, best_profit, routed = -1, -1, 0
+    for i in np.argsort(bound, kind="stable").tolist():
+        if bound[i] == np.inf or fitness(bound[i], main_distance) <= best_profit:
+            instrument.count("admission.pruned", len(tabu) - routed)
+            break
+        routed += 1
+        try:
+            path = astar.find_path(G, nodes[i], start, heuristic, request.pickup_time)[1]
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            continue
+        if request.max_time and get_minutes(path, G) > request.max_time:
+            continue
+        profit = fitness(get_length(path, G), main_distance)
+        if profit > best_profit:
+            best, best_profit = i, profit
+    instrument.count("admission.routed", routed)
+    return best, best_profit, routed
+
+
+@instrument.timed("batch_admission_control")
+def batch_admission_control(requests, vehicles, G, fleet=None, solver="hungarian", budget=None, workers=None):
+    """
+    Assigns a batch of requests together. Builds the vehicle x request profit matrix in one shot and solves
+    the assignment that maximizes the total profit with the Hungarian algorithm, or with the genetic algorithm
+    of assignment.genetic_assignment.
 
-    for i in range(0, len(tabu)):
+    returns {vehicle ID: request}
+    ==Parameters==
+    requests: list of Request() objects
+    vehicles: list of vehicles (total fleet)
+    G: a networkx graph
+    fleet: Fleet() holding every vehicle, its grid is used for the radius filter instead of scanning vehicles
+    solver: "hungarian" or "genetic"
+    budget: float, most seconds the genetic algorithm runs for, None for no limit
+    workers: int, processes evaluating the fitness of the genetic algorithm
+    """
+    final_trip = {}
+    main_distances = []
+    for r in requests:
         try:
-            arrival_path = nx.astar_path(G, tabu[i].position, request.start, astar.diste)
-            total_distance = get_distance(arrival_path, tabu[i].position, request.start, G) + main_distance
-            estimated_fare = fare.calculate_fare_NYC(total_distance, False, False)
-            profit = fare.profit(estimated_fare, total_distance)
-            if profit > current_fitness:
-                current_fitness = profit
-                vehicle_id = tabu[i].id
+            path = astar.find_path(G, r.start, r.stop, astar.default_heuristic(G), r.pickup_time)[1]
+            main_distances.append(get_distance(path, r.start, r.stop, G))
         except:
-            break
+            main_distances.append(float("inf"))
+    main_distances = np.array(main_distances, dtype=np.float64)
+
+    # Keep the available vehicles within maximum_radius of at least one pickup
+    if fleet is not None:
+        vehicles = fleet.vehicles
+    close = np.zeros((len(vehicles), len(requests)), dtype=bool)
+    if fleet is not None:
+        for j, r in enumerate(requests):
+            close[fleet.within(r.start, maximum_radius), j] = True
+    else:
+        available = np.array([v.available for v in vehicles], dtype=bool)
+        if available.any() and requests:
+            positions = np.array([vehicles[i].position for i in np.flatnonzero(available)])
+            close[available] = astar.haversine_pairwise(positions, [r.start for r in requests]) < maximum_radius
+    candidates = np.flatnonzero(close.any(axis=1))
+    instrument.count("admission.candidates", len(candidates))
+    if not len(candidates) or not len(requests):
+        return final_trip
+
+    costs, distances = travel_time_matrix(G, [vehicles[i].position for i in candidates],
+                                          [r.start for r in requests], distances=True,
+                                          depart=requests[0].pickup_time)
+    profit = fitness(distances, main_distances[np.newaxis, :])
+    feasible = close[candidates] & np.isfinite(costs) & np.isfinite(profit) & (profit > -1)
+    if solver == "genetic":
+        rows, cols = genetic_assignment(distances, main_distances, feasible, budget=budget, workers=workers)
+    elif solver == "hungarian":
+        rows, cols = hungarian(np.where(feasible, -profit, np.inf))
+    else:
+        raise ValueError(f"Unknown solver {solver}")
+    for i, j in zip(rows, cols):
+        final_trip[vehicles[candidates[i]].id] = requests[j]
+        requests[j].select()
+    return final_trip
+
+
+def fitness(arrival_distance, main_distance):
+    """
+    Returns the profit of a trip served by a vehicle arrival_distance metres away from the pickup: the fare of
+    the trip minus the fuel cost of driving to the pickup and then the trip. Goes down as arrival_distance grows.
+    Works elementwise on numpy arrays.
 
-    return [request, vehicle_id]
+    ==Parameters==
+    arrival_distance: float (metres)
+    main_distance: float (metres)
+    """
+    total_distance = arrival_distance + main_distance
+    estimated_fare = fare.calculate_fare_NYC(main_distance, False, False)
+    return fare.profit(estimated_fare, total_distance)
 
 
 def get_distance(path, n1, n2, G):
@@ -91,3 +224,29 @@ def get_distance(path, n1, n2, G):
             distances.append(G[path[p]][path[p + 1]]["distance"])
 
     return round(sum(distances) * 0.3048, 2)
+
+
+def get_length(path, G):
+    """
+    Given a path of nodes, returns the length in metres of the route driven (see CSRGraph.lengths).
+
+    ==Parameters==
+    path: list of nodes
+    G: road networkx graph
+    """
+    csr = routing_graph(G)
+    ids, lengths = csr.ids, csr.lengths()
+    return float(sum(lengths[csr.edge(ids[a], ids[b])] for a, b in zip(path, path[1:])))
+
+
+def get_minutes(path, G):
+    """
+    Given a path of nodes, returns the minutes needed to drive it at the speed limits.
+
+    ==Parameters==
+    path: list of nodes
+    G: road networkx graph
+    """
+    csr = routing_graph(G)
+    ids, seconds = csr.ids, csr.seconds()
+    return sum(seconds[csr.edge(ids[a], ids[b])] for a, b in zip(path, path[1:])) / 60
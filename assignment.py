@@ -0,0 +1,280 @@
+import time
+from multiprocessing import get_all_start_methods, get_context
+import numpy as np
+import fare
+
+# Solves assignment problems for batched dispatch.
+
+# Matrices of the genetic algorithm being run, inherited by the forked fitness workers
+_ga_arrival = None
+_ga_main = None
+
+
+def hungarian(cost):
+    """
+    Solves the rectangular linear assignment problem with the Hungarian algorithm (shortest augmenting
+    paths with potentials), vectorized over the columns. Pairs with an infinite cost are never returned.
+    Returns (rows, cols) index arrays sorted by row, like scipy.optimize.linear_sum_assignment.
+
+    ==Parameters==
+    cost: float array (n, m), cost of assigning row i to column j (inf if not allowed)
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.size == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    allowed = np.isfinite(cost)
+    if not allowed.any():
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    finite = cost[allowed]
+    # Forbidden pairs get a cost higher than any complete assignment of allowed pairs
+    big = (np.abs(finite).max() + 1) * (cost.shape[0] + 1)
+    cost = np.where(allowed, cost, big)
+
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)  # p[j] = row (1 based) assigned to column j, 0 if none
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            current = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (current < minv[1:])
+            minv[1:][better] = current[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(masked)) + 1
+            delta = masked[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(p[1:])
+    rows = p[1:][cols] - 1
+    keep = allowed[rows, cols]
+    rows, cols = rows[keep], cols[keep]
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def pair_profit(arrival, main):
+    """
+    Returns the profit of serving requests with vehicles arrival metres away from their pickups: the fare of the
+    trip minus the fuel cost of driving to the pickup and then the trip (same as admission_control.fitness).
+    Works elementwise, main is broadcast against arrival.
+
+    ==Parameters==
+    arrival: float array, distance from the vehicle to the pickup (metres)
+    main: float array, distance of the trip (metres)
+    """
+    return fare.profit(fare.calculate_fare_NYC(main, False, False), arrival + main)
+
+
+def population_fitness(genes, arrival, main):
+    """
+    Returns a float64 array (P) with the total profit of every individual of the population.
+
+    ==Parameters==
+    genes: int array (P, R), the vehicle (row of arrival) serving every request, -1 if it's rejected
+    arrival: float array (V, R), distance from every vehicle to every pickup (metres)
+    main: float array (R), distance of every trip (metres)
+    """
+    served = genes >= 0
+    ind, col = np.nonzero(served)
+    profit = np.zeros(genes.shape)
+    # Only served pairs are priced, rejected requests may have no finite trip distance
+    profit[ind, col] = pair_profit(arrival[genes[ind, col], col], np.asarray(main)[col])
+    return profit.sum(axis=1)
+
+
+def _fitness_chunk(genes):
+    return population_fitness(genes, _ga_arrival, _ga_main)
+
+
+def _repair(genes, gain, first=None):
+    """
+    Rejects the requests of every individual that share a vehicle with a more profitable one, in place.
+    Requests marked in first (bool array like genes) keep their vehicle before the others, so a mutated gene
+    takes the vehicle away instead of being undone.
+    """
+    ind, col = np.nonzero(genes >= 0)
+    vehicle = genes[ind, col]
+    rank = -gain[vehicle, col]
+    if first is not None:
+        rank = np.where(first[ind, col], -np.inf, rank)
+    order = np.lexsort((rank, vehicle, ind))
+    ind, col, vehicle = ind[order], col[order], vehicle[order]
+    taken = np.r_[False, (ind[1:] == ind[:-1]) & (vehicle[1:] == vehicle[:-1])]
+    genes[ind[taken], col[taken]] = -1
+    return genes
+
+
+def _fill(genes, gain, ranked, rng):
+    """
+    Gives every rejected request of every individual its most profitable free vehicle, if serving it makes a
+    profit, in place. Requests are filled in a random order. ranked holds the vehicles of every request by
+    decreasing profit, padded with -1.
+    """
+    n = genes.shape[0]
+    used = np.zeros((n, gain.shape[0]), dtype=bool)
+    ind, col = np.nonzero(genes >= 0)
+    used[ind, genes[ind, col]] = True
+    k = np.arange(n)
+    for c in rng.permutation(np.flatnonzero((genes < 0).any(axis=0))).tolist():
+        cand = ranked[c][ranked[c] >= 0]
+        rows = k[genes[:, c] < 0]
+        if not len(cand) or not len(rows):
+            continue
+        free = ~used[rows[:, np.newaxis], cand]
+        has = free.any(axis=1)
+        rows, pick = rows[has], cand[free[has].argmax(axis=1)]
+        genes[rows, c] = pick
+        used[rows, pick] = True
+    return genes
+
+
+def _greedy(gain, allowed):
+    """
+    Returns the genes of the greedy assignment: pairs taken by decreasing profit while both are free.
+    """
+    genes = np.full(gain.shape[1], -1, dtype=np.int64)
+    used = np.zeros(gain.shape[0], dtype=bool)
+    rows, cols = np.nonzero(allowed)
+    for i in np.argsort(-gain[rows, cols], kind="stable").tolist():
+        r, c = rows[i], cols[i]
+        if not used[r] and genes[c] < 0:
+            genes[c] = r
+            used[r] = True
+    return genes
+
+
+def _swap(genes, allowed, swaps, rng):
+    """
+    Swaps the vehicles of swaps random pairs of requests in every individual when both can take the other's
+    vehicle (a rejected request can always give its -1 away), in place. Moves a vehicle between requests
+    without the conflicts that mutating a single gene makes.
+    """
+    n, r = genes.shape
+    k = np.arange(n)
+    for _ in range(swaps):
+        i, j = rng.integers(r, size=(2, n))
+        a, b = genes[k, i], genes[k, j]
+        ok = (((b < 0) | allowed[np.maximum(b, 0), i]) & ((a < 0) | allowed[np.maximum(a, 0), j]))
+        genes[k[ok], i[ok]] = b[ok]
+        genes[k[ok], j[ok]] = a[ok]
+    return genes
+
+
+def genetic_assignment(arrival, main, allowed, population=64, generations=300, mutation=None, swaps=1, elite=2,
+                       budget=None, workers=None, seed=0):
+    """
+    Assigns requests (columns) to vehicles (rows) with a genetic algorithm maximizing the total profit.
+    A generation is an int array (population, R) holding the vehicle of every request or -1 for rejected.
+    Every generation is evaluated with population_fitness, parents are picked by binary tournaments, children
+    are made by uniform crossover and mutated by drawing a new allowed vehicle (or a rejection) and by swapping
+    the vehicles of pairs of requests. A vehicle given to two requests stays with the mutated one or else the
+    most profitable one, and rejected requests then take their best free vehicle (_fill), so a mutation moves
+    the request it displaces. The best individuals are kept as they are and the first population holds the
+    greedy assignment, so the result is never worse than greedy.
+    Stops after generations or once budget seconds are spent. Returns (rows, cols) sorted by row, like hungarian.
+
+    ==Parameters==
+    arrival: float array (V, R), distance from every vehicle to every pickup (metres)
+    main: float array (R), distance of every trip (metres)
+    allowed: bool array (V, R), pairs that can be assigned
+    population: int, individuals per generation
+    generations: int, most generations
+    mutation: float, probability of every gene to mutate, None for one gene per child on average
+    swaps: int, vehicle swaps tried per child and generation
+    elite: int, best individuals copied to the next generation
+    budget: float, most seconds spent, None for no limit
+    workers: int, processes evaluating the fitness (None or 1 to evaluate in this process)
+    seed: int
+    """
+    global _ga_arrival, _ga_main
+    start = time.perf_counter()
+    arrival = np.asarray(arrival, dtype=np.float64)
+    main = np.asarray(main, dtype=np.float64)
+    allowed = np.asarray(allowed, dtype=bool) & np.isfinite(arrival) & np.isfinite(main)
+    v, r = arrival.shape
+    if not allowed.any():
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    if mutation is None:
+        mutation = 1 / r
+    arrival = np.where(allowed, arrival, 0)
+    main = np.where(np.isfinite(main), main, 0)
+    gain = np.where(allowed, pair_profit(arrival, main), -np.inf)
+
+    # Allowed vehicles of every request padded to a (R, K) table, so genes are drawn for all requests at once
+    counts = allowed.sum(axis=0)
+    choices = np.zeros((r, max(int(counts.max()), 1)), dtype=np.int64)
+    cols, rows = np.nonzero(allowed.T)
+    choices[cols, np.arange(len(cols)) - np.repeat(np.cumsum(counts) - counts, counts)] = rows
+
+    def draw(shape):
+        pick = (rng.random(shape) * (counts + 1)).astype(np.int64)
+        return np.where(pick < counts, choices[np.arange(r), np.minimum(pick, choices.shape[1] - 1)], -1)
+
+    # Vehicles that serve every request at a profit, most profitable first
+    rank = np.where(choices >= 0, gain[choices, np.arange(r)[:, np.newaxis]], -np.inf)
+    rank[np.arange(choices.shape[1]) >= counts[:, np.newaxis]] = -np.inf
+    order = np.argsort(-rank, axis=1, kind="stable")
+    ranked = np.where(np.take_along_axis(rank, order, axis=1) > 0, np.take_along_axis(choices, order, axis=1), -1)
+
+    population = max(population, elite + 2)
+    genes = draw((population, r))
+    genes[0] = _greedy(gain, allowed)
+    _fill(_repair(genes, gain), gain, ranked, rng)
+
+    pool = None
+    if workers is not None and workers > 1 and "fork" in get_all_start_methods():
+        _ga_arrival, _ga_main = arrival, main
+        pool = get_context("fork").Pool(workers)
+    try:
+        for generation in range(generations + 1):
+            if pool is not None:
+                fitness = np.concatenate(pool.map(_fitness_chunk, np.array_split(genes, workers)))
+            else:
+                fitness = population_fitness(genes, arrival, main)
+            if generation == generations or (budget is not None and time.perf_counter() - start >= budget):
+                break
+            best = np.argsort(-fitness, kind="stable")[:elite]
+            n = population - len(best)
+            a, b = rng.integers(population, size=(2, 2, n))
+            first = np.where(fitness[a[0]] >= fitness[b[0]], a[0], b[0])
+            second = np.where(fitness[a[1]] >= fitness[b[1]], a[1], b[1])
+            children = np.where(rng.random((n, r)) < 0.5, genes[first], genes[second])
+            mutate = rng.random((n, r)) < mutation
+            children[mutate] = draw((n, r))[mutate]
+            _fill(_swap(_repair(children, gain, mutate), allowed, swaps, rng), gain, ranked, rng)
+            genes = np.concatenate([genes[best], children])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            _ga_arrival = _ga_main = None
+
+    best = genes[int(np.argmax(fitness))]
+    cols = np.flatnonzero(best >= 0)
+    rows = best[cols]
+    order = np.argsort(rows, kind="stable")
+    return rows[order], cols[order]
@@ -6,8 +6,19 @@ import math
 import random
 import traffic
 import pickle
+import os
+from multiprocessing import Pool, get_all_start_methods, get_context
 from datetime import datetime
 from request import Request
+from spatial_index import SpatialIndex, load_index
+from csr import CSRGraph, load_graph, save_graph, save_volume, convert_pickle, seconds_of_day
+from ch import build_hierarchy, load_hierarchy
+from landmarks import build_landmarks, load_landmarks
+from simplify import load_simplified
+from route_cache import RouteCache
+from trip_store import TripStore, ingest_trips, snap_store, snap_requests
+from street_names import load_street_names
+import instrument
 import numpy as np
 
 try:
@@ -31,16 +42,27 @@ def main():
 
 
 # === Load Data ===
-def load_data(reset=False, graph=False, trip=False, abbr=False):
+def load_data(reset=False, graph=False, trip=False, abbr=False, ch=False, alt=False, simplify=False):
     """
-    Returns a graph representing the NYC map and an array of 2015 trips. Saves all the data in pickle files.
+    Returns a graph representing the NYC map (a memory mapped CSRGraph) and the 2015 trips (a TripStore).
+    Saves all the data in files.
+    The contraction hierarchy (ch.npz in the graph directory) is loaded when it exists and only built when
+    ch=True since it's slow.
+    Same for the ALT landmarks (landmarks.npz) with alt=True, they are in G.graph["landmarks"] and can be
+    passed as the heuristic.
+    With simplify=True the chains of shape points are contracted (see simplify.contract_chains, saved in
+    graph_simple) and every structure is built on the simplified graph. The trips are snapped to its nodes (a
+    copy of the store is kept in graph_simple/trips).
     *** To refresh everything, reset=True ***
 
-    Parameters: (reset, graph, trip, abbr)
+    Parameters: (reset, graph, trip, abbr, ch, alt, simplify)
         reset - bool
         graph - bool
         trips - bool
         abbr - bool
+        ch - bool
+        alt - bool
+        simplify - bool
     """
     G = None
     trips = None
@@ -48,44 +70,71 @@ def load_data(reset=False, graph=False, trip=False, abbr=False):
     if reset:
         graph = trip = abbr = True
     if graph:
-        traffic_dict = traffic.process_traffic("NYC/Traffic_Data/traffic_volume.csv")
-        pickle_graph(abbr, traffic_dict)
-    with open('graph.pkl', 'rb') as graph_file:
-        G = pickle.load(graph_file)
+        names = load_street_names(reset=abbr)
+        traffic_volumes = traffic.process_traffic("NYC/Traffic_Data/traffic_volume.csv", names)
+        pickle_graph(names, traffic_volumes)
+    try:
+        G = load_graph("graph")
+    except (OSError, ValueError):
+        # Graph pickled by older versions
+        print("Converting graph.pkl...")
+        G = convert_pickle("graph.pkl", "graph")
+        print("Done.")
+    if G.volume is None and os.path.exists("NYC/Traffic_Data/traffic_volume.csv"):
+        print("Adding hourly traffic volumes...")
+        names = load_street_names()
+        add_volumes(G, traffic.process_traffic("NYC/Traffic_Data/traffic_volume.csv", names), names)
+        print("Done.")
+    directory = "graph"
+    if simplify:
+        G = load_simplified(G, reset=graph)
+        directory = "graph_simple"
+    # One index per graph directory, so switching simplify doesn't rebuild it
+    G.graph["index"] = load_index(G, os.path.join(directory, "index.pkl"), reset=graph)
+    G.graph["csr"] = G
+    G.graph["version"] = 0
+    G.graph["route_cache"] = RouteCache()
+    if ch:
+        print("Building contraction hierarchy...")
+        G.graph["ch"] = build_hierarchy(G.graph["csr"], os.path.join(directory, "ch.npz"))
+        print("Done.")
+    else:
+        G.graph["ch"] = load_hierarchy(G.graph["csr"], os.path.join(directory, "ch.npz"))
+    if alt:
+        print("Building landmarks...")
+        G.graph["landmarks"] = build_landmarks(G.graph["csr"], path=os.path.join(directory, "landmarks.npz"))
+        print("Done.")
+    else:
+        G.graph["landmarks"] = load_landmarks(G.graph["csr"], os.path.join(directory, "landmarks.npz"))
 
     if trip:
-        pickle_trips(G)
-    with open('trips.pkl', 'rb') as trips_file:
-        trips = pickle.load(trips_file)
+        print("Loading trips...")
+        trips = ingest_trips(G, path="trips" if not simplify else os.path.join(directory, "trips"))
+        print("Done.")
+    elif os.path.isdir("trips"):
+        trips = TripStore("trips")
+    else:
+        # Trips saved as a pickled list by older versions
+        with open('trips.pkl', 'rb') as trips_file:
+            trips = pickle.load(trips_file)
+        if simplify:
+            trips = snap_requests(trips, G.graph["index"])
+    if isinstance(trips, TripStore) and not np.array_equal(trips.nodes, G.graph["index"].coords):
+        # Snapped to the nodes of another graph (the full one with simplify), nodes it doesn't have can't be routed
+        trips = snap_store(trips, G.graph["index"], os.path.join(directory, "trips"))
 
     return G, trips
 
 
-def pickle_graph(abbr, traffic_dict):
+def pickle_graph(names, traffic_volumes, workers=None):
     """
-    Generate and save the graph in a pickle file.
+    Generate the graph and save it in the binary graph format (see csr.save_graph).
 
-    Parameters: (abbr, traffic_dict)
-        abbr - bool
-        traffic_dict - dict of traffic volume per street
+    Parameters: (names, traffic_volumes, workers)
+        names - StreetNames(), see street_names.load_street_names
+        traffic_volumes - traffic.TrafficVolumes() keyed by canonical name
+        workers - int, processes used to build the graph (None for one per CPU)
     """
-    # Replace with street abbr
-    try:
-        if abbr:
-            raise ResetPickle
-        with open('abbr.pkl', 'rb') as abbr_file:
-            abbr = pickle.load(abbr_file)
-    except:
-        print("Loading abbreviations...")
-        abbr = {}
-        with open("abbr.txt") as rFile:
-            for line in rFile:
-                line = line.rstrip("\n")
-                abbr[line.split(" ")[0].upper()] = line.split(" ")[1].upper()
-        with open('abbr.pkl', 'wb') as out:
-            pickle.dump(abbr, out)
-        print("Done.")
-
     # Variables to keep track of the number of recognized streets
     recognized = 0
     unrecognized = 0
@@ -94,85 +143,190 @@ def pickle_graph(abbr, traffic_dict):
     print("Building speeds dictionary...")
     speeds = {}
     for feature in fiona.open("NYC/VZV_Speed Limits/geo_export_6459c10e-7bfb-4e64-ae29-f0747dc3824c.shp"):
-        street = feature["properties"]["street"]
-        for v in street_variations(street, abbr):
-            speeds[v] = feature["properties"]["postvz_sl"]
+        speeds[names.normalize(feature["properties"]["street"])] = feature["properties"]["postvz_sl"]
     print("Done.")
 
     # Create a Graph with intersections as nodes and roads as edges
     print("Creating graph...")
-    time = random.randint(0, 23)
-    G = nx.Graph()
-    for feature in fiona.open("NYC/Map/geo_export_24fdfadb-893d-40a0-a751-a76cdefc9bc6.shp"):
-        for seg_start, seg_end in zip(list(shape(feature["geometry"]).coords),
-                                      list(shape(feature["geometry"]).coords)[1:]):
-            street = feature["properties"]["st_label"]
-            if street in speeds:
-                recognized += 1
-            else:
-                unrecognized += 1
-            divider = speeds.get(street, 0)
-            if divider == 0:
-                divider = 25
-            seg_start = seg_start[1] , seg_start[0] 
-            seg_end = seg_end[1] , seg_end[0] 
-            if street in traffic_dict:
-                volume_total = traffic_dict[street]
-                volume_count = volume_total[time]
-                w = reweight(seg_start, seg_end, divider, int(volume_count))
-            else:
-                w = weight(seg_start, seg_end, divider)
-
-            G.add_edge(seg_start, seg_end, weight=w, distance=feature["properties"]["shape_leng"],
-                       speed=divider / 3600 * 1609) # Gives the edge properties like a weight, the in real life distance, and the speed limit
+    csr, recognized, unrecognized = build_graph("NYC/Map/geo_export_24fdfadb-893d-40a0-a751-a76cdefc9bc6.shp",
+                                                names, speeds, traffic_volumes, workers)
     print(
         f"Streets recognized: {recognized}. Unrecognized: {unrecognized}. Percent recognized: {recognized / (unrecognized + recognized) * 100}%.")
-   
-    with open('graph.pkl', 'wb') as out:
-        pickle.dump(G, out)
+
+    save_graph(csr, "graph")
     print("Done.")
 
 
-def pickle_trips(G):
+# Street names, speeds and traffic of the graph being built, set once per worker process
+_build_names = None
+_build_speeds = None
+_build_traffic = None
+
+
+def _init_graph_worker(names, speeds, traffic_volumes):
+    global _build_names, _build_speeds, _build_traffic
+    _build_names = names
+    _build_speeds = speeds
+    _build_traffic = traffic_volumes
+
+
+def graph_chunk(path, start, stop):
+    """
+    Returns the segments of features [start, stop) of the map as arrays: a dict with starts, ends (S, 2),
+    weight, distance, speed (S), volume (S, 24) (0 for streets without traffic data), the number of
+    recognized and unrecognized segments and the number of features skipped for not being lines.
+    Every part of a MultiLineString is a line of its own (no segment joins two parts).
+    Uses the street names, speeds and traffic set by _init_graph_worker.
+
+    Parameters: (path, start, stop)
+        path - string, shapefile of the map
+        start - int
+        stop - int
     """
-    Saves the trips in a pickle file.
+    names, speeds, traffic_volumes = _build_names, _build_speeds, _build_traffic
+    coords, sizes, dividers, lengths, traffic_rows = [], [], [], [], []
+    recognized = unrecognized = skipped = 0
+    with fiona.open(path) as src:
+        for feature in src.filter(start, stop):
+            geometry = feature["geometry"]
+            if geometry is not None and geometry["type"] == "LineString":
+                lines = [geometry["coordinates"]]
+            elif geometry is not None and geometry["type"] == "MultiLineString":
+                lines = geometry["coordinates"]
+            else:
+                skipped += 1
+                continue
+            street = names.normalize(feature["properties"]["st_label"])
+            divider = speeds.get(street, 0)
+            if divider == 0:
+                divider = 25
+            for line in lines:
+                if len(line) < 2:
+                    continue
+                if street in speeds:
+                    recognized += len(line) - 1
+                else:
+                    unrecognized += len(line) - 1
+                coords.extend(c[:2] for c in line)
+                sizes.append(len(line) - 1)
+                dividers.append(divider)
+                lengths.append(feature["properties"]["shape_leng"])
+                traffic_rows.append(traffic_volumes.rows.get(street, -1))
+
+    # Every segment of the chunk is weighted at once, segments never join two features
+    points = np.array(coords, dtype=np.float64).reshape(-1, 2)[:, ::-1]  # (lat, lon)
+    sizes = np.array(sizes, dtype=np.int64)
+    last = np.cumsum(sizes + 1) - 1
+    first = np.ones(len(points), dtype=bool)
+    first[last] = False
+    s, e = points[first], points[np.roll(first, 1)]
+    feature = np.repeat(np.arange(len(sizes)), sizes)
+    divider = np.array(dividers, dtype=np.int64)[feature]
+    rows = np.array(traffic_rows, dtype=np.int64)
+    has_volume = rows >= 0
+    volume = np.zeros((len(sizes), 24), dtype=np.float32)
+    volume[has_volume] = traffic_volumes.volume[rows[has_volume]]
+    # Static weights use the mean volume over the day, the hourly weights come from the volumes
+    mean = volume.mean(axis=1).astype(np.int64)[feature]
+    w = np.where(has_volume[feature], reweight(s, e, divider, mean), weight(s, e, divider))
+    return {"starts": s, "ends": e, "weight": w, "distance": np.array(lengths, dtype=np.float64)[feature],
+            "speed": np.array([d / 3600 * 1609 for d in dividers], dtype=np.float64)[feature], # The speed limit in m/s
+            "volume": volume[feature], "recognized": recognized, "unrecognized": unrecognized, "skipped": skipped}
+
+
+def build_graph(path, names, speeds, traffic_volumes, workers=None, chunk=2000):
+    """
+    Builds the road graph from the map with a pool of worker processes. Every worker turns a range of features
+    into segment arrays and the chunks are merged in feature order with CSRGraph.from_segments, so the graph is
+    the same as adding the segments one by one to a networkx graph. Returns (CSRGraph, recognized, unrecognized).
+
+    Parameters: (path, names, speeds, traffic_volumes, workers, chunk)
+        path - string, shapefile of the map
+        names - StreetNames()
+        speeds - dict of speed limit per street, keyed by canonical name
+        traffic_volumes - traffic.TrafficVolumes() keyed by canonical name
+        workers - int, number of processes (None for one per CPU, 1 to build in this process)
+        chunk - int, features per task
+    """
+    with fiona.open(path) as src:
+        total = len(src)
+    tasks = [(path, start, min(start + chunk, total)) for start in range(0, total, chunk)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) < 2:
+        _init_graph_worker(names, speeds, traffic_volumes)
+        parts = [graph_chunk(*task) for task in tasks]
+    else:
+        with Pool(min(workers, len(tasks)), initializer=_init_graph_worker,
+                  initargs=(names, speeds, traffic_volumes)) as pool:
+            parts = pool.starmap(graph_chunk, tasks)
+
+    merged = {key: np.concatenate([part[key] for part in parts]) if parts else None
+              for key in ("starts", "ends", "weight", "distance", "speed", "volume")}
+    csr = CSRGraph.from_segments(merged["starts"], merged["ends"], merged["weight"], merged["distance"],
+                                 merged["speed"], merged["volume"])
+    skipped = sum(part["skipped"] for part in parts)
+    if skipped:
+        print(f"Skipped {skipped} features that aren't lines.")
+    return csr, sum(part["recognized"] for part in parts), sum(part["unrecognized"] for part in parts)
+
+
+def volume_matrix(csr, segments):
+    """
+    Returns the float32 array (2E, 24) of hourly volumes of every edge of csr, 0 for edges without traffic data.
 
-    Parameters: (G)
-        G - networkx.graph()
+    Parameters: (csr, segments)
+        csr - CSRGraph()
+        segments - dict mapping frozenset((u, v)) of every edge to its volumes (TrafficVolumes.get)
     """
-    print("Loading trips...")
-    t = 0 # Number of trips loaded so far
-    trips = []
-    with open("NYC/2015_taxi_data.csv") as rFile:
-        first_line = rFile.readline().rstrip("\n").split(",")
-        for line in rFile:
-            line = line.rstrip("\n").split(",")
-            temp = {}
-            for i in range(len(first_line)):
-                temp[first_line[i]] = line[i]
-            starting = (float(temp["pickup_latitude"]) , float(temp["pickup_longitude"]) )
-            ending = (float(temp["dropoff_latitude"]) , float(temp["dropoff_longitude"]) )
-            n1, n2 = find_closest_node(G, starting), find_closest_node(G, ending)
-            trips.append(Request(n1, n2, 0, int(temp["passenger_count"]),
-                                 datetime.strptime(temp["tpep_pickup_datetime"], "%Y-%m-%d %H:%M:%S")))
-            t += 1
-            if t == 100: # Sets a limit on the number of trips to save time.
-                print("Loaded " + str(t) + " trips.")
-                break
-
-    with open('trips.pkl', 'wb') as out:
-        pickle.dump(trips, out)
-    print("Done.")
+    volume = np.zeros((len(csr.indices), 24), dtype=np.float32)
+    for edge, volumes in segments.items():
+        if volumes is None:
+            continue
+        ends = tuple(edge)
+        a, b = csr.ids[ends[0]], csr.ids[ends[-1]]
+        volume[csr.edge(a, b)] = volumes
+        volume[csr.edge(b, a)] = volumes
+    return volume
+
+
+def add_volumes(G, traffic_volumes, names, path="graph"):
+    """
+    Adds the hourly traffic volumes to a graph built before they were saved, without rebuilding it.
+    Reads the street of every segment from the map again.
+
+    Parameters: (G, traffic_volumes, names, path)
+        G - CSRGraph()
+        traffic_volumes - traffic.TrafficVolumes() keyed by canonical name
+        names - StreetNames()
+        path - string
+    """
+    segments = {}
+    for feature in fiona.open("NYC/Map/geo_export_24fdfadb-893d-40a0-a751-a76cdefc9bc6.shp"):
+        coords = list(shape(feature["geometry"]).coords)
+        volumes = traffic_volumes.get(names.normalize(feature["properties"]["st_label"]))
+        nodes = [(c[1], c[0]) for c in coords]
+        for seg_start, seg_end in zip(nodes, nodes[1:]):
+            segments[frozenset((seg_start, seg_end))] = volumes
+    save_volume(G, volume_matrix(G, segments), path)
 
 
-def find_closest_node(G, starting):
+def find_closest_node(G, starting, giant=None):
     """
-    Finds the closest node to starting.
+    Finds the closest node to starting. Uses the spatial index in G.graph["index"] when it has been loaded.
+    With giant=True only the nodes of the largest connected component are considered, so every point snaps
+    to a node every other point can reach. giant=None uses G.graph["snap_giant"] (False when missing).
 
-    Parameters: (G, starting)
+    Parameters: (G, starting, giant)
         G - networkx.graph()
         starting - (lat, lon)
+        giant - bool
     """
+    if giant is None:
+        giant = G.graph.get("snap_giant", False)
+    if giant and G.graph.get("csr") is not None:
+        return _giant_index(G).nearest(starting)
+    if "index" in G.graph:
+        return G.graph["index"].nearest(starting)
     n1 = (None, float("inf"))
     for node in G.nodes():
         closeness = abs(starting[0] - node[0]) + abs(starting[1] - node[1])
@@ -181,25 +335,49 @@ def find_closest_node(G, starting):
     return n1[0]
 
 
-def street_variations(s, abbr):
+def find_closest_nodes(G, points, giant=None):
     """
-    Returns multiple variations of the street name based on common street term abbreviations.
+    Returns the list of the nodes closest to every point, like find_closest_node. Points that already are
+    nodes are returned as they are and the others are snapped in one batch (SpatialIndex.nearest_many) when
+    the spatial index is loaded.
 
-    Parameters: (s, abbr)
-        s - string
-        abbr - dict of common street abbreviations
+    Parameters: (G, points, giant)
+        G - networkx.graph()
+        points - list of (lat, lon) or float array (M, 2)
+        giant - bool, see find_closest_node
     """
-    variations = [s]
-    for a in abbr:
-        for v in variations.copy():
-            if a in v:
-                v = v.replace(a, abbr[a])
-                variations.append(v)
-    return variations
-
-
-class ResetPickle(Exception):
-    pass
+    if giant is None:
+        giant = G.graph.get("snap_giant", False)
+    csr = G.graph.get("csr")
+    points = [(float(p[0]), float(p[1])) for p in points]
+    nodes = [None] * len(points)
+    if csr is not None:
+        ids = csr.ids
+        component = csr.components() if giant else None
+        for i, p in enumerate(points):
+            if p in ids and (component is None or component[ids[p]] == 0):
+                nodes[i] = p
+    rest = [i for i, n in enumerate(nodes) if n is None]
+    if not rest:
+        return nodes
+    if giant and csr is not None:
+        snapped = _giant_index(G).nearest_many([points[i] for i in rest])
+    elif "index" in G.graph:
+        snapped = G.graph["index"].nearest_many([points[i] for i in rest])
+    else:
+        snapped = [find_closest_node(G, points[i], giant) for i in rest]
+    for i, n in zip(rest, snapped):
+        nodes[i] = n
+    return nodes
+
+
+def _giant_index(G):
+    """
+    Returns the spatial index of the nodes of the largest connected component, built the first time.
+    """
+    if G.graph.get("giant_index") is None:
+        G.graph["giant_index"] = SpatialIndex(G.graph["csr"].giant_nodes())
+    return G.graph["giant_index"]
 
 
 # === Plotting ===
@@ -220,16 +398,19 @@ def draw_graph(g, bounds=((-180 , -90 ), (180 , 90 ))):
             plt.plot((edge[0][1], edge[1][1]), (edge[0][0], edge[1][0]), 'c.-')
 
 
-def draw_path(path, color="b"):
+def draw_path(path, color="b", G=None):
     """
-    Plots a path on matplotlib.
+    Plots a path on matplotlib. Give the graph of a simplified path to draw it along the streets.
 
-    Parameters: (path, color)
+    Parameters: (path, color, G)
         path - [nodes]
         color - str
+        G - CSRGraph()
 
         node - (lat, lon)
     """
+    if G is not None and G.graph.get("csr") is not None:
+        path = G.graph["csr"].expand_path(path)
     px = []
     py = []
     for p in range(len(path) - 1):
@@ -258,16 +439,143 @@ def process_trips(G, trips, heuristic):
         print(f"\nGoing from {n1} to {n2}")
         print("Calculating traffic...")
         try:
-            path = nx.astar_path(G, n1, n2, heuristic)
+            cost, path = find_path(G, n1, n2, heuristic)
 
-            print(f"Cost of trip: {nx.astar_path_length(G, n1, n2, heuristic)}")
+            print(f"Cost of trip: {cost}")
             print(f"Nodes in trip: {len(path)}")
             print_trip_info(n1, n2, path, G)
-            draw_path(path)
+            draw_path(path, G=G)
         except:
             print("Couldn't find a path")
 
 
+# Result of every trip routed by route_trips, cost is nan and nodes 0 when there is no path
+ROUTE_DTYPE = np.dtype([("cost", "<f8"), ("nodes", "<i4"), ("distance", "<f8"), ("minutes", "<f8")])
+
+# Graph and heuristic of the batch being routed, inherited by the forked worker processes
+_route_graph = None
+_route_heuristic = None
+
+
+def _route_chunk(starts, stops, departs):
+    """
+    Returns the ROUTE_DTYPE array of the trips from starts to stops. Uses the graph and heuristic set by
+    route_trips.
+
+    Parameters: (starts, stops, departs)
+        starts - list of nodes
+        stops - list of nodes
+        departs - list of datetime, or of None for the static weights
+    """
+    G, heuristic = _route_graph, _route_heuristic
+    out = np.zeros(len(starts), dtype=ROUTE_DTYPE)
+    out["cost"] = np.nan
+    for i, (n1, n2, depart) in enumerate(zip(starts, stops, departs)):
+        try:
+            cost, path = find_path(G, n1, n2, heuristic, depart)
+        except nx.NetworkXNoPath:
+            continue
+        _, distance, minutes = print_trip_info(n1, n2, path, G)
+        out[i] = (cost, len(path), distance, minutes)
+    return out
+
+
+def route_trips(G, trips, heuristic, workers=None, depart=False, chunk=256, path=None):
+    """
+    Routes every trip without printing or plotting and returns a ROUTE_DTYPE array in the order of trips: cost,
+    number of nodes, distance (meters) and time (minutes) of print_trip_info.
+    The trips are split in chunks of chunk trips spread over a pool of forked processes that share G (the
+    memory mapped graph, hierarchy and landmarks are not copied). Falls back to routing in this process where
+    fork isn't available.
+
+    Parameters: (G, trips, heuristic, workers, depart, chunk, path)
+        G - networkx.graph()
+        trips - list of Request() (or a TripStore slice)
+        heuristic - Callable
+        workers - int, number of processes (None for one per CPU, 1 to route in this process)
+        depart - bool, route at the pickup time of every trip (time dependent) instead of the static weights
+        chunk - int, trips per task
+        path - string, .npy file to save the results in, None to not save
+    """
+    global _route_graph, _route_heuristic
+    starts = [trip.start for trip in trips]
+    stops = [trip.stop for trip in trips]
+    departs = [trip.pickup_time if depart else None for trip in trips]
+    tasks = [(starts[i:i + chunk], stops[i:i + chunk], departs[i:i + chunk]) for i in range(0, len(starts), chunk)]
+    workers = workers or os.cpu_count() or 1
+    _route_graph, _route_heuristic = G, heuristic
+    try:
+        if workers == 1 or len(tasks) < 2 or "fork" not in get_all_start_methods():
+            parts = [_route_chunk(*task) for task in tasks]
+        else:
+            with get_context("fork").Pool(min(workers, len(tasks))) as pool:
+                parts = pool.starmap(_route_chunk, tasks)
+    finally:
+        _route_graph = _route_heuristic = None
+    results = np.concatenate(parts) if parts else np.zeros(0, dtype=ROUTE_DTYPE)
+    if path is not None:
+        np.save(path, results)
+    return results
+
+
+@instrument.timed("find_path")
+def find_path(G, n1, n2, heuristic, depart=None):
+    """
+    Returns (cost, path) of the shortest path from n1 to n2 in a single search.
+    If depart is given and the graph has hourly volumes, the search is time dependent (see CSRGraph.astar).
+    Otherwise uses the contraction hierarchy in G.graph["ch"] when it has been loaded (exact, heuristic is not
+    needed), then the CSR copy of the graph in G.graph["csr"], then networkx.
+    Routes are kept in G.graph["route_cache"] when there is one, keyed by n1, n2 and the hour of departure for
+    time dependent routes, whatever the heuristic. Raises networkx.NetworkXNoPath if there is no path, right away when n1 and n2 are in different
+    connected components.
+
+    Parameters: (G, n1, n2, heuristic, depart)
+        G - networkx.graph()
+        n1 - (lat, lon)
+        n2 - (lat, lon)
+        heuristic - Callable
+        depart - datetime, None for the static weights
+    """
+    csr = G.graph.get("csr")
+    if csr is not None and n1 in csr.ids and n2 in csr.ids and not csr.connected(csr.ids[n1], csr.ids[n2]):
+        instrument.count("route.rejected")
+        raise nx.NetworkXNoPath(f"Node {n2} not reachable from {n1}")
+    if depart is not None and (csr is None or csr.volume is None):
+        depart = None
+    cache = G.graph.get("route_cache")
+    if cache is None:
+        return _route(G, n1, n2, heuristic, depart)
+
+    cache.check(G.graph.get("version", 0))
+    key = (n1, n2, None if depart is None else int(seconds_of_day(depart) // 3600))
+    route = cache.get(key)
+    if route is None:
+        try:
+            cost, path = _route(G, n1, n2, heuristic, depart)
+            route = (cost, tuple(path))
+        except nx.NetworkXNoPath:
+            route = (None, None)
+        cache.put(key, route)
+    if route[1] is None:
+        raise nx.NetworkXNoPath(f"Node {n2} not reachable from {n1}")
+    return route[0], list(route[1])
+
+
+def _route(G, n1, n2, heuristic, depart):
+    """
+    Routes n1 to n2 without the cache, see find_path.
+    """
+    csr = G.graph.get("csr")
+    if depart is not None:
+        return csr.astar_path(n1, n2, heuristic, depart)
+    if G.graph.get("ch") is not None:
+        return G.graph["ch"].query_path(n1, n2)
+    if csr is not None:
+        return csr.astar_path(n1, n2, heuristic)
+    path = nx.astar_path(G, n1, n2, heuristic)
+    return nx.path_weight(G, path, "weight"), path
+
+
 def random_trip(G):
     """
     Returns a randomly generated trip as a Request.
@@ -276,8 +584,8 @@ def random_trip(G):
         G - netwrokx.graph()
    """
     tn = len(G.nodes())
-    n1 = random.randint(0, tn)
-    n2 = random.randint(0, tn)
+    n1 = random.randint(0, tn - 1)
+    n2 = random.randint(0, tn - 1)
     tn = 0
     for node in G.nodes():
         if n1 == tn:
@@ -322,19 +630,21 @@ def print_trip_info(n1, n2, path, G, pr=False):
 # === Heuristics ===
 def weight(s, e, speed):
     """
-    Returns the weight to be assigned to the edges of the graph.
+    Returns the weight to be assigned to the edges of the graph. Works on (N, 2) arrays of segments.
 
     Parameters: (s, e, d)
         s - (lat, lon)
         e - (lat, lon)
         speed - int
     """
-    return ((s[0] - e[0]) ** 2 + (s[1] - e[1]) ** 2) ** 0.5 / speed
+    s, e = np.asarray(s, dtype=np.float64), np.asarray(e, dtype=np.float64)
+    return ((s[..., 0] - e[..., 0]) ** 2 + (s[..., 1] - e[..., 1]) ** 2) ** 0.5 / speed
 
 
 def reweight(s, e, speed, volume):
     """
-    Returns the weight to be assigned to the edges of the graph.
+    Returns the weight to be assigned to the edges of the graph. Works on (N, 2) arrays of segments.
+    Segments with no length or no traffic fall back to weight.
     ** Traffic Version (Includes historical traffic data for more accurate weighting) **
 
     Parameters: (s, e, speed, volume)
@@ -343,9 +653,12 @@ def reweight(s, e, speed, volume):
         speed - int
         volume - int
     """
-    density = volume / (distance_to_meters(s, e))
-    congestion = density / speed
-    return ((s[0] - e[0]) ** 2 + (s[1] - e[1]) ** 2) ** 0.5 / congestion
+    s, e = np.asarray(s, dtype=np.float64), np.asarray(e, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        density = volume / np.round(haversine(s, e), 2)
+        congestion = density / speed
+        w = ((s[..., 0] - e[..., 0]) ** 2 + (s[..., 1] - e[..., 1]) ** 2) ** 0.5 / congestion
+    return np.where(np.isfinite(w), w, weight(s, e, speed))
 
 
 def diste(p1, p2):
@@ -359,6 +672,20 @@ def diste(p1, p2):
     return (pow(abs(p1[0] - p2[0]), 2) + pow(abs(p1[1] - p2[1]), 2)) ** 0.5 / 65
 
 
+def diste_array(coords, p2):
+    """
+    Returns diste from every row of coords to p2.
+
+    Parameters: (coords, p2)
+        coords - float array (N, 2) of (lat, lon)
+        p2 - (lat, lon)
+    """
+    return np.sqrt(np.square(coords[:, 0] - p2[0]) + np.square(coords[:, 1] - p2[1])) / 65
+
+
+diste.array = diste_array
+
+
 def distm(p1, p2):
     """
     Returns manhattan distance divided by the default NYC speed. NOT admissible.
@@ -370,6 +697,32 @@ def distm(p1, p2):
     return abs(p1[0] - p2[0]) + abs(p1[1] - p2[1]) / 65
 
 
+def distm_array(coords, p2):
+    """
+    Returns distm from every row of coords to p2.
+
+    Parameters: (coords, p2)
+        coords - float array (N, 2) of (lat, lon)
+        p2 - (lat, lon)
+    """
+    return np.abs(coords[:, 0] - p2[0]) + np.abs(coords[:, 1] - p2[1]) / 65
+
+
+distm.array = distm_array
+
+
+def default_heuristic(G):
+    """
+    Returns the ALT landmarks of G if they have been loaded, diste otherwise.
+
+    Parameters: (G)
+        G - networkx.graph()
+    """
+    if G.graph.get("landmarks") is not None:
+        return G.graph["landmarks"]
+    return diste
+
+
 # === Helpers ===
 def distance_to_meters(n1, n2):
     """
@@ -382,15 +735,53 @@ def distance_to_meters(n1, n2):
     radius = 6371000  # Radius of earth
     x1, y1 = float(n1[0]), float(n1[1])
     x2, y2 = float(n2[0]), float(n2[1])
-    
-    o1 = np.divide(np.multiply(x1, math.pi), 180)
-    o2 = np.divide(np.multiply(x2,math.pi),180)
-    d1 = np.divide(np.multiply(np.subtract(x2,x1),math.pi),180)
-    d2 = np.divide(np.multiply(np.subtract(y2,y1),math.pi),180)
-
-    a = np.add(np.multiply(np.sin(np.divide(d1,2)),np.sin(np.divide(d1,2))),np.multiply(np.multiply(np.cos(o2),math.sin(np.divide(d2,2))),np.sin(np.divide(d2,2))))
-    c = np.multiply(2, np.arctan(np.divide(np.sqrt(a),np.sqrt(np.subtract(1,a)))))
-    return round(np.multiply(radius,c),2)
+
+    o2 = x2 * math.pi / 180
+    d1 = (x2 - x1) * math.pi / 180
+    d2 = (y2 - y1) * math.pi / 180
+
+    a = math.sin(d1 / 2) * math.sin(d1 / 2) + math.cos(o2) * math.sin(d2 / 2) * math.sin(d2 / 2)
+    c = 2 * math.atan(math.sqrt(a) / math.sqrt(1 - a)) if a < 1 else math.pi
+    return round(radius * c, 2)
+
+
+def haversine(p1, p2, out=None):
+    """
+    Vectorized distance_to_meters (same formula, without the rounding). p1 and p2 are broadcast against each
+    other, so (N, 2) with (2,) is one-to-many and (N, 2) with (N, 2) is elementwise.
+    Returns a float array of the broadcast shape, written into out if given.
+
+    Parameters: (p1, p2, out)
+        p1 - float array (..., 2) of (lat, lon)
+        p2 - float array (..., 2) of (lat, lon)
+        out - float array to write the result into
+    """
+    radius = 6371000  # Radius of earth
+    p1 = np.asarray(p1, dtype=np.float64)
+    p2 = np.asarray(p2, dtype=np.float64)
+    o2 = np.radians(p2[..., 0])
+    d1 = np.radians(p2[..., 0] - p1[..., 0])
+    d2 = np.radians(p2[..., 1] - p1[..., 1])
+
+    a = np.sin(d1 / 2) ** 2 + np.cos(o2) * np.sin(d2 / 2) ** 2
+    a = np.clip(a, 0, 1)
+    with np.errstate(divide="ignore"):
+        c = np.arctan(np.sqrt(a) / np.sqrt(1 - a))
+    return np.multiply(2 * radius, c, out=out)
+
+
+def haversine_pairwise(p1, p2, out=None):
+    """
+    Returns the (N, M) matrix of haversine distances between every row of p1 and every row of p2.
+
+    Parameters: (p1, p2, out)
+        p1 - float array (N, 2) of (lat, lon)
+        p2 - float array (M, 2) of (lat, lon)
+        out - float array (N, M) to write the result into
+    """
+    p1 = np.asarray(p1, dtype=np.float64).reshape(-1, 2)
+    p2 = np.asarray(p2, dtype=np.float64).reshape(-1, 2)
+    return haversine(p1[:, np.newaxis, :], p2[np.newaxis, :, :], out=out)
 
 
 # === Main ===
@@ -0,0 +1,354 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import networkx as nx
+import numpy as np
+from scheduling import Scheduling
+from vehicle import Vehicle
+from admission_control import admission_control
+import astar
+from csr import CSRGraph
+from spatial_index import SpatialIndex
+from route_cache import RouteCache
+from landmarks import build_landmarks
+from ch import build_hierarchy
+from request import Request
+
+# Reproducible benchmarks of routing, nearest node lookups, admission control and Fleet movement.
+# Every workload is generated from the seed, so two runs with the same arguments do the same work and their
+# JSON reports can be compared with --compare. Runs on a synthetic city grid unless --nyc is given.
+
+START = datetime(2015, 1, 1, 8, 0)
+
+
+def grid_city(rows=60, cols=60, spacing=0.001, origin=(40.70, -74.00), drop=0.05, traffic=True, seed=0):
+    """
+    Returns a CSRGraph of a synthetic city: a rows x cols grid of intersections spacing degrees apart, slightly
+    jittered, with drop of the streets removed. Every fifth street is an avenue at 35 mph, the others are 25 mph.
+    With traffic, every street gets random hourly volumes so time dependent routing can be measured.
+
+    Parameters: (rows, cols, spacing, origin, drop, traffic, seed)
+        rows - int
+        cols - int
+        spacing - float (degrees)
+        origin - (lat, lon) of the south west corner
+        drop - float, fraction of streets removed
+        traffic - bool
+        seed - int
+    """
+    rng = np.random.default_rng(seed)
+    lat = origin[0] + np.arange(rows) * spacing
+    lon = origin[1] + np.arange(cols) * spacing
+    nodes = np.stack(np.meshgrid(lat, lon, indexing="ij"), axis=-1)
+    nodes += rng.uniform(-0.1, 0.1, nodes.shape) * spacing
+    ids = np.arange(rows * cols).reshape(rows, cols)
+    # Streets along the rows then along the columns, avenues every fifth line
+    a = np.concatenate([ids[:, :-1].ravel(), ids[:-1, :].ravel()])
+    b = np.concatenate([ids[:, 1:].ravel(), ids[1:, :].ravel()])
+    avenue = np.concatenate([(np.arange(rows) % 5 == 0).repeat(cols - 1), np.tile(np.arange(cols) % 5 == 0, rows - 1)])
+    keep = rng.random(len(a)) >= drop
+    a, b, avenue = a[keep], b[keep], avenue[keep]
+
+    flat = nodes.reshape(-1, 2)
+    s, e = flat[a], flat[b]
+    divider = np.where(avenue, 35, 25)
+    volume = None
+    if traffic:
+        profile = 1 + 0.5 * np.sin((np.arange(24) - 8) * np.pi / 12)  # busiest in the afternoon, never empty
+        volume = (rng.integers(100, 900, (len(a), 1)) * profile).astype(np.float32)
+        w = astar.reweight(s, e, divider, volume.mean(axis=1).astype(np.int64))
+    else:
+        w = astar.weight(s, e, divider)
+    distance = astar.haversine(s, e) / 0.3048  # feet, like the map
+    return CSRGraph.from_segments(s, e, w, distance, divider / 3600 * 1609, volume)
+
+
+def prepare(G, alt=False, ch=False):
+    """
+    Attaches the spatial index, route cache and optionally landmarks and contraction hierarchy to a graph that
+    wasn't loaded with astar.load_data.
+
+    Parameters: (G, alt, ch)
+        G - CSRGraph()
+        alt - bool
+        ch - bool
+    """
+    G.graph["index"] = SpatialIndex(G.nodes())
+    G.graph["csr"] = G
+    G.graph["version"] = 0
+    G.graph["route_cache"] = RouteCache()
+    G.graph["ch"] = build_hierarchy(G, path=None) if ch else None
+    G.graph["landmarks"] = build_landmarks(G, path=None) if alt else None
+    return G
+
+
+def summary(latencies, **extra):
+    """
+    Returns a dict with the count, total time, throughput and latency percentiles (milliseconds) of a list of
+    latencies in seconds, plus extra.
+
+    Parameters: (latencies, extra)
+        latencies - list of float (seconds)
+        extra - values added to the dict
+    """
+    lat = np.asarray(latencies, dtype=np.float64) * 1000
+    total = float(lat.sum()) / 1000
+    report = {"count": len(lat), "total_s": total, "throughput": len(lat) / total if total else 0.0}
+    if len(lat):
+        report.update({"mean_ms": float(lat.mean()), "p50_ms": float(np.percentile(lat, 50)),
+                       "p90_ms": float(np.percentile(lat, 90)), "p99_ms": float(np.percentile(lat, 99)),
+                       "max_ms": float(lat.max())})
+    report.update(extra)
+    return report
+
+
+def peak_memory(run):
+    """
+    Runs run() again under tracemalloc and returns the peak of the memory allocated during it in KiB.
+
+    Parameters: (run)
+        run - callable
+    """
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def random_pairs(G, k, seed):
+    rng = random.Random(seed)
+    return [(rng.randrange(len(G)), rng.randrange(len(G))) for _ in range(k)]
+
+
+def random_requests(G, n, seed, minutes=60):
+    """
+    Returns n Request() between random nodes, sorted, picked up over minutes from START.
+    """
+    rng = random.Random(seed)
+    nodes = G.nodes()
+    times = sorted(rng.randrange(minutes * 60) for _ in range(n))
+    return [Request(nodes[rng.randrange(len(nodes))], nodes[rng.randrange(len(nodes))], 0, 1,
+                    START + timedelta(seconds=t)) for t in times]
+
+
+def bench_routing(G, pairs, heuristic, depart=None):
+    """
+    Routes node id pairs with CSRGraph.astar_path and returns the latency summary with the nodes settled.
+    """
+    csr = G.graph["csr"]
+    nodes = csr.nodes()
+    latencies, settled, unreachable = [], [], 0
+    for s, t in pairs:
+        start = time.perf_counter()
+        try:
+            csr.astar_path(nodes[s], nodes[t], heuristic, depart)
+        except nx.NetworkXNoPath:
+            unreachable += 1
+        latencies.append(time.perf_counter() - start)
+        settled.append(csr.settled)
+    return summary(latencies, settled_mean=float(np.mean(settled)) if settled else 0.0,
+                   settled_p50=float(np.median(settled)) if settled else 0.0, unreachable=unreachable)
+
+
+def bench_hierarchy(G, pairs):
+    ch = G.graph["ch"]
+    nodes = G.nodes()
+    latencies = []
+    for s, t in pairs:
+        start = time.perf_counter()
+        try:
+            ch.query_path(nodes[s], nodes[t])
+        except nx.NetworkXNoPath:
+            pass
+        latencies.append(time.perf_counter() - start)
+    return summary(latencies)
+
+
+def bench_trips(G, trips, heuristic):
+    """
+    Routes trips through astar.find_path with an empty route cache.
+    """
+    G.graph["route_cache"].clear()
+    latencies = []
+    for trip in trips:
+        start = time.perf_counter()
+        try:
+            astar.find_path(G, trip.start, trip.stop, heuristic)
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            pass
+        latencies.append(time.perf_counter() - start)
+    return summary(latencies)
+
+
+def bench_nearest(G, points):
+    """
+    Snaps points one at a time with SpatialIndex.nearest, then all at once with nearest_index.
+    """
+    index = G.graph["index"]
+    latencies = []
+    for p in points.tolist():
+        start = time.perf_counter()
+        index.nearest(p)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    index.nearest_index(points)
+    batch = time.perf_counter() - start
+    return summary(latencies, batch_s=batch, batch_throughput=len(points) / batch if batch else 0.0)
+
+
+def make_fleet(G, vehicles, seed):
+    """
+    Returns a Scheduling() with vehicles available vehicles on random nodes.
+    """
+    rng = random.Random(seed)
+    nodes = G.nodes()
+    scheduling = Scheduling(G)
+    for v in range(vehicles):
+        scheduling.add_vehicle(Vehicle(nodes[rng.randrange(len(nodes))], 40.0, 10.0, 20, True, 4, v))
+    return scheduling
+
+
+def bench_admission(G, vehicles, requests, seed):
+    """
+    Runs admission_control for every request against a fleet of available vehicles. Nothing is assigned, so
+    every request sees the same fleet.
+    """
+    G.graph["route_cache"].clear()
+    scheduling = make_fleet(G, vehicles, seed)
+    fleet = scheduling._grid_fleet()
+    latencies, candidates, admitted = [], [], 0
+    for r in requests:
+        candidates.append(len(fleet.within(r.start, 3000)))
+        start = time.perf_counter()
+        result = admission_control(r, scheduling.vehicles, G, fleet)
+        latencies.append(time.perf_counter() - start)
+        admitted += -1 not in result
+    return summary(latencies, candidates_mean=float(np.mean(candidates)) if candidates else 0.0,
+                   admitted=admitted)
+
+
+def bench_move(G, vehicles, requests, steps, seed, step=5):
+    """
+    Assigns one request to every vehicle and times steps Scheduling.move calls of step seconds.
+    """
+    G.graph["route_cache"].clear()
+    scheduling = make_fleet(G, vehicles, seed)
+    heuristic = astar.default_heuristic(G)
+    for v, r in zip(scheduling.vehicles, requests):
+        try:
+            v.assign_trip(G, r, heuristic)
+        except nx.NetworkXNoPath:
+            continue
+    latencies, moving = [], []
+    for _ in range(steps):
+        moving.append(sum(1 for v in scheduling.vehicles if v.trips))
+        start = time.perf_counter()
+        scheduling.move(step)
+        latencies.append(time.perf_counter() - start)
+    return summary(latencies, vehicle_steps=int(sum(moving)),
+                   vehicle_steps_per_s=sum(moving) / sum(latencies) if sum(latencies) else 0.0)
+
+
+def run(args):
+    """
+    Runs every benchmark and returns the report.
+    """
+    if args.nyc:
+        G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False, alt=args.alt, ch=args.ch)
+        trips = list(trips[:args.requests])
+    else:
+        G = prepare(grid_city(args.rows, args.cols, traffic=True, seed=args.seed), args.alt, args.ch)
+        trips = random_requests(G, args.requests, args.seed)
+    csr = G.graph["csr"]
+    pairs = random_pairs(G, args.pairs, args.seed)
+    rng = np.random.default_rng(args.seed)
+    lo, hi = csr.coords.min(axis=0), csr.coords.max(axis=0)
+    points = rng.uniform(lo, hi, (args.points, 2))
+
+    heuristics = {"dijkstra": None, "diste": astar.diste}
+    if G.graph["landmarks"] is not None:
+        heuristics["alt"] = G.graph["landmarks"]
+    benchmarks = {}
+    for name, heuristic in heuristics.items():
+        benchmarks["routing." + name] = lambda h=heuristic: bench_routing(G, pairs, h)
+    if csr.volume is not None:
+        benchmarks["routing.time_dependent"] = lambda: bench_routing(G, pairs, astar.default_heuristic(G), START)
+    if G.graph["ch"] is not None:
+        benchmarks["routing.ch"] = lambda: bench_hierarchy(G, pairs)
+    benchmarks["trips"] = lambda: bench_trips(G, trips, astar.default_heuristic(G))
+    benchmarks["nearest"] = lambda: bench_nearest(G, points)
+    benchmarks["admission_control"] = lambda: bench_admission(G, args.vehicles, trips, args.seed)
+    benchmarks["move"] = lambda: bench_move(G, args.vehicles, trips, args.steps, args.seed)
+
+    results = {}
+    for name, bench in benchmarks.items():
+        if args.only and not any(name.startswith(o) for o in args.only):
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        results[name] = bench()
+        if args.memory:
+            results[name]["peak_kib"] = peak_memory(bench)
+    return {"meta": {"date": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+                     "numpy": np.__version__, "machine": platform.machine(), "seed": args.seed,
+                     "graph": "nyc" if args.nyc else f"grid {args.rows}x{args.cols}", "nodes": len(csr),
+                     "edges": csr.number_of_edges(), "pairs": args.pairs, "points": args.points,
+                     "vehicles": args.vehicles, "requests": len(trips), "steps": args.steps},
+            "results": results}
+
+
+def compare(report, base):
+    """
+    Prints the p50 latency and throughput of report next to base, with the ratio report / base.
+
+    Parameters: (report, base)
+        report - dict
+        base - dict
+    """
+    print(f"{'benchmark':<24}{'p50 ms':>12}{'base':>12}{'ratio':>8}{'per s':>12}{'base':>12}{'ratio':>8}")
+    for name, result in report["results"].items():
+        old = base["results"].get(name)
+        if old is None:
+            continue
+        row = f"{name:<24}"
+        for key in ("p50_ms", "throughput"):
+            new_value, old_value = result.get(key, 0.0), old.get(key, 0.0)
+            ratio = new_value / old_value if old_value else float("nan")
+            row += f"{new_value:>12.3f}{old_value:>12.3f}{ratio:>8.2f}"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="python benchmark.py [options]")
+    parser.add_argument("--rows", type=int, default=60, help="rows of the synthetic grid")
+    parser.add_argument("--cols", type=int, default=60, help="columns of the synthetic grid")
+    parser.add_argument("--nyc", action="store_true", help="use the NYC graph and trips from load_data")
+    parser.add_argument("--alt", action="store_true", help="build ALT landmarks")
+    parser.add_argument("--ch", action="store_true", help="build the contraction hierarchy")
+    parser.add_argument("--pairs", type=int, default=200, help="random node pairs routed")
+    parser.add_argument("--points", type=int, default=20000, help="random points snapped to nodes")
+    parser.add_argument("--vehicles", type=int, default=200, help="vehicles in the synthetic fleet")
+    parser.add_argument("--requests", type=int, default=100, help="trips routed and admitted")
+    parser.add_argument("--steps", type=int, default=100, help="Fleet movement steps")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc pass")
+    parser.add_argument("--only", nargs="*", default=None, help="run the benchmarks whose name starts with these")
+    parser.add_argument("--output", default="benchmark.json", help="JSON report")
+    parser.add_argument("--compare", default=None, metavar="JSON", help="report to compare with")
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, "w") as out:
+        json.dump(report, out, indent=2)
+    for name, result in report["results"].items():
+        print(f"{name}: {result.get('p50_ms', 0):.3f} ms p50, {result.get('p99_ms', 0):.3f} ms p99, "
+              f"{result['throughput']:.1f}/s" + (f", {result['peak_kib']:.0f} KiB peak" if "peak_kib" in result else ""))
+    if args.compare:
+        with open(args.compare) as base:
+            compare(report, json.load(base))
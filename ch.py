@@ -0,0 +1,327 @@
+from heapq import heappush, heappop, heapify
+import hashlib
+import networkx as nx
+import numpy as np
+import instrument
+
+
+class ContractionHierarchy():
+    """
+    A contraction hierarchy over the weight attribute of the road graph for exact point to point queries.
+    Ids are the node ids of the CSRGraph it was built from.
+
+    ===Attributes===
+    csr: CSRGraph the hierarchy was built from
+    rank: int64 array (N), order in which every node was contracted
+    indptr: int64 array (N + 1), the upward edges of id are indptr[id]:indptr[id + 1]
+    indices: int32 array, head of every upward edge (always of higher rank)
+    weight: float64 array, weight of every upward edge
+    mid: int32 array, contracted node an upward edge is a shortcut over, -1 for road edges
+    """
+    csr: object
+    rank: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    weight: np.ndarray
+    mid: np.ndarray
+
+    def __init__(self, csr, rank, indptr, indices, weight, mid):
+        self.csr = csr
+        self.rank = rank
+        self.indptr = indptr
+        self.indices = indices
+        self.weight = weight
+        self.mid = mid
+        self._indptr = indptr.tolist()
+        self._indices = indices.tolist()
+        self._weight = weight.tolist()
+        self._rank = rank.tolist()
+
+    def __len__(self):
+        return len(self.rank)
+
+    def query(self, source, target):
+        """
+        Returns (cost, path) of the shortest path from source to target, path being a list of ids.
+        Raises networkx.NetworkXNoPath.
+
+        Parameters: (self, source, target)
+            source - int
+            target - int
+        """
+        if source == target:
+            return 0, [source]
+        indptr = self._indptr
+        indices = self._indices
+        weights = self._weight
+        dist = ({source: 0}, {target: 0})
+        parent = ({source: -1}, {target: -1})  # position of the upward edge used to reach a node
+        settled = (set(), set())
+        queues = ([(0, source)], [(0, target)])
+        best = float("inf")
+        meet = -1
+        while True:
+            tops = [q[0][0] if q else float("inf") for q in queues]
+            if min(tops) >= best:
+                break
+            side = 0 if tops[0] <= tops[1] else 1
+            d, u = heappop(queues[side])
+            if u in settled[side]:
+                continue
+            settled[side].add(u)
+            other = dist[1 - side].get(u)
+            if other is not None and d + other < best:
+                best = d + other
+                meet = u
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nd = d + weights[k]
+                if nd < dist[side].get(v, float("inf")):
+                    dist[side][v] = nd
+                    parent[side][v] = k
+                    heappush(queues[side], (nd, v))
+        if meet == -1:
+            raise nx.NetworkXNoPath(f"Node {self.csr.nodes[target]} not reachable from {self.csr.nodes[source]}")
+
+        forward = self._up_path(meet, parent[0])
+        backward = self._up_path(meet, parent[1])
+        path = [source]
+        for low, high in reversed(forward):
+            path.extend(self._unpack(low, high)[1:])
+        back = [target]
+        for low, high in reversed(backward):
+            back.extend(self._unpack(low, high)[1:])
+        path.extend(back[-2::-1])
+        return self._cost(path), path
+
+    def upward(self, source):
+        """
+        Returns a dict with the cost of every id reached by the full upward search from source.
+
+        Parameters: (self, source)
+            source - int
+        """
+        indptr = self._indptr
+        indices = self._indices
+        weights = self._weight
+        dist = {source: 0}
+        queue = [(0, source)]
+        settled = {}
+        while queue:
+            d, u = heappop(queue)
+            if u in settled:
+                continue
+            settled[u] = d
+            for k in range(indptr[u], indptr[u + 1]):
+                v = indices[k]
+                nd = d + weights[k]
+                if nd < dist.get(v, float("inf")):
+                    dist[v] = nd
+                    heappush(queue, (nd, v))
+        return settled
+
+    def _up_path(self, node, parent):
+        """
+        Returns the upward edges (low, high) walked from the search root to node, last edge first.
+        """
+        edges = []
+        k = parent[node]
+        while k != -1:
+            low = int(np.searchsorted(self.indptr, k, side="right")) - 1
+            edges.append((low, node))
+            node = low
+            k = parent[node]
+        return edges
+
+    def _unpack(self, a, b):
+        """
+        Returns the road nodes from a to b of the hierarchy edge between them.
+        """
+        out = [a]
+        stack = [(a, b)]
+        while stack:
+            p, q = stack.pop()
+            if self._rank[p] < self._rank[q]:
+                m = int(self.mid[self._find(p, q)])
+            else:
+                m = int(self.mid[self._find(q, p)])
+            if m == -1:
+                out.append(q)
+            else:
+                # The middle node was contracted before both ends so both halves are upward edges of m
+                stack.append((m, q))
+                stack.append((p, m))
+        return out
+
+    def _find(self, low, high):
+        """
+        Returns the position of the upward edge low -> high.
+        """
+        for k in range(self._indptr[low], self._indptr[low + 1]):
+            if self._indices[k] == high:
+                return k
+        raise KeyError((low, high))
+
+    def _cost(self, path):
+        """
+        Returns the weight of a road path summed in order, like networkx.path_weight.
+        """
+        weights = self.csr._weight
+        cost = 0
+        for u, v in zip(path, path[1:]):
+            cost += weights[self.csr.edge(u, v)]
+        return cost
+
+    def query_path(self, n1, n2):
+        """
+        Returns (cost, path) from n1 to n2 with path being a list of nodes.
+
+        Parameters: (self, n1, n2)
+            n1 - (lat, lon)
+            n2 - (lat, lon)
+        """
+        ids = self.csr.ids
+        if n1 not in ids:
+            raise nx.NodeNotFound(f"Source {n1} is not in G")
+        if n2 not in ids:
+            raise nx.NodeNotFound(f"Target {n2} is not in G")
+        instrument.count("ch.queries")
+        cost, path = self.query(ids[n1], ids[n2])
+        return cost, [self.csr.nodes[i] for i in path]
+
+    def save(self, path="ch.npz"):
+        """
+        Saves the hierarchy in a numpy file.
+
+        Parameters: (self, path)
+            path - string
+        """
+        np.savez(path, rank=self.rank, indptr=self.indptr, indices=self.indices, weight=self.weight, mid=self.mid,
+                 checksum=checksum(self.csr))
+
+
+def checksum(csr):
+    """
+    Returns a fingerprint (SHA-1) of the edges and edge weights of csr used to detect a hierarchy built for
+    another graph.
+
+    Parameters: (csr)
+        csr - CSRGraph()
+    """
+    digest = hashlib.sha1()
+    for array, dtype in ((csr.indptr, np.int64), (csr.indices, np.int64), (csr.weight, np.float64)):
+        digest.update(np.ascontiguousarray(array, dtype=dtype).tobytes())
+    return np.array(digest.hexdigest())
+
+
+def load_hierarchy(csr, path="ch.npz"):
+    """
+    Returns the hierarchy saved in path for csr, None if it is missing or was built for another graph.
+
+    Parameters: (csr, path)
+        csr - CSRGraph()
+        path - string
+    """
+    try:
+        data = np.load(path)
+    except OSError:
+        return None
+    if not np.array_equal(data["checksum"], checksum(csr)):
+        return None
+    return ContractionHierarchy(csr, data["rank"], data["indptr"], data["indices"], data["weight"], data["mid"])
+
+
+def build_hierarchy(csr, path="ch.npz", settle_limit=500):
+    """
+    Contracts every node of csr in edge difference order and saves the hierarchy in path.
+
+    Parameters: (csr, path, settle_limit)
+        csr - CSRGraph()
+        path - string, None to not save
+        settle_limit - int, nodes settled per witness search before giving up and adding the shortcut
+    """
+    n = len(csr)
+    # adj[u][v] = (weight, mid) for every edge between nodes that are not contracted yet
+    adj = [dict() for _ in range(n)]
+    for u in range(n):
+        for k in range(csr._indptr[u], csr._indptr[u + 1]):
+            v = csr._indices[k]
+            w = csr._weight[k]
+            if v != u and (v not in adj[u] or w < adj[u][v][0]):
+                adj[u][v] = (w, -1)
+
+    def witness(u, skip, limit, targets):
+        # Dijkstra from u that ignores skip, bounded by limit and settle_limit
+        dist = {u: 0}
+        queue = [(0, u)]
+        done = set()
+        remaining = set(targets)
+        while queue and len(done) < settle_limit and remaining:
+            d, x = heappop(queue)
+            if x in done:
+                continue
+            if d > limit:
+                break
+            done.add(x)
+            remaining.discard(x)
+            for y, (w, _) in adj[x].items():
+                if y == skip:
+                    continue
+                nd = d + w
+                if nd < dist.get(y, float("inf")):
+                    dist[y] = nd
+                    heappush(queue, (nd, y))
+        return dist
+
+    def shortcuts(v):
+        nbrs = list(adj[v].items())
+        found = []
+        for i, (u, (wu, _)) in enumerate(nbrs):
+            rest = nbrs[i + 1:]
+            if not rest:
+                break
+            limit = wu + max(wx for _, (wx, _) in rest)
+            dist = witness(u, v, limit, [x for x, _ in rest])
+            for x, (wx, _) in rest:
+                if dist.get(x, float("inf")) > wu + wx:
+                    found.append((u, x, wu + wx))
+        return found
+
+    deleted = [0] * n
+
+    def priority(v):
+        return len(shortcuts(v)) - len(adj[v]) + deleted[v]
+
+    queue = [(priority(v), v) for v in range(n)]
+    heapify(queue)
+    rank = np.empty(n, dtype=np.int64)
+    up = [None] * n
+    order = 0
+    while queue:
+        p, v = heappop(queue)
+        # Lazy update: contract v only if it is still the best candidate
+        current = priority(v)
+        if queue and current > queue[0][0]:
+            heappush(queue, (current, v))
+            continue
+        for u, x, w in shortcuts(v):
+            if x not in adj[u] or w < adj[u][x][0]:
+                adj[u][x] = (w, v)
+                adj[x][u] = (w, v)
+        rank[v] = order
+        order += 1
+        up[v] = list(adj[v].items())
+        for u in adj[v]:
+            del adj[u][v]
+            deleted[u] += 1
+        adj[v] = {}
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in up], out=indptr[1:])
+    indices = np.array([u for e in up for u, _ in e], dtype=np.int32)
+    weight = np.array([w for e in up for _, (w, _) in e], dtype=np.float64)
+    mid = np.array([m for e in up for _, (_, m) in e], dtype=np.int32)
+    ch = ContractionHierarchy(csr, rank, indptr, indices, weight, mid)
+    if path is not None:
+        ch.save(path)
+    return ch
@@ -0,0 +1,708 @@
+from heapq import heappush, heappop
+from itertools import count
+import json
+import os
+import pickle
+import networkx as nx
+import numpy as np
+import instrument
+
+# Version of the binary graph format written by save_graph
+GRAPH_VERSION = 1
+GRAPH_ARRAYS = ("coords", "indptr", "indices", "weight", "distance", "speed")
+# Arrays that older graphs don't have, the last four only exist in simplified graphs (see simplify)
+OPTIONAL_ARRAYS = ("volume", "component", "hourly", "shape_ptr", "shape", "segment_speed")
+
+
+class NodeList(list):
+    """
+    List of nodes that can also be called like networkx.graph().nodes().
+    """
+
+    def __call__(self):
+        return self
+
+
+class CSRGraph():
+    """
+    A compact copy of the road graph in compressed sparse row layout, used for routing.
+    Nodes are mapped to integer ids in G.nodes() order and the neighbours of every node keep the
+    order of G[node], so searches break ties exactly like networkx.
+
+    ===Attributes===
+    nodes: list of nodes, nodes[id] = (lat, lon)
+    ids: dict mapping (lat, lon) to id
+    coords: float64 array (N, 2) of node coordinates
+    indptr: int64 array (N + 1), the edges of id are indptr[id]:indptr[id + 1]
+    indices: int32 array (2E), head of every edge
+    weight: float64 array (2E), the weight attribute of every edge
+    distance: float64 array (2E), the distance attribute of every edge
+    speed: float64 array (2E), the speed attribute of every edge
+    volume: float32 array (2E, 24), traffic volume of the street of every edge per hour, None if not loaded
+    component: int32 array (N), connected component of every node numbered by decreasing size (0 is the giant
+               component), None until components() is called on graphs saved without it
+    hourly: float64 array (24, 2E), stored hourly weights of simplified graphs (they can't be recomputed from
+            volume), None otherwise
+    shape_ptr: int64 array (2E + 1), the shape points of edge k are shape[shape_ptr[k]:shape_ptr[k + 1]],
+               None if the graph wasn't simplified
+    shape: float64 array (P, 2), (lat, lon) of the points between the ends of every edge, in travel order
+    segment_speed: float64 array (P + 2E), speed of every straight piece of every edge, the pieces of edge k
+                   are segment_speed[shape_ptr[k] + k:shape_ptr[k + 1] + k + 1]
+    settled: number of nodes expanded by the last astar call
+    graph: dict of data attached to the graph (same role as networkx.graph().graph)
+    """
+    nodes: list
+    ids: dict
+    coords: np.ndarray
+    indptr: np.ndarray
+    indices: np.ndarray
+    weight: np.ndarray
+    distance: np.ndarray
+    speed: np.ndarray
+    volume: np.ndarray
+    component: np.ndarray
+    hourly: np.ndarray
+    shape_ptr: np.ndarray
+    shape: np.ndarray
+    segment_speed: np.ndarray
+    settled: int
+    graph: dict
+
+    def __init__(self, coords, indptr, indices, weight, distance, speed, volume=None, component=None, hourly=None,
+                 shape_ptr=None, shape=None, segment_speed=None):
+        self.coords = coords
+        self.indptr = indptr
+        self.indices = indices
+        self.weight = weight
+        self.distance = distance
+        self.speed = speed
+        self.volume = volume
+        self.component = component
+        self.hourly = hourly
+        self.shape_ptr = shape_ptr
+        self.shape = shape
+        self.segment_speed = segment_speed
+        self.settled = 0
+        self.graph = {}
+        # The python copies used by the searches are only made when they are first needed, so opening a
+        # memory mapped graph doesn't read it
+        self._nodes = None
+        self._ids = None
+        self._lists = None
+        self._hourly = None
+        self._hour_lists = {}
+        self._seconds = None
+        self._lengths = None
+        self._components = None
+
+    @property
+    def nodes(self):
+        if self._nodes is None:
+            self._nodes = NodeList(tuple(c) for c in self.coords.tolist())
+        return self._nodes
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = {n: i for i, n in enumerate(self.nodes)}
+        return self._ids
+
+    def _load_lists(self):
+        if self._lists is None:
+            self._lists = (self.indptr.tolist(), self.indices.tolist(), self.weight.tolist())
+        return self._lists
+
+    @property
+    def _indptr(self):
+        return self._load_lists()[0]
+
+    @property
+    def _indices(self):
+        return self._load_lists()[1]
+
+    @property
+    def _weight(self):
+        return self._load_lists()[2]
+
+    @classmethod
+    def from_networkx(cls, G):
+        """
+        Compiles a graph built by astar.pickle_graph into a CSRGraph.
+
+        Parameters: (G)
+            G - networkx.graph()
+        """
+        ids = {n: i for i, n in enumerate(G.nodes())}
+        coords = np.array(list(G.nodes()), dtype=np.float64).reshape(-1, 2)
+        degree = np.fromiter((len(G._adj[n]) for n in G.nodes()), dtype=np.int64, count=len(ids))
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        m = int(indptr[-1])
+        indices = np.empty(m, dtype=np.int32)
+        weight = np.empty(m, dtype=np.float64)
+        distance = np.empty(m, dtype=np.float64)
+        speed = np.empty(m, dtype=np.float64)
+        k = 0
+        for n in G.nodes():
+            for v, d in G._adj[n].items():
+                indices[k] = ids[v]
+                weight[k] = d.get("weight", 1)
+                distance[k] = d.get("distance", 0)
+                speed[k] = d.get("speed", 0)
+                k += 1
+        return cls(coords, indptr, indices, weight, distance, speed)
+
+    @classmethod
+    def from_segments(cls, starts, ends, weight, distance, speed, volume=None):
+        """
+        Builds the CSRGraph that adding every segment in order to a networkx.graph() with add_edge and then
+        calling from_networkx would give: nodes in order of first appearance (start before end), neighbours in
+        order of the first segment joining them and the attributes of the last segment joining them.
+        Equal coordinates are coalesced into one node.
+
+        Parameters: (starts, ends, weight, distance, speed, volume)
+            starts - float64 array (S, 2) of (lat, lon)
+            ends - float64 array (S, 2) of (lat, lon)
+            weight - float64 array (S)
+            distance - float64 array (S)
+            speed - float64 array (S)
+            volume - float32 array (S, 24), None for no volumes
+        """
+        n = len(starts)
+        points = np.empty((2 * n, 2), dtype=np.float64)
+        points[0::2] = starts
+        points[1::2] = ends
+        _, first, inverse = np.unique(points, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        # Number the nodes in order of first appearance
+        order = np.argsort(first, kind="stable")
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        coords = points[first[order]]  # first spelling of every node, like networkx keeps (0.0 vs -0.0)
+        a, b = rank[inverse[0::2]], rank[inverse[1::2]]
+
+        # First and last segment of every undirected pair
+        low, high = np.minimum(a, b), np.maximum(a, b)
+        pair = low * len(coords) + high
+        sorted_pairs = np.argsort(pair, kind="stable")
+        starts_of = np.flatnonzero(np.r_[True, pair[sorted_pairs][1:] != pair[sorted_pairs][:-1]])
+        ends_of = np.r_[starts_of[1:], n] - 1
+        first_seg = sorted_pairs[starts_of]
+        last_seg = sorted_pairs[ends_of]
+        u, v = low[first_seg], high[first_seg]
+
+        # Both directions of every pair, a self loop only once, neighbours ordered by first segment
+        loop = u == v
+        tail = np.concatenate([u, v[~loop]])
+        head = np.concatenate([v, u[~loop]])
+        when = np.concatenate([first_seg, first_seg[~loop]])
+        last = np.concatenate([last_seg, last_seg[~loop]])
+        edge_order = np.lexsort((when, tail))
+        tail, head, last = tail[edge_order], head[edge_order], last[edge_order]
+
+        indptr = np.zeros(len(coords) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tail, minlength=len(coords)), out=indptr[1:])
+        csr = cls(coords, indptr, head.astype(np.int32), np.asarray(weight, dtype=np.float64)[last],
+                  np.asarray(distance, dtype=np.float64)[last], np.asarray(speed, dtype=np.float64)[last])
+        if volume is not None:
+            csr.volume = np.asarray(volume, dtype=np.float32)[last]
+        return csr
+
+    def tails(self):
+        """
+        Returns an int64 array (2E) with the tail of every edge.
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+    def components(self):
+        """
+        Returns the component array, labelling the graph the first time if it wasn't saved with it.
+        """
+        if self.component is None:
+            self.component = label_components(self)
+        return self.component
+
+    def connected(self, u, v):
+        """
+        Returns whether there is a path between the ids u and v, in constant time.
+
+        Parameters: (self, u, v)
+            u - int
+            v - int
+        """
+        if self._components is None:
+            self._components = self.components().tolist()
+        return self._components[u] == self._components[v]
+
+    def giant_nodes(self):
+        """
+        Returns the list of the nodes of the largest connected component.
+        """
+        nodes = self.nodes
+        return [nodes[i] for i in np.flatnonzero(self.components() == 0).tolist()]
+
+    def hourly_weights(self):
+        """
+        Returns a float64 array (24, 2E) with the weight of every edge for every hour of the day, computed from
+        volume like astar.pickle_graph does for one hour. Edges without traffic data keep astar.weight.
+        Raises ValueError if the graph has no volumes.
+        """
+        if self.volume is None:
+            raise ValueError("The graph has no hourly traffic volumes")
+        if self._hourly is None and self.hourly is not None:
+            self._hourly = np.asarray(self.hourly)
+        if self._hourly is None:
+            from astar import reweight
+            s, e = self.coords[self.tails()], self.coords[self.indices]
+            limit = np.round(np.asarray(self.speed) * 3600 / 1609, 6)  # speed limit in mph
+            volume = np.asarray(self.volume, dtype=np.float64)
+            self._hourly = np.stack([reweight(s, e, limit, volume[:, h]) for h in range(24)])
+        return self._hourly
+
+    def _hour_weights(self, hour):
+        """
+        Returns the list of edge weights of hour. Only the hours that are used are copied to lists.
+        """
+        if hour not in self._hour_lists:
+            self._hour_lists[hour] = self.hourly_weights()[hour].tolist()
+        return self._hour_lists[hour]
+
+    def seconds(self):
+        """
+        Returns a list with the seconds needed to drive every edge at its speed limit.
+        """
+        if self._seconds is None:
+            from astar import haversine
+            if self.shape_ptr is None:
+                speed = np.maximum(np.asarray(self.speed), 1e-9)
+                self._seconds = (haversine(self.coords[self.tails()], self.coords[self.indices]) / speed).tolist()
+            else:
+                starts, ends = self.segments()
+                seconds = haversine(starts, ends) / np.maximum(np.asarray(self.segment_speed), 1e-9)
+                first = np.asarray(self.shape_ptr[:-1]) + np.arange(len(self.indices))
+                self._seconds = np.add.reduceat(seconds, first).tolist() if len(first) else []
+        return self._seconds
+
+    def lengths(self):
+        """
+        Returns a float64 array with the length in metres (astar.haversine) of every edge, along its shape points
+        in a simplified graph.
+        """
+        if self._lengths is None:
+            from astar import haversine
+            pieces = haversine(*self.segments())
+            if self.shape_ptr is None:
+                self._lengths = pieces
+            else:
+                first = np.asarray(self.shape_ptr[:-1]) + np.arange(len(self.indices))
+                self._lengths = np.add.reduceat(pieces, first) if len(first) else pieces
+        return self._lengths
+
+    def segments(self):
+        """
+        Returns (starts, ends), float64 arrays (S, 2) of the straight pieces the edges are drawn with, edge by
+        edge: the edge itself, or the pieces between its shape points in a simplified graph.
+        """
+        starts, ends = self.coords[self.tails()], self.coords[self.indices]
+        if self.shape_ptr is None:
+            return starts, ends
+        # Points of every edge in travel order: tail, shape points, head
+        m = len(self.indices)
+        shape_ptr = np.asarray(self.shape_ptr)
+        first = shape_ptr[:-1] + 2 * np.arange(m)
+        last = shape_ptr[1:] + 2 * np.arange(m) + 1
+        points = np.empty((len(self.shape) + 2 * m, 2))
+        points[first] = starts
+        points[last] = ends
+        owner = np.repeat(np.arange(m), np.diff(shape_ptr))
+        points[np.arange(len(self.shape)) + 2 * owner + 1] = self.shape
+        is_first = np.zeros(len(points), dtype=bool)
+        is_first[first] = True
+        is_last = np.zeros(len(points), dtype=bool)
+        is_last[last] = True
+        return points[~is_last], points[~is_first]
+
+    def __len__(self):
+        return len(self.coords)
+
+    def __contains__(self, node):
+        return node in self.ids
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __getitem__(self, node):
+        """
+        Returns the neighbours of node like networkx: {neighbour: {"weight": ..., "distance": ..., "speed": ...}}.
+        """
+        u = self.ids[node]
+        nodes = self.nodes
+        return {nodes[int(self.indices[k])]: {"weight": float(self.weight[k]), "distance": float(self.distance[k]),
+                                              "speed": float(self.speed[k])}
+                for k in range(int(self.indptr[u]), int(self.indptr[u + 1]))}
+
+    def number_of_nodes(self):
+        return len(self)
+
+    def number_of_edges(self):
+        return len(self.indices) // 2
+
+    def neighbors(self, node):
+        """
+        Returns an iterator over the neighbours of node.
+
+        Parameters: (self, node)
+            node - (lat, lon)
+        """
+        u = self.ids[node]
+        return iter([self.nodes[v] for v in self._indices[self._indptr[u]:self._indptr[u + 1]]])
+
+    def edges(self, data=False):
+        """
+        Returns a list of the edges as (u, v), or (u, v, attributes) if data=True. Every edge is listed once,
+        from the endpoint that comes first in G.nodes() order.
+
+        Parameters: (self, data)
+            data - bool
+        """
+        tails = self.tails()
+        keep = np.flatnonzero(tails <= self.indices)
+        nodes = self.nodes
+        if not data:
+            return [(nodes[u], nodes[v]) for u, v in zip(tails[keep].tolist(), self.indices[keep].tolist())]
+        return [(nodes[u], nodes[v], {"weight": w, "distance": d, "speed": sp})
+                for u, v, w, d, sp in zip(tails[keep].tolist(), self.indices[keep].tolist(), self.weight[keep].tolist(),
+                                          self.distance[keep].tolist(), self.speed[keep].tolist())]
+
+    def to_networkx(self):
+        """
+        Returns a networkx.graph() with the same nodes, edges and edge attributes.
+        """
+        G = nx.Graph()
+        G.add_nodes_from(self.nodes)
+        G.add_edges_from(self.edges(data=True))
+        return G
+
+    def edge(self, u, v):
+        """
+        Returns the position of the edge u -> v in the edge arrays.
+
+        Parameters: (self, u, v)
+            u - int
+            v - int
+        """
+        for k in range(self._indptr[u], self._indptr[u + 1]):
+            if self._indices[k] == v:
+                return k
+        raise KeyError((self.nodes[u], self.nodes[v]))
+
+    def astar(self, source, target, heuristic=None, depart=None):
+        """
+        Returns (cost, path) of the shortest path from source to target, path being a list of ids.
+        Same algorithm and tie-breaking as networkx.astar_path. Raises networkx.NetworkXNoPath.
+        If depart is given and the graph has volumes, every edge costs its weight for the hour in which it's
+        entered, the clock being advanced by the time needed to drive every edge at the speed limit.
+
+        Parameters: (self, source, target, heuristic, depart)
+            source - int
+            target - int
+            heuristic - callable taking two nodes (lat, lon), None for Dijkstra. If it has an array attribute,
+                        heuristic.array(coords, target) is used to evaluate it for every node at once
+            depart - datetime or seconds after midnight, None for the static weights
+        """
+        nodes = self.nodes
+        if not self.connected(source, target):
+            self.settled = 0
+            instrument.count("astar.rejected")
+            raise nx.NetworkXNoPath(f"Node {nodes[target]} not reachable from {nodes[source]}")
+        timed = depart is not None and self.volume is not None
+        if timed:
+            start = seconds_of_day(depart)
+            seconds = self.seconds()
+            arrival = [0.0] * len(self)
+        indptr = self._indptr
+        indices = self._indices
+        weights = self._weight
+        goal = nodes[target]
+        if heuristic is None:
+            table = [0] * len(nodes)
+        elif hasattr(heuristic, "array"):
+            table = heuristic.array(self.coords, goal).tolist()
+        else:
+            table = None
+        # enqueued[id] is the cost of the best path pushed so far, explored[id] the parent (-1 for source)
+        enqueued = [float("inf")] * len(nodes)
+        explored = [-2] * len(nodes)
+        c = count()
+        queue = [(0, next(c), source, 0, -1)]
+        settled = 0
+        while queue:
+            _, __, curnode, dist, parent = heappop(queue)
+            if curnode == target:
+                self.settled = settled
+                instrument.count("astar.calls")
+                instrument.count("astar.settled", settled)
+                path = [curnode]
+                node = parent
+                while node != -1:
+                    path.append(node)
+                    node = explored[node]
+                path.reverse()
+                return dist, path
+            if explored[curnode] != -2:
+                # Do not override the parent of starting node, skip paths that were beaten after being pushed
+                if explored[curnode] == -1 or enqueued[curnode] < dist:
+                    continue
+            explored[curnode] = parent
+            settled += 1
+            a, b = indptr[curnode], indptr[curnode + 1]
+            if timed:
+                # arrival[curnode] belongs to the path being expanded since beaten paths were skipped
+                clock = arrival[curnode]
+                weights = self._hour_weights(int(start + clock) // 3600 % 24)
+                for neighbor, cost, t in zip(indices[a:b], weights[a:b], seconds[a:b]):
+                    ncost = dist + cost
+                    if enqueued[neighbor] <= ncost:
+                        continue
+                    enqueued[neighbor] = ncost
+                    arrival[neighbor] = clock + t
+                    h = table[neighbor] if table is not None else heuristic(nodes[neighbor], goal)
+                    heappush(queue, (ncost + h, next(c), neighbor, ncost, curnode))
+                continue
+            for neighbor, cost in zip(indices[a:b], weights[a:b]):
+                ncost = dist + cost
+                if enqueued[neighbor] <= ncost:
+                    continue
+                enqueued[neighbor] = ncost
+                h = table[neighbor] if table is not None else heuristic(nodes[neighbor], goal)
+                heappush(queue, (ncost + h, next(c), neighbor, ncost, curnode))
+        self.settled = settled
+        instrument.count("astar.calls")
+        instrument.count("astar.settled", settled)
+        raise nx.NetworkXNoPath(f"Node {goal} not reachable from {nodes[source]}")
+
+    def dijkstra(self, source, cutoff=None, targets=None, hour=None):
+        """
+        Returns (dist, parent) dicts of every id settled from source, parent[source] = -1.
+        Stops early once every id in targets has been settled or the cost goes over cutoff.
+
+        Parameters: (self, source, cutoff, targets, hour)
+            source - int
+            cutoff - float
+            targets - iterable of ids
+            hour - int, use the weights of this hour of the day (needs volumes), None for the static weights
+        """
+        indptr = self._indptr
+        indices = self._indices
+        weights = self._weight if hour is None or self.volume is None else self._hour_weights(hour % 24)
+        remaining = set(targets) if targets is not None else None
+        dist = {}
+        parent = {}
+        seen = {source: 0}
+        queue = [(0, source, -1)]
+        while queue:
+            d, u, p = heappop(queue)
+            if u in dist:
+                continue
+            if cutoff is not None and d > cutoff:
+                break
+            dist[u] = d
+            parent[u] = p
+            if remaining is not None:
+                remaining.discard(u)
+                if not remaining:
+                    break
+            a, b = indptr[u], indptr[u + 1]
+            for v, w in zip(indices[a:b], weights[a:b]):
+                nd = d + w
+                if v not in dist and nd < seen.get(v, float("inf")):
+                    seen[v] = nd
+                    heappush(queue, (nd, v, u))
+        instrument.count("dijkstra.calls")
+        instrument.count("dijkstra.settled", len(dist))
+        return dist, parent
+
+    def expand_path(self, path):
+        """
+        Returns path (a list of nodes) with the shape points of its edges inserted, so it follows the streets
+        of a simplified graph. Other graphs return a copy of path.
+
+        Parameters: (self, path)
+            path - list of nodes
+        """
+        if self.shape_ptr is None:
+            return list(path)
+        ids = self.ids
+        expanded = list(path[:1])
+        for a, b in zip(path, path[1:]):
+            k = self.edge(ids[a], ids[b])
+            expanded += [tuple(p) for p in self.shape[self.shape_ptr[k]:self.shape_ptr[k + 1]].tolist()]
+            expanded.append(b)
+        return expanded
+
+    def path_speeds(self, path):
+        """
+        Returns a float64 array with the speed of every piece of expand_path(path).
+
+        Parameters: (self, path)
+            path - list of nodes
+        """
+        ids = self.ids
+        edges = [self.edge(ids[a], ids[b]) for a, b in zip(path, path[1:])]
+        if self.shape_ptr is None:
+            return np.asarray(self.speed, dtype=np.float64)[edges]
+        pieces = [self.segment_speed[self.shape_ptr[k] + k:self.shape_ptr[k + 1] + k + 1] for k in edges]
+        return np.concatenate(pieces).astype(np.float64) if pieces else np.empty(0)
+
+    def astar_path(self, source, target, heuristic=None, depart=None):
+        """
+        Returns (cost, path) from source to target with path being a list of nodes.
+
+        Parameters: (self, source, target, heuristic, depart)
+            source - (lat, lon)
+            target - (lat, lon)
+            heuristic - callable
+            depart - datetime or seconds after midnight, None for the static weights
+        """
+        if source not in self.ids:
+            raise nx.NodeNotFound(f"Source {source} is not in G")
+        if target not in self.ids:
+            raise nx.NodeNotFound(f"Target {target} is not in G")
+        cost, path = self.astar(self.ids[source], self.ids[target], heuristic, depart)
+        return cost, [self.nodes[i] for i in path]
+
+
+def label_components(csr):
+    """
+    Returns an int32 array (N) with the connected component of every node of csr, components numbered by
+    decreasing size (ties by first node). Every round hooks the root of every edge end onto the smaller root
+    and then follows the pointers to the roots, so it only takes a few passes over the edge arrays.
+
+    Parameters: (csr)
+        csr - CSRGraph()
+    """
+    n = len(csr)
+    tails, heads = csr.tails(), np.asarray(csr.indices, dtype=np.int64)
+    root = np.arange(n)
+    while True:
+        a, b = root[tails], root[heads]
+        low = np.minimum(a, b)
+        hooked = root.copy()
+        np.minimum.at(hooked, a, low)
+        np.minimum.at(hooked, b, low)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, root):
+            break
+        root = hooked
+    _, first, inverse, size = np.unique(root, return_index=True, return_inverse=True, return_counts=True)
+    order = np.lexsort((first, -size))
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order))
+    return rank[inverse.reshape(-1)]
+
+
+def seconds_of_day(depart):
+    """
+    Returns the seconds after midnight of depart.
+
+    Parameters: (depart)
+        depart - datetime or seconds after midnight
+    """
+    if hasattr(depart, "hour"):
+        return depart.hour * 3600 + depart.minute * 60 + depart.second
+    return float(depart) % 86400
+
+
+def save_graph(csr, path="graph"):
+    """
+    Saves csr in the binary graph format: a directory with header.json and one .npy file per array so the
+    graph can be opened with load_graph without unpickling anything. The connected components are labelled
+    first so they are stored with the graph.
+
+    Parameters: (csr, path)
+        csr - CSRGraph()
+        path - string
+    """
+    os.makedirs(path, exist_ok=True)
+    csr.components()
+    arrays = {}
+    for name in GRAPH_ARRAYS + OPTIONAL_ARRAYS:
+        if getattr(csr, name) is None:
+            continue
+        array = np.ascontiguousarray(getattr(csr, name))
+        np.save(os.path.join(path, name + ".npy"), array)
+        arrays[name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+    header = {"version": GRAPH_VERSION, "nodes": len(csr), "edges": len(csr.indices), "arrays": arrays}
+    with open(os.path.join(path, "header.json"), "w") as out:
+        json.dump(header, out, indent=1)
+
+
+def load_graph(path="graph", mmap=True):
+    """
+    Opens a graph saved by save_graph. The arrays are memory mapped read only, so opening is fast and processes
+    reading the same graph share one copy in the page cache. Optional arrays (volume) are None when missing.
+    Raises ValueError if the format version or the
+    arrays don't match the header and OSError if it's missing.
+
+    Parameters: (path, mmap)
+        path - string
+        mmap - bool
+    """
+    with open(os.path.join(path, "header.json")) as header_file:
+        header = json.load(header_file)
+    if header.get("version") != GRAPH_VERSION:
+        raise ValueError(f"Graph format version {header.get('version')} in {path}, expected {GRAPH_VERSION}")
+    arrays = {}
+    for name in GRAPH_ARRAYS + OPTIONAL_ARRAYS:
+        if name not in header["arrays"]:
+            continue
+        array = np.load(os.path.join(path, name + ".npy"), mmap_mode="r" if mmap else None)
+        spec = header["arrays"][name]
+        if array.dtype.str != spec["dtype"] or list(array.shape) != spec["shape"]:
+            raise ValueError(f"{name}.npy in {path} doesn't match its header")
+        arrays[name] = array
+    return CSRGraph(**arrays)
+
+
+def save_volume(csr, volume, path="graph"):
+    """
+    Adds the hourly traffic volumes to csr and to the graph saved in path without rewriting the other arrays.
+
+    Parameters: (csr, volume, path)
+        csr - CSRGraph()
+        volume - float array (2E, 24)
+        path - string
+    """
+    volume = np.ascontiguousarray(volume, dtype=np.float32)
+    np.save(os.path.join(path, "volume.npy"), volume)
+    with open(os.path.join(path, "header.json")) as header_file:
+        header = json.load(header_file)
+    header["arrays"]["volume"] = {"dtype": volume.dtype.str, "shape": list(volume.shape)}
+    with open(os.path.join(path, "header.json"), "w") as out:
+        json.dump(header, out, indent=1)
+    csr.volume = volume
+    csr._hourly = None
+    csr._hour_lists = {}
+
+
+def convert_pickle(pickle_path="graph.pkl", path="graph"):
+    """
+    Converts a networkx graph pickled by older versions of astar.pickle_graph to the binary format.
+    Returns the CSRGraph.
+
+    Parameters: (pickle_path, path)
+        pickle_path - string
+        path - string
+    """
+    with open(pickle_path, 'rb') as graph_file:
+        G = pickle.load(graph_file)
+    save_graph(CSRGraph.from_networkx(G), path)
+    return load_graph(path)
+
+
+if __name__ == "__main__":
+    convert_pickle()
@@ -0,0 +1,201 @@
+from heapq import heappush, heappop
+from itertools import count
+from datetime import timedelta
+import math
+import instrument
+from live_traffic import apply_updates, refresh
+
+# Event kinds, in the order they are handled when they share a timestamp (same order as the old tick loop)
+ARRIVAL = 0
+DISPATCH = 1
+MOVE = 2
+UPDATE = 3
+
+
+class EventSimulation():
+    """
+    Discrete event core of the simulation. Only the seconds where something happens are visited: request
+    arrivals, batch dispatches, the 5 second movement ticks while at least one vehicle is on a trip and the
+    batches of a live traffic feed. Without a feed it produces the same assignments as stepping through every
+    second.
+
+    ===Attributes===
+    scheduling: Scheduling() that owns the fleet
+    trips: iterable of Request() sorted by pickup time (a list or TripStore.iter_between), read lazily
+    start: datetime the simulation starts at
+    end: datetime the simulation stops at
+    heuristic: callable used for routing
+    step: seconds the vehicles move per movement tick
+    offset: seconds after start of the first movement tick
+    feed: iterable of (datetime, observations) sorted by time applied with live_traffic.apply_updates, or None
+    refresh: feed batches applied between two rebuilds of the landmarks they made stale (live_traffic.refresh),
+             0 to never rebuild them
+    refresh_ch: feed batches applied between two rebuilds of the contraction hierarchy, 0 to never rebuild it.
+                Building a hierarchy takes minutes on the city, A* answers the queries while it's dropped
+    updates: number of feed batches applied
+    rejected: number of trips that weren't assigned
+    dropoffs: list of (datetime, vehicle ID) for every completed trip
+    events: number of events handled
+    """
+    scheduling: object
+    trips: object
+    start: object
+    end: object
+    heuristic: object
+    step: int
+    offset: int
+    feed: object
+    refresh: int
+    refresh_ch: int
+    updates: int
+    rejected: int
+    dropoffs: list
+    events: int
+
+    def __init__(self, scheduling, trips, start, end, heuristic, step=5, offset=3, feed=None,
+                 refresh=0, refresh_ch=0):
+        self.scheduling = scheduling
+        self.trips = trips
+        self.start = start
+        self.end = end
+        self.heuristic = heuristic
+        self.step = step
+        self.offset = offset
+        self.feed = feed
+        self.refresh = refresh
+        self.refresh_ch = refresh_ch
+        self.updates = 0
+        self.rejected = 0
+        self.dropoffs = []
+        self.events = 0
+        self._queue = []
+        self._counter = count()
+        self._next_move = None
+        self._next_dispatch = None
+        self._arrivals = None
+        self._updates = None
+
+    def push(self, time, kind, payload=None):
+        """
+        Schedules an event.
+
+        Parameters: (self, time, kind, payload)
+            time - datetime
+            kind - ARRIVAL, DISPATCH, MOVE or UPDATE
+            payload - object
+        """
+        heappush(self._queue, (time, kind, next(self._counter), payload))
+
+    def _push_arrival(self):
+        """
+        Schedules the next trip request. Only one arrival is queued at a time so the trips are never all in
+        memory. Trips are sorted, so the first one at or after end stops the arrivals.
+        """
+        trip = next(self._arrivals, None)
+        if trip is not None and trip.pickup_time < self.end:
+            self.push(trip.pickup_time, ARRIVAL, trip)
+
+    def _push_update(self):
+        """
+        Schedules the next batch of the feed, like the arrivals only one is queued at a time.
+        """
+        update = next(self._updates, None)
+        if update is not None and update[0] < self.end:
+            self.push(max(update[0], self.start), UPDATE, update[1])
+
+    def _second(self, time):
+        """
+        Returns the first whole second of simulation time at or after time.
+        """
+        seconds = math.ceil((time - self.start).total_seconds())
+        return self.start + timedelta(seconds=max(seconds, 0))
+
+    def _schedule_move(self, time):
+        """
+        Schedules the first movement tick at or after time if none is pending.
+        """
+        if self._next_move is not None:
+            return
+        elapsed = (time - self.start).total_seconds()
+        ticks = max(math.ceil((elapsed - self.offset) / self.step), 0)
+        tick = self.start + timedelta(seconds=self.offset + ticks * self.step)
+        if tick < self.end:
+            self._next_move = tick
+            self.push(tick, MOVE)
+
+    def run(self):
+        """
+        Runs the simulation. Returns the number of rejected trips.
+        """
+        self._arrivals = iter(self.trips)
+        self._push_arrival()
+        if self.feed is not None:
+            self._updates = iter(self.feed)
+            self._push_update()
+
+        while self._queue:
+            time, kind, _, payload = heappop(self._queue)
+            self.events += 1
+            instrument.tick(time)
+            if kind == ARRIVAL:
+                self._push_arrival()
+                self._arrival(time, payload)
+            elif kind == DISPATCH:
+                self._next_dispatch = None
+                self.rejected += self.scheduling.dispatch_batch(self.heuristic)[1]
+            elif kind == MOVE:
+                self._next_move = None
+                self._move(time)
+            elif kind == UPDATE:
+                self._push_update()
+                self._update(payload)
+            if self.scheduling.busy():
+                self._schedule_move(time)
+
+        if self.scheduling.pending:
+            self.rejected += self.scheduling.dispatch_batch(self.heuristic)[1]
+        instrument.flush()
+        return self.rejected
+
+    def _arrival(self, time, trip):
+        """
+        Handles a trip request. Trips before the start or between two whole seconds are missed like in
+        the tick loop.
+        """
+        if time < self.start or self._second(time) != time:
+            self.rejected += 1
+            instrument.count("trips.missed")
+            return
+        if self.scheduling.batch_window is None:
+            if not self.scheduling.find_assign_trip(trip, self.heuristic):
+                self.rejected += 1
+            return
+        self.scheduling.add_request(trip)
+        if self._next_dispatch is None:
+            due = self._second(self.scheduling.pending[0].pickup_time + timedelta(seconds=self.scheduling.batch_window))
+            if due < self.end:
+                self._next_dispatch = due
+                self.push(due, DISPATCH)
+
+    def _update(self, observations):
+        """
+        Applies a batch of the feed to the graph. Every refresh batches the landmarks the updates made stale are
+        rebuilt so routing keeps its heuristic, every refresh_ch batches the contraction hierarchy too.
+        """
+        G = self.scheduling.graph
+        apply_updates(G, observations, G.graph.get("names"))
+        self.updates += 1
+        alt = bool(self.refresh) and self.updates % self.refresh == 0
+        ch = bool(self.refresh_ch) and self.updates % self.refresh_ch == 0
+        if (alt or ch) and G.graph.get("stale"):
+            with instrument.timer("live.refresh"):
+                refresh(G, alt=alt, ch=ch)
+
+    def _move(self, time):
+        """
+        Moves the fleet one tick and records the trips completed during it.
+        """
+        for v in self.scheduling.move(self.step):
+            self.dropoffs.append((time, v.id))
+        if self.scheduling.busy():
+            self._schedule_move(time + timedelta(seconds=self.step))
@@ -0,0 +1,231 @@
+from datetime import timedelta
+import numpy as np
+from astar import haversine
+from spatial_index import FleetGrid
+import instrument
+
+
+class Fleet():
+    """
+    Struct of arrays holding the state of every vehicle so the whole fleet moves in vectorized steps.
+    Vehicles added to the fleet read and write their position and availability from its rows.
+
+    ===Attributes===
+    vehicles: list of Vehicle(), vehicles[row]
+    position: float64 array (N, 2), (lat, lon) of every vehicle
+    available: bool array (N)
+    edge: int64 array (N), index in the route of the node the vehicle last passed, -1 if it has no route
+    target: float64 array (N, 2), next node of the route
+    speed: float64 array (N), speed in m/s on the current edge
+    progress: float64 array (N), fraction of the current edge already travelled
+    routes: list of float64 arrays (K, 2), nodes of the route of every vehicle
+    speeds: list of float64 arrays (K - 1), edge speeds of the route of every vehicle
+    grid: FleetGrid() of the available vehicles, kept up to date as they move and change availability
+    active: number of vehicles on a route (edge >= 0), kept up to date by load_route and move
+    """
+    vehicles: list
+    position: np.ndarray
+    available: np.ndarray
+    edge: np.ndarray
+    target: np.ndarray
+    speed: np.ndarray
+    progress: np.ndarray
+    routes: list
+    speeds: list
+    grid: FleetGrid
+    active: int
+
+    def __init__(self, capacity=16):
+        self.vehicles = []
+        self.position = np.zeros((capacity, 2))
+        self.available = np.zeros(capacity, dtype=bool)
+        self.edge = np.full(capacity, -1, dtype=np.int64)
+        self.target = np.zeros((capacity, 2))
+        self.speed = np.zeros(capacity)
+        self.progress = np.zeros(capacity)
+        self._length = np.zeros(capacity)
+        self.routes = []
+        self.speeds = []
+        self.grid = FleetGrid()
+        self.active = 0
+
+    def __len__(self):
+        return len(self.vehicles)
+
+    def _grow(self):
+        """
+        Doubles the capacity of every array.
+        """
+        for name in ("position", "available", "edge", "target", "speed", "progress", "_length"):
+            old = getattr(self, name)
+            new = np.zeros((len(old) * 2,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.edge[len(self.vehicles):] = -1
+
+    def add(self, vehicle):
+        """
+        Moves the state of vehicle into a new row of the fleet.
+
+        Parameters: (self, vehicle)
+            vehicle - Vehicle()
+        """
+        if len(self.vehicles) == len(self.position):
+            self._grow()
+        row = len(self.vehicles)
+        position, available = vehicle.position, vehicle.available
+        self.vehicles.append(vehicle)
+        self.routes.append(None)
+        self.speeds.append(None)
+        vehicle.fleet = self
+        vehicle.row = row
+        vehicle.position = position
+        vehicle.available = available
+
+    def set_position(self, row, position):
+        """
+        Sets the position of the vehicle in row.
+
+        Parameters: (self, row, position)
+            row - int
+            position - (lat, lon)
+        """
+        self.position[row] = position
+        if row in self.grid:
+            self.grid.insert(row, self.position[row].tolist())
+
+    def set_available(self, row, available):
+        """
+        Sets the availability of the vehicle in row and adds it to or removes it from the grid.
+
+        Parameters: (self, row, available)
+            row - int
+            available - bool
+        """
+        self.available[row] = available
+        if available:
+            self.grid.insert(row, self.position[row].tolist())
+        else:
+            self.grid.remove(row)
+
+    def within(self, point, radius):
+        """
+        Returns the rows of the available vehicles less than radius metres (astar.haversine) from point,
+        in row order. Only the grid cells around point are looked at.
+
+        Parameters: (self, point, radius)
+            point - (lat, lon)
+            radius - float (metres)
+        """
+        rows = np.array(sorted(self.grid.candidates(point, radius)), dtype=np.int64)
+        if not len(rows):
+            return rows
+        return rows[haversine(self.position[rows], point) < radius]
+
+    def load_route(self, row, path, G):
+        """
+        Starts the vehicle in row on path. Like Vehicle.move, it heads straight for the second node.
+        On a simplified graph the route follows the shape points of the edges.
+
+        Parameters: (self, row, path, G)
+            row - int
+            path - list of nodes
+            G - networkx.graph()
+        """
+        csr = G.graph.get("csr")
+        if csr is not None:
+            self.speeds[row] = csr.path_speeds(path)
+            path = csr.expand_path(path)
+        else:
+            self.speeds[row] = np.array([G[path[i]][path[i + 1]]["speed"] for i in range(len(path) - 1)])
+        self.routes[row] = np.array(path, dtype=np.float64).reshape(-1, 2)
+        if self.edge[row] < 0:
+            self.active += 1
+        self.edge[row] = 0
+        self.progress[row] = 0
+        if len(path) > 1:
+            self.target[row] = self.routes[row][1]
+            self.speed[row] = self.speeds[row][0]
+            self._length[row] = haversine(self.position[row:row + 1], self.target[row:row + 1])[0]
+        else:
+            self.target[row] = self.position[row]
+
+    def _next_edge(self, rows):
+        """
+        Moves rows that reached their target onto the next edge of their route. Returns the rows whose
+        route is finished.
+        """
+        finished = []
+        for row in rows.tolist():
+            self.edge[row] += 1
+            route = self.routes[row]
+            if self.edge[row] + 1 >= len(route):
+                finished.append(row)
+                continue
+            self.target[row] = route[self.edge[row] + 1]
+            self.speed[row] = self.speeds[row][self.edge[row]]
+        rows = rows[~np.isin(rows, finished)]
+        self._length[rows] = haversine(self.position[rows], self.target[rows])
+        self.progress[rows] = 0
+        return finished
+
+    def move(self, G, s=1, rows=None):
+        """
+        Moves every vehicle on a route (or only rows) s seconds. Vehicles cross as many full edges as they
+        can and then travel part of the next one. Completes the trips of the vehicles that reach the end
+        of their route and returns their vehicles.
+
+        Parameters: (self, G, s, rows)
+            G - networkx.graph()
+            s - float
+            rows - list of int
+        """
+        n = len(self.vehicles)
+        if rows is None:
+            rows = np.flatnonzero(self.edge[:n] >= 0)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            rows = rows[self.edge[rows] >= 0]
+        moved = rows
+        instrument.count("move.vehicles", len(rows))
+        for row in rows.tolist():
+            trips = self.vehicles[row].trips
+            if trips and trips[0]["end_time"] is not None:
+                trips[0]["end_time"] += timedelta(seconds=s)
+
+        # Routes with less than two nodes are already finished
+        short = np.array([len(self.routes[r]) < 2 for r in rows.tolist()], dtype=bool)
+        finished = rows[short].tolist()
+        rows = rows[~short]
+        remaining = np.full(len(rows), float(s))
+        while len(rows):
+            left = haversine(self.position[rows], self.target[rows]) / self.speed[rows]
+            arrive = remaining >= left
+            # Travel part of the edge
+            part = rows[~arrive]
+            if len(part):
+                frac = remaining[~arrive] / left[~arrive]
+                self.position[part] += frac[:, np.newaxis] * (self.target[part] - self.position[part])
+                length = np.maximum(self._length[part], 1e-12)
+                self.progress[part] = 1 - haversine(self.position[part], self.target[part]) / length
+            # Go as far from node to node as possible with only full edges
+            rows = rows[arrive]
+            remaining = remaining[arrive] - left[arrive]
+            self.position[rows] = self.target[rows]
+            done = self._next_edge(rows)
+            finished += done
+            keep = ~np.isin(rows, done)
+            rows, remaining = rows[keep], remaining[keep]
+        self.grid.update(moved, self.position[moved])
+
+        completed = []
+        for row in finished:
+            self.edge[row] = -1
+            self.active -= 1
+            self.routes[row] = self.speeds[row] = None
+            vehicle = self.vehicles[row]
+            vehicle.complete_trip()
+            if vehicle.trips:
+                self.load_route(row, vehicle.trips[0]["path"], G)
+            completed.append(vehicle)
+        return completed
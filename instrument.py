@@ -0,0 +1,241 @@
+import cProfile
+import csv
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import nullcontext
+from functools import wraps
+
+# Counters and timers for the hot paths of the simulation. Everything is off by default and every hook returns
+# after one flag check, so they can stay in the code. Turn it on with the CELER_PROFILE environment variable
+# (1 or counters, cprofile, tracemalloc) or enable(). EventSimulation calls tick with the simulation time so
+# the counts are kept per simulated hour, dump writes them as JSON or CSV.
+
+MODES = ("counters", "cprofile", "tracemalloc")
+
+ENABLED = False
+MODE = None
+
+_counters = {}
+_timers = {}
+_totals = {}
+_rows = []
+_hour = None
+_profiler = None
+_NULL = nullcontext()
+
+
+def enable(mode="counters"):
+    """
+    Turns the instrumentation on. counters only counts and times, cprofile also profiles every simulated hour
+    and tracemalloc also records the memory in use and its peak every simulated hour.
+
+    Parameters: (mode)
+        mode - one of MODES
+    """
+    global ENABLED, MODE, _profiler
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode {mode}")
+    disable()
+    reset()
+    ENABLED, MODE = True, mode
+    if mode == "cprofile":
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif mode == "tracemalloc":
+        tracemalloc.start()
+
+
+def disable():
+    """
+    Turns the instrumentation off. Collected counts are kept until reset.
+    """
+    global ENABLED, MODE, _profiler
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler = None
+    if MODE == "tracemalloc" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    ENABLED, MODE = False, None
+
+
+def reset():
+    """
+    Forgets every count, timing and hour.
+    """
+    global _hour
+    _counters.clear()
+    _timers.clear()
+    _totals.clear()
+    _rows.clear()
+    _hour = None
+
+
+def count(name, n=1):
+    """
+    Adds n to the counter name.
+
+    Parameters: (name, n)
+        name - string
+        n - int
+    """
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def _add_time(name, seconds):
+    timing = _timers.get(name)
+    if timing is None:
+        timing = _timers[name] = [0, 0.0]
+    timing[0] += 1
+    timing[1] += seconds
+
+
+class _Timer():
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timer(name):
+    """
+    Returns a context manager that adds one call and its duration to the timer name.
+
+    Parameters: (name)
+        name - string
+    """
+    return _Timer(name) if ENABLED else _NULL
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function with the timer name.
+
+    Parameters: (name)
+        name - string
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                _add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _values():
+    """
+    Returns the counters and timers collected since the last hour as a flat dict.
+    """
+    values = dict(_counters)
+    for name, (calls, seconds) in _timers.items():
+        values[name + ".calls"] = calls
+        values[name + ".seconds"] = seconds
+    return values
+
+
+def _close():
+    """
+    Stores the row of the current hour and starts a new one.
+    """
+    global _profiler
+    values = _values()
+    for name, value in values.items():
+        _totals[name] = _totals.get(name, 0) + value
+    row = {"hour": _hour.isoformat() if _hour is not None else None}
+    row.update(values)
+    if _profiler is not None:
+        _profiler.disable()
+        stats = pstats.Stats(_profiler)
+        top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:15]
+        row["profile"] = [{"function": f"{f}:{line}({function})", "calls": calls, "tottime": tottime,
+                           "cumtime": cumtime} for (f, line, function), (_, calls, tottime, cumtime, _) in top]
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if MODE == "tracemalloc":
+        current, peak = tracemalloc.get_traced_memory()
+        row["memory_kib"], row["peak_kib"] = current / 1024, peak / 1024
+        tracemalloc.reset_peak()
+    _rows.append(row)
+    _counters.clear()
+    _timers.clear()
+
+
+def tick(now):
+    """
+    Tells the instrumentation the simulation time. Counts are closed into a row every time the hour changes.
+
+    Parameters: (now)
+        now - datetime
+    """
+    global _hour
+    if not ENABLED:
+        return
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    if _hour is None:
+        _hour = hour
+    elif hour != _hour:
+        _close()
+        _hour = hour
+
+
+def flush():
+    """
+    Closes the current hour if anything was counted in it.
+    """
+    if ENABLED and (_counters or _timers):
+        _close()
+
+
+def report():
+    """
+    Returns {"mode", "hours": list of per hour rows, "total": counters and timers summed over every hour}.
+    """
+    totals = dict(_totals)
+    for name, value in _values().items():
+        totals[name] = totals.get(name, 0) + value
+    return {"mode": MODE, "hours": list(_rows), "total": totals}
+
+
+def dump(path="profile.json"):
+    """
+    Writes the report in path. A .csv path gets one line per hour with a column per counter and timer
+    (profiles are only in the JSON report).
+
+    Parameters: (path)
+        path - string
+    """
+    flush()
+    data = report()
+    if path.endswith(".csv"):
+        columns = ["hour"]
+        for row in data["hours"]:
+            columns += [key for key in row if key not in columns and key != "profile"]
+        with open(path, "w", newline="") as out:
+            writer = csv.DictWriter(out, columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(data["hours"])
+    else:
+        with open(path, "w") as out:
+            json.dump(data, out, indent=2, default=str)
+
+
+_env = os.environ.get("CELER_PROFILE", "")
+if _env and _env != "0":
+    enable(_env if _env in MODES else "counters")
@@ -0,0 +1,300 @@
+from heapq import heappush, heappop
+import hashlib
+import random
+import statistics
+import networkx as nx
+import numpy as np
+from ch import checksum as graph_checksum
+
+
+class Landmarks():
+    """
+    ALT (A*, landmarks, triangle inequality) heuristic. For every landmark L the distance from L to every node
+    is stored, and |d(L, t) - d(L, v)| is a lower bound on the cost from v to t. The road graph is undirected,
+    so the distances from and to a landmark are the same array.
+    The object is a heuristic: it can be passed anywhere a heuristic callable is (find_path, process_trips,
+    Vehicle.assign_trip, Scheduling.find_assign_trip...) and evaluates the whole graph at once in A* with array.
+
+    ===Attributes===
+    csr: CSRGraph() the distances were computed on
+    landmarks: int64 array (K), ids of the landmarks
+    dist: float64 array (K, N), dist[k, v] is the cost between landmark k and v, inf if unreachable
+    stale: True once an edge weight went below the weights dist was computed on, the bounds are 0 until rebuilt
+    """
+    csr: object
+    landmarks: np.ndarray
+    dist: np.ndarray
+    stale: bool
+
+    def __init__(self, csr, landmarks, dist):
+        self.csr = csr
+        self.landmarks = np.asarray(landmarks, dtype=np.int64)
+        self.dist = np.asarray(dist, dtype=np.float64)
+        self.stale = False
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def _column(self, node):
+        """
+        Returns the landmark distances of node, None if it isn't a node of the graph.
+        """
+        column = self._columns.get(node)
+        if column is None:
+            i = self.csr.ids.get((float(node[0]), float(node[1])))
+            if i is None:
+                return None
+            column = self._columns[node] = self.dist[:, i]
+        return column
+
+    def __call__(self, p1, p2):
+        """
+        Returns a lower bound on the cost of the shortest path from p1 to p2.
+
+        Parameters: (p1, p2)
+            p1 - (lat, lon)
+            p2 - (lat, lon)
+        """
+        if self.stale:
+            return 0
+        a, b = self._column(p1), self._column(p2)
+        if a is None or b is None:
+            return 0
+        bound = 0
+        for x, y in zip(a.tolist(), b.tolist()):
+            # A landmark that can't reach one of the nodes gives no information
+            if x != float("inf") and y != float("inf") and abs(x - y) > bound:
+                bound = abs(x - y)
+        return bound
+
+    def array(self, coords, p2):
+        """
+        Returns the lower bound from every row of coords to p2. coords must be the coordinates of the graph
+        nodes in id order (CSRGraph.coords), other points are evaluated one by one.
+
+        Parameters: (coords, p2)
+            coords - float array (N, 2) of (lat, lon)
+            p2 - (lat, lon)
+        """
+        if self.stale:
+            return np.zeros(len(coords))
+        goal = self._column(p2)
+        if coords is not self.csr.coords and not np.array_equal(coords, self.csr.coords):
+            return np.array([self(tuple(c), p2) for c in np.asarray(coords).tolist()], dtype=np.float64)
+        if goal is None:
+            return np.zeros(len(coords))
+        with np.errstate(invalid="ignore"):
+            diff = np.abs(self.dist - goal[:, np.newaxis])
+        diff[~np.isfinite(diff)] = 0
+        return diff.max(axis=0) if len(diff) else np.zeros(len(coords))
+
+    def save(self, path="landmarks.npz"):
+        """
+        Saves the landmarks in a npz file.
+
+        Parameters: (self, path)
+            path - string
+        """
+        np.savez(path, landmarks=self.landmarks, dist=self.dist, checksum=checksum(self.csr))
+
+
+def checksum(csr):
+    """
+    Returns a fingerprint (SHA-1) of the weights the landmark distances depend on: the edges and static weights
+    like ch.checksum, and the speeds and volumes the hourly weights are computed from.
+
+    Parameters: (csr)
+        csr - CSRGraph()
+    """
+    digest = hashlib.sha1(str(graph_checksum(csr)).encode())
+    digest.update(np.ascontiguousarray(csr.speed, dtype=np.float64).tobytes())
+    if csr.volume is not None:
+        digest.update(np.ascontiguousarray(csr.volume, dtype=np.float64).tobytes())
+    return np.array(digest.hexdigest())
+
+
+def lower_weights(csr):
+    """
+    Returns a list with the smallest weight every edge can have: the static weight, or the lowest hourly weight
+    if it's smaller, so the landmark bounds are admissible for time dependent queries too.
+
+    Parameters: (csr)
+        csr - CSRGraph()
+    """
+    weights = np.asarray(csr.weight, dtype=np.float64)
+    if csr.volume is not None:
+        weights = np.minimum(weights, csr.hourly_weights().min(axis=0))
+    return weights.tolist()
+
+
+def shortest_tree(csr, source, weights):
+    """
+    Runs a full Dijkstra from source. Returns (dist, parent, order): a float64 array of costs (inf when
+    unreachable), an int64 array of parents (-1 for source and unreachable nodes) and the ids in settled order.
+
+    Parameters: (csr, source, weights)
+        csr - CSRGraph()
+        source - int
+        weights - list of edge weights
+    """
+    indptr = csr._indptr
+    indices = csr._indices
+    dist = [float("inf")] * len(csr)
+    parent = [-1] * len(csr)
+    done = [False] * len(csr)
+    order = []
+    dist[source] = 0
+    queue = [(0, source)]
+    while queue:
+        d, u = heappop(queue)
+        if done[u]:
+            continue
+        done[u] = True
+        order.append(u)
+        a, b = indptr[u], indptr[u + 1]
+        for v, w in zip(indices[a:b], weights[a:b]):
+            nd = d + w
+            if nd < dist[v]:
+                dist[v] = nd
+                parent[v] = u
+                heappush(queue, (nd, v))
+    return np.array(dist), np.array(parent, dtype=np.int64), order
+
+
+def _farthest(closest):
+    """
+    Returns the reachable id farthest from the landmarks chosen so far.
+    """
+    finite = np.where(np.isfinite(closest), closest, -1)
+    return int(np.argmax(finite))
+
+
+def _avoid(csr, weights, dist, chosen, rng):
+    """
+    Returns the next landmark of the avoid strategy: grow a shortest path tree from a random root, weigh every
+    node by how much the current landmarks underestimate its cost from the root, and walk down to the leaf of
+    the heaviest subtree that doesn't contain a landmark yet.
+    """
+    root = rng.randrange(len(csr))
+    tree, parent, order = shortest_tree(csr, root, weights)
+    if len(chosen):
+        d = np.array(dist[:len(chosen)])
+        with np.errstate(invalid="ignore"):
+            diff = np.abs(d[:, root][:, np.newaxis] - d)
+        diff[~np.isfinite(diff)] = 0
+        bound = diff.max(axis=0)
+    else:
+        bound = np.zeros(len(csr))
+    size = np.where(np.isfinite(tree), tree - bound, 0)
+    blocked = np.zeros(len(csr), dtype=bool)
+    blocked[chosen] = True
+    # Sizes of the subtrees, children are settled after their parents
+    for v in reversed(order):
+        p = parent[v]
+        if p < 0:
+            continue
+        if blocked[v]:
+            blocked[p] = True
+        else:
+            size[p] += size[v]
+    size[blocked] = 0
+    children = {}
+    for v in order:
+        if parent[v] >= 0:
+            children.setdefault(int(parent[v]), []).append(v)
+    node = root
+    while children.get(node):
+        best = max(children[node], key=lambda c: size[c])
+        if size[best] <= 0:
+            break
+        node = best
+    return node
+
+
+def build_landmarks(csr, k=16, strategy="farthest", path="landmarks.npz", seed=0):
+    """
+    Selects k landmarks, computes their distances to every node and saves them in path.
+
+    Parameters: (csr, k, strategy, path, seed)
+        csr - CSRGraph()
+        k - int
+        strategy - "farthest" (each landmark is the node farthest from the previous ones) or "avoid"
+        path - string, None to not save
+        seed - int
+    """
+    if strategy not in ("farthest", "avoid"):
+        raise ValueError(f"Unknown landmark strategy {strategy}")
+    rng = random.Random(seed)
+    weights = lower_weights(csr)
+    k = min(k, len(csr))
+    chosen = []
+    dist = []
+    # The first landmark is the node farthest from a random start
+    closest = shortest_tree(csr, rng.randrange(len(csr)), weights)[0]
+    while len(chosen) < k:
+        if strategy == "farthest" or not chosen:
+            node = _farthest(closest)
+        else:
+            node = _avoid(csr, weights, dist, chosen, rng)
+        if node in chosen:
+            break
+        chosen.append(node)
+        dist.append(shortest_tree(csr, node, weights)[0])
+        closest = dist[-1] if len(chosen) == 1 else np.minimum(closest, dist[-1])
+    landmarks = Landmarks(csr, chosen, np.array(dist).reshape(len(chosen), len(csr)))
+    if path is not None:
+        landmarks.save(path)
+    return landmarks
+
+
+def load_landmarks(csr, path="landmarks.npz"):
+    """
+    Returns the landmarks saved in path for csr, None if they are missing or were computed for other weights.
+
+    Parameters: (csr, path)
+        csr - CSRGraph()
+        path - string
+    """
+    try:
+        data = np.load(path)
+    except OSError:
+        return None
+    if not np.array_equal(data["checksum"], checksum(csr)):
+        return None
+    return Landmarks(csr, data["landmarks"], data["dist"])
+
+
+def compare(csr, heuristics, pairs=100, seed=0):
+    """
+    Routes random node pairs with every heuristic and returns {name: (mean settled, median settled,
+    number of pairs whose cost differs from Dijkstra)}.
+
+    Parameters: (csr, heuristics, pairs, seed)
+        csr - CSRGraph()
+        heuristics - dict mapping a name to a heuristic
+        pairs - int
+        seed - int
+    """
+    rng = random.Random(seed)
+    queries = [(rng.randrange(len(csr)), rng.randrange(len(csr))) for _ in range(pairs)]
+    expected = []
+    for s, t in queries:
+        try:
+            expected.append(csr.astar(s, t)[0])
+        except nx.NetworkXNoPath:
+            expected.append(None)
+    report = {}
+    for name, heuristic in heuristics.items():
+        settled = []
+        wrong = 0
+        for (s, t), cost in zip(queries, expected):
+            try:
+                result = csr.astar(s, t, heuristic)[0]
+            except nx.NetworkXNoPath:
+                result = None
+            settled.append(csr.settled)
+            if result != cost and (result is None or cost is None or abs(result - cost) > 1e-9 * max(cost, 1)):
+                wrong += 1
+        report[name] = (statistics.mean(settled), statistics.median(settled), wrong)
+    return report
@@ -0,0 +1,317 @@
+from datetime import timedelta
+import fiona
+import numpy as np
+import traffic
+import instrument
+from astar import weight, reweight, haversine
+
+# Incremental edge weight updates from live traffic observations. An observation is a tuple
+# (key, field, value, hour):
+#   key   - street name (any spelling, see street_names) or edge position in the CSRGraph arrays
+#   field - "volume" (vehicles per hour) or "speed" (speed limit in mph)
+#   value - number, or a sequence of 24 hourly volumes when hour is None
+#   hour  - hour of the day the volume is for, None for every hour (ignored for speeds)
+# apply_updates changes the weights of the affected edges in place and repairs what depends on them:
+# the route cache, the ALT landmarks and the contraction hierarchy.
+
+MAP = "NYC/Map/geo_export_24fdfadb-893d-40a0-a751-a76cdefc9bc6.shp"
+
+
+class StreetEdges():
+    """
+    The edges of every street of the map, so observations keyed by street name can be applied to the graph.
+
+    ===Attributes===
+    names: list of canonical street names
+    street: int32 array (2E), index in names of the street of every edge, -1 if unknown
+    order: int64 array (2E), edge positions sorted by street
+    starts: int64 array (S + 1), edges of street s are order[starts[s]:starts[s + 1]]
+    """
+    names: list
+    street: np.ndarray
+    order: np.ndarray
+    starts: np.ndarray
+
+    def __init__(self, names, street):
+        self.names = list(names)
+        self.street = np.asarray(street, dtype=np.int32)
+        self._rows = {name: s for s, name in enumerate(self.names)}
+        known = np.flatnonzero(self.street >= 0)
+        self.order = known[np.argsort(self.street[known], kind="stable")]
+        self.starts = np.zeros(len(self.names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.street[known], minlength=len(self.names)), out=self.starts[1:])
+
+    def __len__(self):
+        return len(self.names)
+
+    def edges(self, name):
+        """
+        Returns the int64 array of the edge positions of the street name (canonical), empty if it's unknown.
+
+        Parameters: (self, name)
+            name - string
+        """
+        s = self._rows.get(name)
+        if s is None:
+            return np.empty(0, dtype=np.int64)
+        return self.order[self.starts[s]:self.starts[s + 1]]
+
+    def save(self, path):
+        np.savez(path, names=np.array(self.names, dtype=str), street=self.street)
+
+
+def edge_positions(csr, tails, heads):
+    """
+    Returns the int64 array of the positions of the edges tails[i] -> heads[i], -1 for pairs that aren't edges.
+
+    Parameters: (csr, tails, heads)
+        csr - CSRGraph()
+        tails - int array
+        heads - int array
+    """
+    n = len(csr)
+    keys = csr.tails() * n + np.asarray(csr.indices, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    wanted = np.asarray(tails, dtype=np.int64) * n + np.asarray(heads, dtype=np.int64)
+    i = np.searchsorted(keys[order], wanted).clip(max=max(len(keys) - 1, 0))
+    found = keys[order][i] == wanted if len(keys) else np.zeros(len(wanted), dtype=bool)
+    return np.where(found, order[i], -1)
+
+
+def reverse_edges(csr):
+    """
+    Returns the int64 array with the position of v -> u for every edge u -> v.
+
+    Parameters: (csr)
+        csr - CSRGraph()
+    """
+    return edge_positions(csr, csr.indices, csr.tails())
+
+
+def build_street_edges(csr, names, map_path=MAP, path="graph/streets.npz"):
+    """
+    Reads the street of every segment from the map and saves which edges belong to which street in path.
+    The last feature joining two nodes wins, like the attributes of the graph.
+
+    Parameters: (csr, names, map_path, path)
+        csr - CSRGraph()
+        names - StreetNames()
+        map_path - string
+        path - string, None to not save
+    """
+    streets = {}
+    tails, heads, rows = [], [], []
+    ids = csr.ids
+    for feature in fiona.open(map_path):
+        line = feature["geometry"]["coordinates"]
+        s = streets.setdefault(names.normalize(feature["properties"]["st_label"]), len(streets))
+        nodes = [ids.get((c[1], c[0]), -1) for c in line]
+        for a, b in zip(nodes, nodes[1:]):
+            tails += [a, b]
+            heads += [b, a]
+            rows += [s, s]
+    street = np.full(len(csr.indices), -1, dtype=np.int32)
+    tails, heads, rows = np.array(tails, dtype=np.int64), np.array(heads, dtype=np.int64), np.array(rows)
+    known = (tails >= 0) & (heads >= 0)
+    positions = edge_positions(csr, tails[known], heads[known])
+    hit = positions >= 0
+    street[positions[hit]] = rows[known][hit]
+    edges = StreetEdges(list(streets), street)
+    if path is not None:
+        edges.save(path)
+    return edges
+
+
+def load_street_edges(csr, names, path="graph/streets.npz", map_path=MAP):
+    """
+    Returns the StreetEdges of csr saved in path, built from the map if they are missing or for another graph.
+
+    Parameters: (csr, names, path, map_path)
+        csr - CSRGraph()
+        names - StreetNames()
+        path - string
+        map_path - string
+    """
+    try:
+        data = np.load(path)
+        if len(data["street"]) == len(csr.indices):
+            return StreetEdges(data["names"].tolist(), data["street"])
+    except OSError:
+        pass
+    return build_street_edges(csr, names, map_path, path)
+
+
+def _writable(csr):
+    """
+    Replaces the memory mapped (read only) arrays that updates write to by copies in memory, once.
+    """
+    for name in ("weight", "speed", "volume"):
+        array = getattr(csr, name)
+        if array is not None and not array.flags.writeable:
+            setattr(csr, name, np.array(array))
+    if csr._hourly is not None and not csr._hourly.flags.writeable:
+        csr._hourly = np.array(csr._hourly)
+
+
+def _edge_weights(csr, edges):
+    """
+    Returns (static, hourly): the static weights (E) and the hourly weights (24, E) of edges computed from their
+    current speed and volume like astar.graph_chunk and CSRGraph.hourly_weights. hourly is None without volumes.
+    """
+    s, e = csr.coords[csr.tails()[edges]], csr.coords[np.asarray(csr.indices)[edges]]
+    limit = np.round(np.asarray(csr.speed)[edges] * 3600 / 1609, 6)
+    if csr.volume is None:
+        return weight(s, e, limit), None
+    volume = np.asarray(csr.volume, dtype=np.float64)[edges]
+    static = reweight(s, e, limit, np.asarray(csr.volume)[edges].mean(axis=1).astype(np.int64))
+    hourly = np.stack([reweight(s, e, limit, volume[:, h]) for h in range(24)])
+    return static, hourly
+
+
+def _lower(static, hourly):
+    return static if hourly is None else np.minimum(static, hourly.min(axis=0))
+
+
+def apply_updates(G, observations, names=None, streets=None):
+    """
+    Applies a batch of observations to the edge weights of G in place and returns a dict with the number of
+    edges changed, the new graph version, whether any weight (static or of any hour) went down and whether the
+    lowest weight of an edge over the day went down.
+    G.graph["version"] is bumped. When every weight only went up, the cached routes that don't use a changed
+    edge are kept, otherwise a cheaper route may exist for any pair and the route cache is emptied. The landmark
+    bounds are computed on the lowest weight of every edge, so they stay lower bounds unless that went down,
+    in which case the landmarks are marked stale (they bound by 0, so heuristics already handed out stay
+    admissible) until refresh is called. The contraction hierarchy is dropped on any change since its shortcuts were chosen by witness
+    searches on the old weights, queries fall back to A* until refresh.
+
+    Parameters: (G, observations, names, streets)
+        G - CSRGraph() loaded with astar.load_data
+        observations - iterable of (key, field, value, hour), see the top of this module
+        names - StreetNames(), to key observations by street name
+        streets - StreetEdges(), default G.graph["streets"]
+    """
+    csr = G.graph["csr"]
+    if csr.shape_ptr is not None:
+        raise ValueError("Live updates need the full graph, the weights of simplified edges are sums of chains")
+    streets = streets if streets is not None else G.graph.get("streets")
+    reverse = G.graph.get("reverse_edges")
+    if reverse is None:
+        reverse = G.graph["reverse_edges"] = reverse_edges(csr)
+    _writable(csr)
+
+    # Resolve the keys to both directions of every street segment
+    resolved = []
+    for key, field, value, hour in observations:
+        if field not in ("volume", "speed"):
+            raise ValueError(f"Unknown observation field {field}")
+        if field == "volume" and csr.volume is None:
+            raise ValueError("The graph has no hourly traffic volumes")
+        if isinstance(key, str):
+            if streets is None:
+                raise ValueError("Observations keyed by street need G.graph['streets'] (see load_street_edges)")
+            edges = streets.edges(names.normalize(key) if names is not None else key)
+        else:
+            edges = np.array([key], dtype=np.int64)
+        if len(edges):
+            back = reverse[edges]
+            resolved.append((np.unique(np.concatenate([edges, back[back >= 0]])), field, value, hour))
+    if not resolved:
+        return {"edges": 0, "version": G.graph.get("version", 0), "decreased": False, "lowered": False}
+    edges = np.unique(np.concatenate([r[0] for r in resolved]))
+    old_static = np.asarray(csr.weight)[edges]
+    old_hourly = csr._hourly[:, edges] if csr._hourly is not None else _edge_weights(csr, edges)[1]
+
+    for changed, field, value, hour in resolved:
+        if field == "speed":
+            csr.speed[changed] = float(value) / 3600 * 1609
+        elif hour is None:
+            csr.volume[changed] = np.broadcast_to(np.asarray(value, dtype=np.float32), (len(changed), 24))
+        else:
+            csr.volume[changed, int(hour) % 24] = value
+    static, hourly = _edge_weights(csr, edges)
+    # Raising the volume of one hour lowers that hour and the static weight but maybe not the lowest weight
+    decreased = bool((static < old_static).any() or (hourly is not None and (hourly < old_hourly).any()))
+    lowered = bool((_lower(static, hourly) < _lower(old_static, old_hourly)).any())
+
+    # Write the new weights to the arrays and to the python copies the searches use
+    csr.weight[edges] = static
+    if csr._lists is not None:
+        weights = csr._lists[2]
+        for k, w in zip(edges.tolist(), static.tolist()):
+            weights[k] = w
+    if csr._hourly is not None and hourly is not None:
+        csr._hourly[:, edges] = hourly
+        for h, weights in csr._hour_lists.items():
+            for k, w in zip(edges.tolist(), hourly[h].tolist()):
+                weights[k] = w
+    speed_edges = [r[0] for r in resolved if r[1] == "speed"]
+    if speed_edges and csr._seconds is not None:
+        changed = np.unique(np.concatenate(speed_edges))
+        length = haversine(csr.coords[csr.tails()[changed]], csr.coords[np.asarray(csr.indices)[changed]])
+        for k, t in zip(changed.tolist(), (length / np.maximum(csr.speed[changed], 1e-9)).tolist()):
+            csr._seconds[k] = t
+
+    # Repair what depends on the weights
+    version = G.graph["version"] = G.graph.get("version", 0) + 1
+    stale = G.graph.setdefault("stale", set())
+    cache = G.graph.get("route_cache")
+    if cache is not None:
+        if decreased:
+            cache.clear()
+        else:
+            nodes = csr.nodes
+            tails = csr.tails()[edges].tolist()
+            heads = np.asarray(csr.indices)[edges].tolist()
+            cache.discard_edges({(nodes[u], nodes[v]) for u, v in zip(tails, heads)})
+        cache.version = version
+    if lowered and G.graph.get("landmarks") is not None:
+        G.graph["landmarks"].stale = True
+        stale.add("landmarks")
+    if G.graph.get("ch") is not None:
+        G.graph["ch"] = None
+        stale.add("ch")
+    instrument.count("live.edges", len(edges))
+    return {"edges": len(edges), "version": version, "decreased": decreased, "lowered": lowered}
+
+
+def refresh(G, alt=True, ch=False):
+    """
+    Rebuilds the structures apply_updates dropped (landmarks with alt, the contraction hierarchy with ch) for the
+    current weights. Slow, meant to run between dispatch windows. Nothing is saved to disk.
+
+    Parameters: (G, alt, ch)
+        G - CSRGraph()
+        alt - bool
+        ch - bool
+    """
+    from landmarks import build_landmarks
+    from ch import build_hierarchy
+    stale = G.graph.setdefault("stale", set())
+    if alt and "landmarks" in stale:
+        # Rebuilt in place, the simulation holds on to the Landmarks object as its heuristic
+        old = G.graph["landmarks"]
+        new = build_landmarks(G.graph["csr"], k=len(old), path=None)
+        old.landmarks, old.dist, old._columns, old.stale = new.landmarks, new.dist, {}, False
+        stale.discard("landmarks")
+    if ch and "ch" in stale:
+        G.graph["ch"] = build_hierarchy(G.graph["csr"], path=None)
+        stale.discard("ch")
+
+
+def replay(path="NYC/Traffic_Data/traffic_volume.csv", start=None, interval=60, batch=1000):
+    """
+    Stand in for a live feed: yields (time, observations) with batch rows of the traffic counts file every
+    interval seconds from start. Every row becomes a full day volume observation of its street.
+
+    Parameters: (path, start, interval, batch)
+        path - string
+        start - datetime, None to yield None times
+        interval - float (seconds)
+        batch - int, rows per update
+    """
+    roadways, counts = traffic.extract_data(path)
+    counts = np.nan_to_num(counts)
+    for i, first in enumerate(range(0, len(roadways), batch)):
+        time = None if start is None else start + timedelta(seconds=i * interval)
+        yield time, [(name, "volume", row, None)
+                     for name, row in zip(roadways[first:first + batch], counts[first:first + batch])]
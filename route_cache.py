@@ -0,0 +1,106 @@
+from collections import OrderedDict
+
+
+class RouteCache():
+    """
+    Least recently used cache of shortest paths shared by every routing call made through astar.find_path.
+    Keys are (source, target, profile), profile being None for the static weights or the hour of departure for
+    time dependent routes. The heuristic isn't part of the key: admissible heuristics and the contraction
+    hierarchy all find a shortest path, so a route is shared by every caller. The cache is emptied when the version of the graph changes, so
+    edge weight updates must bump G.graph["version"] (live_traffic.apply_updates only drops the routes over
+    the edges it changed and moves the version itself).
+
+    ===Attributes===
+    maxsize: most routes kept
+    version: graph version the cached routes were computed for
+    hits: number of lookups answered from the cache
+    misses: number of lookups that had to be routed
+    evictions: number of routes dropped to stay under maxsize
+    """
+    maxsize: int
+    version: int
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, maxsize=100000, version=0):
+        self.maxsize = maxsize
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._routes = OrderedDict()
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __contains__(self, key):
+        return key in self._routes
+
+    def check(self, version):
+        """
+        Empties the cache if version isn't the version it was filled for.
+
+        Parameters: (self, version)
+            version - int
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, key):
+        """
+        Returns the route stored for key and marks it as recently used, None if it isn't cached.
+        Counts a hit or a miss.
+
+        Parameters: (self, key)
+            key - tuple
+        """
+        route = self._routes.get(key)
+        if route is None:
+            self.misses += 1
+            return None
+        self._routes.move_to_end(key)
+        self.hits += 1
+        return route
+
+    def put(self, key, route):
+        """
+        Stores route for key, evicting the least recently used routes when full.
+
+        Parameters: (self, key, route)
+            key - tuple
+            route - (cost, tuple of nodes), or (None, None) if there is no path
+        """
+        self._routes[key] = route
+        self._routes.move_to_end(key)
+        while len(self._routes) > self.maxsize:
+            self._routes.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Removes every route. The counters are kept.
+        """
+        self._routes.clear()
+
+    def discard_edges(self, edges):
+        """
+        Removes the routes that use one of edges. Returns the number of routes removed.
+
+        Parameters: (self, edges)
+            edges - set of (u, v) node pairs, both directions must be given for undirected edges
+        """
+        stale = [key for key, (cost, path) in self._routes.items()
+                 if path is not None and any(pair in edges for pair in zip(path, path[1:]))]
+        for key in stale:
+            del self._routes[key]
+        return len(stale)
+
+    def info(self):
+        """
+        Returns a dict with the counters and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self),
+                "maxsize": self.maxsize, "hit_rate": self.hits / lookups if lookups else 0.0}
@@ -1,6 +1,9 @@
 import networkx as nx
+from datetime import timedelta
 from vehicle import Vehicle
-from admission_control import admission_control
+from fleet import Fleet
+from admission_control import admission_control, batch_admission_control
+import instrument
 
 class Scheduling():
     """
@@ -8,17 +11,35 @@ class Scheduling():
 
     ===Attributes===
     vehicles: list of all vehicles being controlled by the celer system
+    fleet: Fleet() storing the state of the vehicles added with add_vehicle
     graph: graph representing the map
     log: dictionary with all trips and who got them
+    batch_window: seconds of requests buffered before they are assigned together, None to assign one at a time
+    solver: "hungarian" or "genetic", how a batch is assigned (see admission_control.batch_admission_control)
+    budget: seconds the genetic algorithm may spend on every batch, None for no limit
+    workers: processes evaluating the fitness of the genetic algorithm, None for none
+    pending: requests buffered for the next batch
     """
     vehicles: list
+    fleet: Fleet
     graph: dict
     log: dict
+    batch_window: float
+    solver: str
+    budget: float
+    workers: int
+    pending: list
 
-    def __init__(self, G):
+    def __init__(self, G, batch_window=None, solver="hungarian", budget=None, workers=None):
         self.vehicles = []
+        self.fleet = Fleet()
         self.graph = G
         self.log = {}
+        self.batch_window = batch_window
+        self.solver = solver
+        self.budget = budget
+        self.workers = workers
+        self.pending = []
 
     def add_vehicle(self, v):
         """
@@ -28,7 +49,14 @@ class Scheduling():
             v - Vehicle()
         """
         self.vehicles.append(v)
-        
+        self.fleet.add(v)
+
+    def _grid_fleet(self):
+        """
+        Returns self.fleet if it holds every vehicle so its grid can answer radius queries, None otherwise.
+        """
+        return self.fleet if len(self.fleet) == len(self.vehicles) else None
+
     def find_assign_trip(self, trip, heuristic):
         """
         Assigns best available vehicle manage a certain trips. Return True if trip-vehicle
@@ -38,23 +66,80 @@ class Scheduling():
             trips - Request()
             heuristic - Callable()
         """
-        ac = admission_control(trip, self.vehicles, self.graph) # {vehicle ID: request()}
+        ac = admission_control(trip, self.vehicles, self.graph, self._grid_fleet()) # {vehicle ID: request()}
         for v in self.vehicles:
             if v.id in ac.keys():
                 v.assign_trip(self.graph, ac[v.id], heuristic)
+                instrument.count("trips.assigned")
                 return True
+        instrument.count("trips.rejected")
         return False
         # Note: AC key will be -1 if this request is not possible/no profit/no cars
-        
+
+    def add_request(self, trip):
+        """
+        Buffers a trip for the next batch.
+
+        Parameters: (self, trip)
+            trip - Request()
+        """
+        self.pending.append(trip)
+
+    def batch_due(self, time):
+        """
+        Return True if the oldest buffered trip has waited batch_window seconds at time.
+
+        Parameters: (self, time)
+            time - datetime
+        """
+        return bool(self.pending) and time - self.pending[0].pickup_time >= timedelta(seconds=self.batch_window)
+
+    def dispatch_batch(self, heuristic):
+        """
+        Assigns all buffered trips together. Returns the number of trips assigned and rejected.
+
+        Parameters: (self, heuristic)
+            heuristic - Callable()
+        """
+        trips, self.pending = self.pending, []
+        ac = batch_admission_control(trips, self.vehicles, self.graph, self._grid_fleet(), self.solver, self.budget,
+                                     self.workers) # {vehicle ID: request()}
+        for v in self.vehicles:
+            if v.id in ac:
+                v.assign_trip(self.graph, ac[v.id], heuristic)
+        instrument.count("trips.assigned", len(ac))
+        instrument.count("trips.rejected", len(trips) - len(ac))
+        return len(ac), len(trips) - len(ac)
+
     def move(self, s=1):
         """
-        Moves all vehicles in self.vehicles, s seconds.
+        Moves all vehicles in self.vehicles, s seconds. Returns the vehicles that completed a trip, in the
+        order of self.vehicles.
 
         Parameters: (self, s)
             s - float
         """
-        for vehicle in self.vehicles:
-            vehicle.move(self.graph, s)
+        with instrument.timer("move"):
+            completed = self.fleet.move(self.graph, s)
+            if self._grid_fleet() is not None:
+                # Rows are given in the order the vehicles were added
+                return sorted(completed, key=lambda vehicle: vehicle.row)
+            for vehicle in self.vehicles:
+                if vehicle.fleet is None and vehicle.trips:
+                    done = len(vehicle.log)
+                    vehicle.move(self.graph, s)
+                    if len(vehicle.log) > done:
+                        completed.append(vehicle)
+            return sorted(completed, key=self.vehicles.index)
+
+    def busy(self):
+        """
+        Returns True if at least one vehicle is on a trip. Reads the counter of the fleet when it holds every
+        vehicle instead of looking at each of them.
+        """
+        if self._grid_fleet() is not None:
+            return self.fleet.active > 0
+        return any(v.trips for v in self.vehicles)
 
     def get_logs(self):
         """
@@ -0,0 +1,158 @@
+import os
+import numpy as np
+from csr import CSRGraph, save_graph, load_graph
+from ch import checksum
+
+# Graph simplification. The map is built with a node at every point of every street centerline, so most nodes
+# are shape points joining exactly two segments. contract_chains replaces every chain of such nodes by one edge
+# between the intersections (or dead ends) at its ends and keeps the points in the shape side arrays of
+# CSRGraph, so paths can still be drawn and driven along the real streets (CSRGraph.expand_path).
+
+
+def _kept(csr):
+    """
+    Returns a list of bools, True for the nodes that stay in the simplified graph: every node that doesn't
+    have exactly two neighbours or that has a self loop.
+    """
+    tails = csr.tails()
+    keep = np.diff(csr.indptr) != 2
+    keep[tails[tails == np.asarray(csr.indices)]] = True
+    return keep.tolist()
+
+
+def _walk(indptr, indices, keep, u, k):
+    """
+    Follows the edge k out of the kept node u through the nodes that aren't kept. Returns (w, edges, interior):
+    the kept node reached, the edge positions in travel order and the nodes passed.
+    """
+    edges, interior = [k], []
+    prev, v = u, indices[k]
+    while not keep[v]:
+        interior.append(v)
+        a = indptr[v]
+        k = a if indices[a] != prev else a + 1
+        edges.append(k)
+        prev, v = v, indices[k]
+    return v, edges, interior
+
+
+def _chains(csr):
+    """
+    Returns (keep, chains): the kept nodes and the chain (u, w, edges, interior) of every edge of the simplified
+    graph, grouped by u in id order and in CSR order for every u.
+    Rings without any kept node get one and chains that would be parallel edges or loops get one of their
+    inner nodes kept, until the simplified graph has at most one edge per pair of nodes like the original.
+    """
+    indptr, indices = csr._indptr, csr._indices
+    keep = _kept(csr)
+    while True:
+        chains = []
+        seen = list(keep)
+        for u in range(len(keep)):
+            if not keep[u]:
+                continue
+            for k in range(indptr[u], indptr[u + 1]):
+                w, edges, interior = _walk(indptr, indices, keep, u, k)
+                for v in interior:
+                    seen[v] = True
+                chains.append((u, w, edges, interior))
+        ring = False
+        for u in range(len(keep)):
+            if not seen[u]:
+                # Ring of shape points, keep its first node
+                keep[u] = seen[u] = ring = True
+                for v in _walk(indptr, indices, keep, u, indptr[u])[2]:
+                    seen[v] = True
+        if ring:
+            continue
+
+        pairs = {}
+        for u, w, edges, interior in chains:
+            pairs[(u, w)] = pairs.get((u, w), 0) + 1
+        split = False
+        for u, w, edges, interior in chains:
+            if interior and (u == w or pairs[(u, w)] > 1):
+                keep[interior[len(interior) // 2]] = True
+                split = True
+        if not split:
+            return keep, chains
+
+
+def contract_chains(csr):
+    """
+    Returns the simplified copy of csr: chains of nodes with two neighbours are contracted into single edges
+    whose weight (static and hourly) is the sum of the weights of the chain, distance the sum of the distances
+    of its streets (consecutive equal distances are the same street, see astar.print_trip_info), speed the
+    length weighted harmonic mean of the speeds so the time to drive it doesn't change, and volume the length
+    weighted mean. The costs of the shortest paths between the nodes kept are the same as in csr.
+
+    Parameters: (csr)
+        csr - CSRGraph()
+    """
+    from astar import haversine
+    keep, chains = _chains(csr)
+    keep = np.array(keep, dtype=bool)
+    new_id = np.cumsum(keep) - 1
+    m = len(chains)
+
+    tails = np.array([c[0] for c in chains], dtype=np.int64)
+    heads = np.array([c[1] for c in chains], dtype=np.int64)
+    sizes = np.array([len(c[2]) for c in chains], dtype=np.int64)
+    flat = np.fromiter((k for c in chains for k in c[2]), dtype=np.int64, count=int(sizes.sum()))
+    interior = np.fromiter((v for c in chains for v in c[3]), dtype=np.int64, count=int(sizes.sum()) - m)
+    first = np.zeros(m, dtype=np.int64)
+    np.cumsum(sizes[:-1], out=first[1:])
+
+    indptr = np.zeros(int(keep.sum()) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(new_id[tails], minlength=len(indptr) - 1), out=indptr[1:])
+    shape_ptr = np.zeros(m + 1, dtype=np.int64)
+    np.cumsum(sizes - 1, out=shape_ptr[1:])
+
+    # Length of every original segment, to weigh the speeds and volumes
+    old_tails = csr.tails()
+    length = haversine(csr.coords[old_tails[flat]], csr.coords[np.asarray(csr.indices)[flat]])
+    total = np.add.reduceat(length, first) if m else np.empty(0)
+    speed = np.asarray(csr.speed, dtype=np.float64)[flat]
+    seconds = np.add.reduceat(length / np.maximum(speed, 1e-9), first) if m else np.empty(0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_speed = np.where(seconds > 0, total / seconds, speed[first] if m else speed)
+    distance = np.asarray(csr.distance, dtype=np.float64)[flat]
+    new_street = np.r_[True, distance[1:] != distance[:-1]] if len(flat) else np.empty(0, dtype=bool)
+    new_street[first] = True
+
+    simple = CSRGraph(csr.coords[keep], indptr, new_id[heads].astype(np.int32),
+                      np.add.reduceat(np.asarray(csr.weight, dtype=np.float64)[flat], first) if m else np.empty(0),
+                      np.add.reduceat(np.where(new_street, distance, 0), first) if m else np.empty(0),
+                      mean_speed, shape_ptr=shape_ptr, shape=csr.coords[interior], segment_speed=speed)
+    if csr.volume is not None:
+        volume = np.asarray(csr.volume, dtype=np.float64)[flat]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.add.reduceat(volume * length[:, np.newaxis], first, axis=0) / total[:, np.newaxis]
+        simple.volume = np.where(total[:, np.newaxis] > 0, mean, volume[first]).astype(np.float32)
+        simple.hourly = np.add.reduceat(csr.hourly_weights()[:, flat], first, axis=1)
+    return simple
+
+
+def load_simplified(csr, path="graph_simple", reset=False):
+    """
+    Returns the simplified graph of csr saved in path (memory mapped like load_graph). Contracts and saves it if
+    it's missing, was made from another graph or reset=True.
+
+    Parameters: (csr, path, reset)
+        csr - CSRGraph()
+        path - string
+        reset - bool
+    """
+    source = os.path.join(path, "source.npy")
+    if not reset:
+        try:
+            if np.array_equal(np.load(source), checksum(csr)):
+                return load_graph(path)
+        except (OSError, ValueError):
+            pass
+    print("Simplifying graph...")
+    simple = contract_chains(csr)
+    save_graph(simple, path)
+    np.save(source, checksum(csr))
+    print(f"Done. {len(csr)} nodes -> {len(simple)} nodes.")
+    return load_graph(path)
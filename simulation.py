@@ -1,27 +1,60 @@
-import sys
+import argparse
 from datetime import datetime, timedelta
 
 from scheduling import *
 from vehicle import *
-from astar import load_data, draw_graph, draw_path
+from astar import load_data, draw_graph, draw_path, default_heuristic
+from events import EventSimulation
+from live_traffic import load_street_edges, replay
+from street_names import load_street_names
 from random import randint
+import instrument
 
-if len(sys.argv) not in [3, 4]:
-    sys.exit("Usage: python simulation.py vehicle_number trip_number reset\nvehicle_number - int\ntrip_number - int\nreset - True/False")
+parser = argparse.ArgumentParser(usage="python simulation.py vehicle_number trip_number reset [--batch SECONDS] "
+                                       "[--live SECONDS] [--refresh UPDATES] [--refresh-ch UPDATES] "
+                                       "[--simplify] [--giant] "
+                                       "[--solver SOLVER] [--budget SECONDS] [--profile MODE] [--profile-output PATH]")
+parser.add_argument("vehicle_number", type=int, help="int")
+parser.add_argument("trip_number", type=int, help="int")
+parser.add_argument("reset", nargs="?", default="False", help="True/False")
+parser.add_argument("--batch", type=float, default=None, metavar="SECONDS",
+                    help="buffer requests and assign them together every SECONDS of simulated time")
+parser.add_argument("--solver", choices=("hungarian", "genetic"), default="hungarian",
+                    help="how a batch of requests is assigned to the vehicles")
+parser.add_argument("--budget", type=float, default=None, metavar="SECONDS",
+                    help="most seconds the genetic algorithm spends on every batch")
+parser.add_argument("--live", type=float, default=None, metavar="SECONDS",
+                    help="replay the traffic counts as a live feed, one batch of updates every SECONDS")
+parser.add_argument("--refresh", type=int, default=0, metavar="UPDATES",
+                    help="rebuild the landmarks the live feed made stale every UPDATES batches, 0 to never rebuild")
+parser.add_argument("--refresh-ch", type=int, default=0, metavar="UPDATES",
+                    help="rebuild the contraction hierarchy every UPDATES batches of the live feed (slow), 0 never")
+parser.add_argument("--simplify", action="store_true",
+                    help="route on the graph with the chains of shape points contracted")
+parser.add_argument("--giant", action="store_true",
+                    help="snap trips and vehicles to the largest connected component only")
+parser.add_argument("--profile", choices=instrument.MODES, default=None,
+                    help="count and time the hot paths per simulated hour (same as CELER_PROFILE=MODE)")
+parser.add_argument("--profile-output", default="profile.json", metavar="PATH",
+                    help="file the per hour profile is written to, .json or .csv")
+args = parser.parse_args()
+if args.live is not None and args.simplify:
+    # Live observations are per street segment, the simplified edges sum whole chains of them
+    parser.error("--live needs the full graph, it can't be combined with --simplify")
+if args.profile is not None:
+    instrument.enable(args.profile)
 
 # Get start up data
-try:
-    num_of_vehicles = int(sys.argv[1])
-    num_of_trips = int(sys.argv[2])
-except:
-    sys.exit("Usage: python simulation.py vehicle_number trip_number reset\nvehicle_number - int\ntrip_number - int\nreset - True/False")
+num_of_vehicles = args.vehicle_number
+num_of_trips = args.trip_number
 
 # Load graph and trips
 G, trips = None, None
-if len(sys.argv) == 4 and sys.argv[2] == "True":
-    G, trips = load_data(reset=True, graph=False, trip=False, abbr=False)
+if args.reset == "True":
+    G, trips = load_data(reset=True, graph=False, trip=False, abbr=False, simplify=args.simplify)
 else:
-    G, trips = load_data(reset=False, graph=False, trip=False, abbr=False)
+    G, trips = load_data(reset=False, graph=False, trip=False, abbr=False, simplify=args.simplify)
+G.graph["snap_giant"] = args.giant
 trips = trips[:num_of_trips]
 trips.sort()
 nodes = G.nodes()
@@ -29,34 +62,23 @@ num_nodes = len(nodes) - 1
 total_trips = len(trips)
 
 # Create Vehicles and other variables
-scheduling = Scheduling(G)
+scheduling = Scheduling(G, batch_window=args.batch, solver=args.solver, budget=args.budget)
 for v in range(num_of_vehicles):
-    scheduling.vehicles.append(Vehicle(list(nodes)[randint(0, num_nodes)], 40.0, 10.0, 20, True, 4, v))
-time = datetime(2015, 1, 1, 0, 0)
-s = 0
-t = 0
+    scheduling.add_vehicle(Vehicle(list(nodes)[randint(0, num_nodes)], 40.0, 10.0, 20, True, 4, v))
 
 # Start simulation:
 sim_start = datetime.now()
 print("=== Running Simulation ===")
-interval = 1
-while time < datetime(2015, 1, 20, 0, 0): # When to stop simulation.
-    while t < total_trips:
-        if time == trips[t].pickup_time:  # time = time trip was assigned IRL
-            if not scheduling.find_assign_trip(trips[t], diste):
-                s += 1
-            t += 1
-        elif time > trips[t].pickup_time:
-            t += 1
-            s += 1
-        else:
-            break
-    interval += 1
-    if interval == 5:
-        scheduling.move(5)
-        interval = 0
-    # scheduling.move(1)
-    time += timedelta(seconds=1)
+heuristic = default_heuristic(G)
+feed = None
+if args.live is not None:
+    G.graph["names"] = load_street_names()
+    G.graph["streets"] = load_street_edges(G, G.graph["names"])
+    feed = replay(start=datetime(2015, 1, 1, 0, 0), interval=args.live)
+simulation = EventSimulation(scheduling, trips, datetime(2015, 1, 1, 0, 0), datetime(2015, 1, 20, 0, 0), heuristic,
+                             feed=feed, refresh=args.refresh,
+                             refresh_ch=args.refresh_ch) # When to stop simulation.
+s = simulation.run()
 print("Done\n")
 sim_end = datetime.now()
 
@@ -70,6 +92,11 @@ print("=== Simulation Summary ===")
 print(f"Runtime: {sim_end - sim_start}")
 print(f"{total_trips - s}/{total_trips} trips completed")
 print(f"{used}/{num_of_vehicles} vehicles used")
+cache = G.graph["route_cache"].info()
+print(f"Route cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate'] * 100:.1f}% hit rate)")
+if instrument.ENABLED:
+    instrument.dump(args.profile_output)
+    print(f"Profile written to {args.profile_output}")
 
 print("\n=== Interactive Simulation Lookup ===")
 ipt = input("S to get the summary, V to look through vehicles, T to look through trips, Q to quit: ").lower()
@@ -88,7 +115,7 @@ while ipt != "q":
                 if vehicle.log != []:
                     path = []
                     for trip in vehicle.log:
-                        path += trip["path"]
+                        path += G.expand_path(trip["path"])
                     sa = so = float("inf")
                     ba = bo = -float("inf")
                     for lat, lon in path:
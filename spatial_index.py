@@ -0,0 +1,367 @@
+import hashlib
+import math
+import pickle
+import numpy as np
+import instrument
+
+
+class SpatialIndex():
+    """
+    A uniform grid over the (lat, lon) coordinates of the graph nodes used for nearest node lookups.
+    Distances are manhattan distances in degrees, the same metric as astar.find_closest_node.
+
+    ===Attributes===
+    nodes: list of nodes in G.nodes() order
+    coords: float64 array (N, 2) of node coordinates
+    origin: (lat, lon) of the lower corner of the grid
+    size: side of a cell in degrees
+    shape: (rows, cols) number of cells
+    order: node indices sorted by cell
+    starts: offsets into order for every cell (rows * cols + 1)
+    """
+    nodes: list
+    coords: np.ndarray
+    origin: tuple
+    size: float
+    shape: tuple
+    order: np.ndarray
+    starts: np.ndarray
+
+    def __init__(self, nodes, per_cell=4):
+        self.nodes = list(nodes)
+        self.coords = np.array(self.nodes, dtype=np.float64).reshape(-1, 2)
+        lo = self.coords.min(axis=0) if len(self.nodes) else np.zeros(2)
+        hi = self.coords.max(axis=0) if len(self.nodes) else np.zeros(2)
+        area = max((hi[0] - lo[0]) * (hi[1] - lo[1]), 1e-12)
+        self.size = max(math.sqrt(area * per_cell / max(len(self.nodes), 1)), 1e-9)
+        self.origin = (float(lo[0]), float(lo[1]))
+        self.shape = (int((hi[0] - lo[0]) // self.size) + 1, int((hi[1] - lo[1]) // self.size) + 1)
+
+        cells = self._cell_ids(self.coords)
+        self.order = np.argsort(cells, kind="stable")
+        counts = np.bincount(cells, minlength=self.shape[0] * self.shape[1])
+        self.starts = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.starts[1:])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _cells(self, points):
+        """
+        Returns the (row, col) cell of every point, clamped to the grid.
+
+        Parameters: (self, points)
+            points - float array (M, 2)
+        """
+        rows = np.clip(((points[:, 0] - self.origin[0]) // self.size).astype(np.int64), 0, self.shape[0] - 1)
+        cols = np.clip(((points[:, 1] - self.origin[1]) // self.size).astype(np.int64), 0, self.shape[1] - 1)
+        return rows, cols
+
+    def _cell_ids(self, points):
+        rows, cols = self._cells(points)
+        return rows * self.shape[1] + cols
+
+    def _block(self, r0, r1, c0, c1):
+        """
+        Returns the node indices stored in the cells [r0, r1] x [c0, c1].
+        """
+        parts = []
+        for r in range(r0, r1 + 1):
+            base = r * self.shape[1]
+            parts.append(self.order[self.starts[base + c0]:self.starts[base + c1 + 1]])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+    def _bound(self, point, row, col, ring):
+        """
+        Returns a lower bound on the distance from point to any node outside the block of cells
+        within ring of (row, col).
+        """
+        bound = float("inf")
+        if row - ring > 0:
+            bound = min(bound, point[0] - (self.origin[0] + (row - ring) * self.size))
+        if row + ring < self.shape[0] - 1:
+            bound = min(bound, self.origin[0] + (row + ring + 1) * self.size - point[0])
+        if col - ring > 0:
+            bound = min(bound, point[1] - (self.origin[1] + (col - ring) * self.size))
+        if col + ring < self.shape[1] - 1:
+            bound = min(bound, self.origin[1] + (col + ring + 1) * self.size - point[1])
+        return bound
+
+    def _bounds(self, points, row, col, ring):
+        """
+        Vectorized _bound for points that all lie in cell (row, col). inf means the block covers the grid.
+        """
+        bound = np.full(len(points), np.inf)
+        if row - ring > 0:
+            bound = np.minimum(bound, points[:, 0] - (self.origin[0] + (row - ring) * self.size))
+        if row + ring < self.shape[0] - 1:
+            bound = np.minimum(bound, self.origin[0] + (row + ring + 1) * self.size - points[:, 0])
+        if col - ring > 0:
+            bound = np.minimum(bound, points[:, 1] - (self.origin[1] + (col - ring) * self.size))
+        if col + ring < self.shape[1] - 1:
+            bound = np.minimum(bound, self.origin[1] + (col + ring + 1) * self.size - points[:, 1])
+        return bound
+
+    def _search(self, point, k):
+        """
+        Returns the indices and distances of the k nodes closest to point, closest first.
+        Ties are broken by position in G.nodes() like the linear scan.
+
+        Parameters: (self, point, k)
+            point - (lat, lon)
+            k - int
+        """
+        point = (float(point[0]), float(point[1]))
+        rows, cols = self._cells(np.array([point]))
+        row, col = int(rows[0]), int(cols[0])
+        k = min(k, len(self.nodes))
+        ring = 0
+        found = np.empty(0, dtype=np.int64)
+        while True:
+            r0, r1 = max(row - ring, 0), min(row + ring, self.shape[0] - 1)
+            c0, c1 = max(col - ring, 0), min(col + ring, self.shape[1] - 1)
+            found = self._block(r0, r1, c0, c1)
+            bound = self._bound(point, row, col, ring)
+            if len(found) >= k:
+                d = np.abs(self.coords[found, 0] - point[0]) + np.abs(self.coords[found, 1] - point[1])
+                best = np.lexsort((found, d))[:k]
+                if d[best[-1]] < bound or bound == float("inf"):
+                    return found[best], d[best]
+            elif bound == float("inf"):
+                d = np.abs(self.coords[found, 0] - point[0]) + np.abs(self.coords[found, 1] - point[1])
+                best = np.lexsort((found, d))
+                return found[best], d[best]
+            ring += 1
+
+    def nearest(self, point):
+        """
+        Returns the node closest to point.
+
+        Parameters: (self, point)
+            point - (lat, lon)
+        """
+        if not self.nodes:
+            return None
+        instrument.count("nearest.calls")
+        return self.nodes[self._search(point, 1)[0][0]]
+
+    def nearest_index(self, points, batch=4096):
+        """
+        Returns an int64 array with the index (in self.nodes) of the node closest to every point.
+
+        Parameters: (self, points, batch)
+            points - float array (M, 2) of (lat, lon)
+            batch - int, most points compared against a block of cells at once
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        out = np.empty(len(points), dtype=np.int64)
+        instrument.count("nearest.points", len(points))
+        if not len(points) or not self.nodes:
+            return out
+        # Points are grouped by cell and matched against the 3 x 3 block around it in one step. The few
+        # points whose answer could lie outside the block go through _search.
+        rows, cols = self._cells(points)
+        cells = rows * self.shape[1] + cols
+        order = np.argsort(cells, kind="stable")
+        splits = np.flatnonzero(np.diff(cells[order])) + 1
+        for group in np.split(order, splits):
+            row, col = int(rows[group[0]]), int(cols[group[0]])
+            block = np.sort(self._block(max(row - 1, 0), min(row + 1, self.shape[0] - 1),
+                                        max(col - 1, 0), min(col + 1, self.shape[1] - 1)))
+            if not len(block):
+                for i in group.tolist():
+                    out[i] = self._search(points[i], 1)[0][0]
+                continue
+            for part in np.array_split(group, -(-len(group) // batch)):
+                pts = points[part]
+                d = (np.abs(pts[:, 0, np.newaxis] - self.coords[block, 0])
+                     + np.abs(pts[:, 1, np.newaxis] - self.coords[block, 1]))
+                best = np.argmin(d, axis=1)
+                dist = d[np.arange(len(part)), best]
+                exact = dist < self._bounds(pts, row, col, 1)
+                out[part[exact]] = block[best[exact]]
+                for i in part[~exact].tolist():
+                    out[i] = self._search(points[i], 1)[0][0]
+        return out
+
+    def nearest_many(self, points):
+        """
+        Returns a list with the node closest to every point.
+
+        Parameters: (self, points)
+            points - float array (M, 2) of (lat, lon)
+        """
+        return [self.nodes[i] for i in self.nearest_index(points)]
+
+    def k_nearest(self, point, k):
+        """
+        Returns a list of the k nodes closest to point, closest first.
+
+        Parameters: (self, point, k)
+            point - (lat, lon)
+            k - int
+        """
+        if not self.nodes or k < 1:
+            return []
+        return [self.nodes[i] for i in self._search(point, k)[0]]
+
+
+def checksum(nodes):
+    """
+    Returns a fingerprint of the coordinates of nodes, in order, used to detect an index built for another graph.
+
+    Parameters: (nodes)
+        nodes - list of (lat, lon)
+    """
+    return hashlib.sha1(np.array(nodes, dtype=np.float64).reshape(-1, 2).tobytes()).hexdigest()
+
+
+def build_index(G, path="index.pkl"):
+    """
+    Builds the spatial index of G and saves it with the checksum of the nodes in a pickle file.
+
+    Parameters: (G, path)
+        G - networkx.graph()
+        path - string
+    """
+    index = SpatialIndex(G.nodes())
+    with open(path, 'wb') as out:
+        pickle.dump((checksum(index.coords), index), out)
+    return index
+
+
+def load_index(G, path="index.pkl", reset=False):
+    """
+    Returns the spatial index of G stored in path. Rebuilds it if it's missing, was built for other nodes or
+    reset=True.
+
+    Parameters: (G, path, reset)
+        G - networkx.graph()
+        path - string
+        reset - bool
+    """
+    if not reset:
+        try:
+            with open(path, 'rb') as index_file:
+                saved, index = pickle.load(index_file)
+            if saved == checksum(list(G.nodes())):
+                return index
+        except (OSError, pickle.UnpicklingError, EOFError, TypeError, ValueError):
+            # Missing, or an index pickled without its checksum by older versions
+            pass
+    print("Building spatial index...")
+    index = build_index(G, path)
+    print("Done.")
+    return index
+
+
+class FleetGrid():
+    """
+    A dynamic uniform grid of vehicle positions used for radius queries. Only the rows that are inserted
+    (the available vehicles) are stored, so vehicles on a trip cost nothing while they move.
+
+    ===Attributes===
+    size: side of a cell in degrees
+    cells: dict mapping (row, col) of a cell to the set of fleet rows in it
+    keys: dict mapping every stored fleet row to its cell
+    """
+    size: float
+    cells: dict
+    keys: dict
+
+    def __init__(self, size=0.01):
+        self.size = size
+        self.cells = {}
+        self.keys = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, row):
+        return row in self.keys
+
+    def _key(self, point):
+        return (math.floor(point[0] / self.size), math.floor(point[1] / self.size))
+
+    def insert(self, row, point):
+        """
+        Stores row at point, moving it if it's already stored.
+
+        Parameters: (self, row, point)
+            row - int
+            point - (lat, lon)
+        """
+        key = self._key(point)
+        old = self.keys.get(row)
+        if old == key:
+            return
+        if old is not None:
+            self._discard(row, old)
+        self.keys[row] = key
+        self.cells.setdefault(key, set()).add(row)
+
+    def remove(self, row):
+        """
+        Removes row if it's stored.
+
+        Parameters: (self, row)
+            row - int
+        """
+        old = self.keys.pop(row, None)
+        if old is not None:
+            self._discard(row, old)
+
+    def _discard(self, row, key):
+        bucket = self.cells[key]
+        bucket.discard(row)
+        if not bucket:
+            del self.cells[key]
+
+    def update(self, rows, points):
+        """
+        Moves the stored rows among rows to their new points. Cells are computed in one vectorized step and
+        only rows that changed cell are touched.
+
+        Parameters: (self, rows, points)
+            rows - int array (M)
+            points - float array (M, 2)
+        """
+        if not len(self.keys) or not len(rows):
+            return
+        keys = np.floor(np.asarray(points) / self.size).astype(np.int64).tolist()
+        for row, key in zip(rows.tolist(), keys):
+            old = self.keys.get(row)
+            if old is not None and old != tuple(key):
+                self._discard(row, old)
+                key = tuple(key)
+                self.keys[row] = key
+                self.cells.setdefault(key, set()).add(row)
+
+    def candidates(self, point, radius):
+        """
+        Returns a list of the stored rows in the cells that can be within radius metres of point, measured
+        like astar.haversine(position, point). The exact distances still have to be checked.
+
+        Parameters: (self, point, radius)
+            point - (lat, lon)
+            radius - float (metres)
+        """
+        # astar.haversine scales the longitude term by cos(lat of point) only, so the box is exact for it
+        half = math.sin(min(radius / (2 * 6371000), math.pi / 2))
+        dlat = math.degrees(2 * math.asin(half)) + 1e-9
+        scale = math.sqrt(max(math.cos(math.radians(point[0])), 1e-12))
+        dlon = math.degrees(2 * math.asin(min(half / scale, 1.0))) + 1e-9
+        r0, c0 = self._key((point[0] - dlat, point[1] - dlon))
+        r1, c1 = self._key((point[0] + dlat, point[1] + dlon))
+        found = []
+        if (r1 - r0 + 1) * (c1 - c0 + 1) > len(self.cells):
+            for (r, c), bucket in self.cells.items():
+                if r0 <= r <= r1 and c0 <= c <= c1:
+                    found.extend(bucket)
+        else:
+            for r in range(r0, r1 + 1):
+                for c in range(c0, c1 + 1):
+                    bucket = self.cells.get((r, c))
+                    if bucket:
+                        found.extend(bucket)
+        return found
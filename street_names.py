@@ -0,0 +1,114 @@
+import pickle
+import re
+
+# Words the abbreviation table doesn't cover but the data sets spell both ways ("WEST 42 STREET", "W 42 ST")
+DIRECTIONS = {"NORTH": "N", "SOUTH": "S", "EAST": "E", "WEST": "W"}
+
+_TOKEN = re.compile(r"[A-Z0-9]+")
+_ORDINAL = re.compile(r"(\d+)(?:ST|ND|RD|TH)")
+
+
+class StreetNames():
+    """
+    Canonical form of street names. Every name is cut into words, every word of the abbreviation table (full
+    or abbreviated) is replaced by its abbreviation, ordinals lose their suffix and punctuation is dropped,
+    so "West 42nd Street", "W. 42 ST" and "W 42 St" are all "W 42 ST". A name is normalized in one pass over
+    its characters and one dict lookup per word, and results are memoized.
+
+    ===Attributes===
+    table: dict mapping every known word (uppercase) to its canonical word
+    """
+    table: dict
+
+    def __init__(self, abbr):
+        self.table = {}
+        for word, short in list(abbr.items()) + list(DIRECTIONS.items()):
+            word, short = word.upper(), short.upper()
+            self.table[word] = short
+            self.table.setdefault(short, short)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def _word(self, word):
+        ordinal = _ORDINAL.fullmatch(word)
+        if ordinal:
+            return ordinal.group(1)
+        return self.table.get(word, word)
+
+    def normalize(self, name):
+        """
+        Returns the canonical form of name, "" for None.
+
+        Parameters: (self, name)
+            name - string
+        """
+        canonical = self._cache.get(name)
+        if canonical is None:
+            words = _TOKEN.findall(str(name or "").upper().replace("'", ""))
+            canonical = self._cache[name] = " ".join(self._word(w) for w in words)
+        return canonical
+
+    def __call__(self, name):
+        return self.normalize(name)
+
+    def key(self, mapping):
+        """
+        Returns a dict with the keys of mapping replaced by their canonical form. When several names have the
+        same canonical form the last one wins.
+
+        Parameters: (self, mapping)
+            mapping - dict keyed by street name
+        """
+        return {self.normalize(name): value for name, value in mapping.items()}
+
+    def __getstate__(self):
+        return {"table": self.table}
+
+    def __setstate__(self, state):
+        self.table = state["table"]
+        self._cache = {}
+
+
+def read_abbreviations(path="abbr.txt"):
+    """
+    Returns a dict mapping every street term of path to its abbreviation, both uppercase.
+    Lines are "Word Abbr".
+
+    Parameters: (path)
+        path - string
+    """
+    abbr = {}
+    with open(path) as rFile:
+        for line in rFile:
+            words = line.split()
+            if len(words) >= 2:
+                abbr[words[0].upper()] = words[1].upper()
+    return abbr
+
+
+def load_street_names(path="abbr.txt", cache="abbr.pkl", reset=False):
+    """
+    Returns the StreetNames() of the abbreviations in path. The table is pickled in cache and only rebuilt
+    when it's missing, was saved by an older version or reset=True.
+
+    Parameters: (path, cache, reset)
+        path - string
+        cache - string
+        reset - bool
+    """
+    if not reset:
+        try:
+            with open(cache, 'rb') as names_file:
+                names = pickle.load(names_file)
+            if isinstance(names, StreetNames):
+                return names
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            pass
+    print("Loading abbreviations...")
+    names = StreetNames(read_abbreviations(path))
+    with open(cache, 'wb') as out:
+        pickle.dump(names, out)
+    print("Done.")
+    return names
@@ -1,29 +1,464 @@
 import io
+import math
+import os
 import sys
+import tempfile
+import time
+import random
+import numpy as np
 import astar
-from datetime import datetime
+from landmarks import compare
+import networkx as nx
+from datetime import datetime, timedelta
+from benchmark import grid_city, prepare
+from csr import CSRGraph
+from events import EventSimulation
+from live_traffic import apply_updates, refresh
+from request import Request
+from scheduling import Scheduling
+from vehicle import Vehicle
+from simplify import contract_chains
+from street_names import StreetNames
+from traffic import TrafficVolumes
 
 
 # Testing astar and timing some runs
 
-def no_plot_main():
-    G, trips = astar.load_data(reset=False, graph=False, trips=False, abbr=False)
+def no_plot_main(G):
     t = astar.random_trip(G)
     astar.process_trips(G, trips=[t], heuristic=astar.distm)
 
 
+def batch_routing(n, workers=None):
+    """
+    Routes the first n trips of the data set (random trips if there are fewer) with astar.route_trips and
+    prints the throughput and a summary of the results. The graph is loaded once.
+
+    Parameters: (n, workers)
+        n - int
+        workers - int, None for one per CPU
+    """
+    G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False)
+    batch = list(trips[:n])
+    batch += [astar.random_trip(G) for _ in range(n - len(batch))]
+    start = time.perf_counter()
+    results = astar.route_trips(G, batch, astar.default_heuristic(G), workers)
+    elapsed = time.perf_counter() - start
+    found = ~np.isnan(results["cost"])
+    print(f"Routed {n} trips in {elapsed:.2f}s ({n / elapsed:.1f} trips/s), {found.sum()} with a path")
+    if found.any():
+        print(f"Mean nodes: {results['nodes'][found].mean():.1f}, mean distance: "
+              f"{results['distance'][found].mean():.1f}m, mean time: {results['minutes'][found].mean():.2f}min")
+    return results
+
+
+def check_hierarchy(pairs):
+    """
+    Checks that contraction hierarchy queries give exactly the same cost and path as nx.astar_path
+    on random node pairs. Builds the hierarchy if graph/ch.npz is missing.
+
+    Parameters: (pairs)
+        pairs - int
+    """
+    G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False)
+    ch = G.graph["ch"]
+    if ch is None:
+        G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False, ch=True)
+        ch = G.graph["ch"]
+    nodes = list(G.nodes())
+    reference = G.to_networkx()
+    failed = 0
+    for i in range(pairs):
+        n1, n2 = random.choice(nodes), random.choice(nodes)
+        try:
+            path = nx.astar_path(reference, n1, n2)
+            expected = (nx.path_weight(reference, path, "weight"), path)
+        except nx.NetworkXNoPath:
+            expected = None
+        try:
+            result = ch.query_path(n1, n2)
+        except nx.NetworkXNoPath:
+            result = None
+        if result != expected:
+            failed += 1
+            print(f"Mismatch from {n1} to {n2}")
+    print(f"{pairs - failed}/{pairs} hierarchy queries match networkx")
+    return failed == 0
+
+
+def check_landmarks(pairs):
+    """
+    Compares the nodes settled per query with the ALT landmarks and with diste, and checks that the landmarks
+    find the same costs as Dijkstra. Builds the landmarks if graph/landmarks.npz is missing.
+
+    Parameters: (pairs)
+        pairs - int
+    """
+    G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False)
+    if G.graph["landmarks"] is None:
+        G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False, alt=True)
+    report = compare(G.graph["csr"], {"dijkstra": None, "diste": astar.diste, "alt": G.graph["landmarks"]}, pairs)
+    for name, (mean, median, wrong) in report.items():
+        print(f"{name}: {mean:.1f} settled on average, {median} median, {wrong} wrong costs")
+    return report["alt"][2] == 0
+
+
+
+# Checks on a synthetic grid (benchmark.grid_city) that run without the NYC data, with pytest or "test.py grid"
+
+def grid_graph(alt=False, ch=False, size=15):
+    """
+    Returns a small grid city without traffic, prepared like astar.load_data.
+
+    Parameters: (alt, ch, size)
+        alt - bool
+        ch - bool
+        size - int, rows and columns of the grid
+    """
+    return prepare(grid_city(size, size, traffic=False), alt=alt, ch=ch)
+
+
+def grid_pairs(G, pairs=100, seed=0):
+    """
+    Returns pairs random (node, node) pairs of G.
+    """
+    rng = random.Random(seed)
+    nodes = list(G.nodes())
+    return [(rng.choice(nodes), rng.choice(nodes)) for _ in range(pairs)]
+
+
+def test_csr_astar():
+    """
+    find_path on the CSR graph returns the same path as nx.astar_path with the same heuristic (same
+    tie-breaking) and, with an admissible heuristic, the cost of nx.dijkstra_path_length.
+    """
+    G = grid_graph()
+    reference = G.to_networkx()
+    for heuristic, admissible in ((None, True), (astar.diste, True), (astar.distm, False)):
+        # Routes are cached whatever the heuristic, every heuristic must search for itself here
+        G.graph["route_cache"].clear()
+        for n1, n2 in grid_pairs(G):
+            try:
+                expected = nx.astar_path(reference, n1, n2, heuristic)
+            except nx.NetworkXNoPath:
+                expected = None
+            try:
+                cost, path = astar.find_path(G, n1, n2, heuristic)
+            except nx.NetworkXNoPath:
+                cost = path = None
+            assert path == expected, (n1, n2)
+            if expected is not None:
+                assert cost == nx.path_weight(reference, path, "weight")
+                if admissible:
+                    assert math.isclose(cost, nx.dijkstra_path_length(reference, n1, n2), rel_tol=1e-12)
+
+
+def check_exact_costs(G, pairs=100, seed=0):
+    """
+    Asserts that the contraction hierarchy and A* with the landmarks of G find the Dijkstra cost of random
+    pairs and paths that cost what they claim.
+    """
+    reference = G.to_networkx()
+    ch, landmarks = G.graph["ch"], G.graph["landmarks"]
+    for n1, n2 in grid_pairs(G, pairs, seed):
+        try:
+            expected = nx.dijkstra_path_length(reference, n1, n2)
+        except nx.NetworkXNoPath:
+            expected = None
+        for route in (ch.query_path, lambda a, b: G.astar_path(a, b, landmarks)):
+            try:
+                cost, path = route(n1, n2)
+            except nx.NetworkXNoPath:
+                cost = path = None
+            assert (cost is None) == (expected is None), (n1, n2)
+            if cost is not None:
+                assert math.isclose(cost, expected, rel_tol=1e-9), (n1, n2)
+                assert math.isclose(nx.path_weight(reference, path, "weight"), cost, rel_tol=1e-9), (n1, n2)
+
+
+def test_ch_alt_exact():
+    """
+    Contraction hierarchy and ALT costs equal Dijkstra costs on a grid, and still do once updates that raise
+    and lower weights have been applied and the hierarchy and landmarks rebuilt.
+    """
+    G = grid_graph(alt=True, ch=True)
+    check_exact_costs(G)
+    slower = [(k, "speed", 5, None) for k in range(0, len(G.indices), 5)]
+    faster = [(k, "speed", 70, None) for k in range(2, len(G.indices), 5)]
+    assert apply_updates(G, slower + faster)["lowered"]
+    assert G.graph["landmarks"].stale and G.graph["ch"] is None
+    refresh(G, alt=True, ch=True)
+    assert not G.graph["landmarks"].stale and G.graph["ch"] is not None
+    check_exact_costs(G, seed=1)
+
+
+def test_simplified_costs():
+    """
+    Contracting the chains of degree 2 nodes keeps the static and hourly costs between the nodes kept, and the
+    expanded paths of the simplified graph are paths of the full graph with the same cost.
+    """
+    full = grid_city(15, 15, drop=0.3)
+    simple = contract_chains(full)
+    assert len(simple) < len(full)
+    kept = [full.ids[node] for node in simple.nodes]
+    for source in range(0, len(simple), 17):
+        for hour in (None, 8):
+            expected = full.dijkstra(kept[source], hour=hour)[0]
+            dist = simple.dijkstra(source, hour=hour)[0]
+            assert {kept[v] for v in dist} == set(expected).intersection(kept)
+            for v, cost in dist.items():
+                assert math.isclose(cost, expected[kept[v]], rel_tol=1e-9, abs_tol=1e-12)
+    for source in range(0, len(simple), 17):
+        target = (source * 7 + 11) % len(simple)
+        try:
+            cost, path = simple.astar_path(simple.nodes[source], simple.nodes[target])
+        except nx.NetworkXNoPath:
+            continue
+        expanded = [full.ids[node] for node in simple.expand_path(path)]
+        weights = [full._weight[full.edge(u, v)] for u, v in zip(expanded, expanded[1:])]
+        assert math.isclose(sum(weights), cost, rel_tol=1e-9, abs_tol=1e-12)
+
+
+def synthetic_map(path, features=60, seed=0):
+    """
+    Writes a shapefile of random streets (LineString and MultiLineString features) on a small lattice, so
+    they cross and share segments, with the st_label and shape_leng properties of the NYC map.
+    """
+    import fiona
+    rng = random.Random(seed)
+    schema = {"geometry": "Unknown", "properties": {"st_label": "str", "shape_leng": "float"}}
+
+    def line():
+        x, y = rng.randrange(8), rng.randrange(8)
+        points = [(x, y)]
+        for _ in range(rng.randrange(1, 5)):
+            x, y = (x + 1, y) if rng.random() < 0.5 else (x, y + 1)
+            points.append((x, y))
+        return [(-74.0 + 0.001 * x, 40.7 + 0.001 * y) for x, y in points]
+
+    with fiona.open(path, "w", driver="ESRI Shapefile", schema=schema) as out:
+        for i in range(features):
+            if i % 5 == 4:
+                geometry = {"type": "MultiLineString", "coordinates": [line(), line()]}
+            else:
+                geometry = {"type": "LineString", "coordinates": line()}
+            out.write({"geometry": geometry,
+                       "properties": {"st_label": ("BROADWAY", "MAIN ST", "1 AVE")[i % 3], "shape_leng": 100.0 + i}})
+
+
+def serial_graph(path, names, speeds, traffic_volumes):
+    """
+    Builds the networkx graph of a map one segment at a time like pickle_graph did before build_graph, the parts
+    of a MultiLineString one after the other.
+    """
+    import fiona
+    from shapely.geometry import shape
+    G = nx.Graph()
+    for feature in fiona.open(path):
+        geometry = shape(feature["geometry"])
+        street = names.normalize(feature["properties"]["st_label"])
+        divider = speeds.get(street, 0) or 25
+        for part in getattr(geometry, "geoms", [geometry]):
+            coords = list(part.coords)
+            for s, e in zip(coords, coords[1:]):
+                s, e = (s[1], s[0]), (e[1], e[0])
+                if street in traffic_volumes:
+                    volume = int(traffic_volumes[street].mean())
+                    w = float(astar.reweight(np.array([s]), np.array([e]), divider, np.array([volume]))[0])
+                else:
+                    w = float(astar.weight(s, e, divider))
+                G.add_edge(s, e, weight=w, distance=feature["properties"]["shape_leng"],
+                           speed=divider / 3600 * 1609)
+    return G
+
+
+def test_parallel_build():
+    """
+    The graph build_graph makes from a map, in one process or in a pool, is the graph of the serial networkx
+    build, MultiLineString features included.
+    """
+    names = StreetNames({"AVENUE": "AVE", "STREET": "ST"})
+    speeds = {"BROADWAY": 30, "MAIN ST": 0}
+    traffic_volumes = TrafficVolumes(["1 AVE"], np.linspace(100, 800, 24, dtype=np.float32), [1])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "map.shp")
+        synthetic_map(path)
+        expected = CSRGraph.from_networkx(serial_graph(path, names, speeds, traffic_volumes))
+        for workers in (1, 2):
+            csr = astar.build_graph(path, names, speeds, traffic_volumes, workers, chunk=7)[0]
+            assert np.array_equal(csr.coords, expected.coords)
+            assert np.array_equal(csr.indptr, expected.indptr) and np.array_equal(csr.indices, expected.indices)
+            for name in ("weight", "distance", "speed"):
+                assert np.allclose(getattr(csr, name), getattr(expected, name), rtol=1e-12), name
+
+
+def test_live_hour_decrease():
+    """
+    Raising the volume of one off-peak hour lowers the static weight and that hour's weight but not the lowest
+    weight of the day, the routes cached before must still be dropped so find_path matches Dijkstra.
+    """
+    G = prepare(grid_city(12, 12))
+    depart = datetime(2015, 1, 1, 2, 0)
+    pairs = grid_pairs(G, 60)
+    for n1, n2 in pairs:
+        for hour in (None, depart):
+            try:
+                astar.find_path(G, n1, n2, None, hour)
+            except nx.NetworkXNoPath:
+                pass
+    # Busier than the hour itself, still quieter than the peak
+    peak = np.asarray(G.volume).max(axis=1)
+    busier = [(k, "volume", 0.9 * peak[k], 2) for k in range(0, len(G.indices), 3)]
+    result = apply_updates(G, busier)
+    assert result["decreased"] and not result["lowered"]
+    for n1, n2 in pairs:
+        for hour in (None, depart):
+            try:
+                expected = G.astar_path(n1, n2, None, hour)[0]
+            except nx.NetworkXNoPath:
+                expected = None
+            try:
+                cost = astar.find_path(G, n1, n2, None, hour)[0]
+            except nx.NetworkXNoPath:
+                cost = None
+            assert cost == expected, (n1, n2, hour)
+
+
+def test_live_refresh():
+    """
+    A live update that lowers weights makes the landmarks stale and drops the hierarchy. With refresh the
+    simulation rebuilds the landmarks so routing after the update is still guided by the heuristic, A* answers
+    exactly while the hierarchy is dropped, and refresh_ch rebuilds the hierarchy too.
+    """
+    G = grid_graph(alt=True, ch=True)
+    landmarks = G.graph["landmarks"]
+    start = datetime(2015, 1, 1)
+    faster = [(k, "speed", 60, None) for k in range(0, len(G.indices), 7)]
+    simulation = EventSimulation(Scheduling(G), [], start, start + timedelta(hours=1), landmarks,
+                                 feed=[(start, faster)], refresh=1)
+    simulation.run()
+    assert simulation.updates == 1 and G.graph["stale"] == {"ch"}
+    assert not landmarks.stale and G.graph["ch"] is None
+    target = len(G) - 1
+    cost = G.astar(0, target)[0]
+    settled = G.settled
+    assert G.astar(0, target, landmarks)[0] == cost and G.settled < settled
+    assert astar.find_path(G, G.nodes[0], G.nodes[target], landmarks)[0] == cost
+
+    fastest = [(k, "speed", 65, None) for k in range(3, len(G.indices), 7)]
+    simulation = EventSimulation(Scheduling(G), [], start, start + timedelta(hours=1), landmarks,
+                                 feed=[(start, fastest)], refresh=1, refresh_ch=1)
+    simulation.run()
+    assert not G.graph["stale"] and not landmarks.stale and G.graph["ch"] is not None
+    assert G.graph["ch"].query(0, target)[0] == G.astar(0, target)[0]
+
+
+def tick_loop(scheduling, trips, start, end, heuristic):
+    """
+    The loop simulation.py ran before EventSimulation: every second from start to end, trips are assigned (or
+    buffered) at their pickup time, due batches are dispatched and the fleet moves 5 seconds every 5 seconds.
+    Returns the number of rejected trips.
+    """
+    time, rejected, t, interval = start, 0, 0, 1
+    while time < end:
+        while t < len(trips):
+            if time == trips[t].pickup_time:
+                if scheduling.batch_window is not None:
+                    scheduling.add_request(trips[t])
+                elif not scheduling.find_assign_trip(trips[t], heuristic):
+                    rejected += 1
+                t += 1
+            elif time > trips[t].pickup_time:
+                t += 1
+                rejected += 1
+            else:
+                break
+        if scheduling.batch_window is not None and scheduling.batch_due(time):
+            rejected += scheduling.dispatch_batch(heuristic)[1]
+        interval += 1
+        if interval == 5:
+            scheduling.move(5)
+            interval = 0
+        time += timedelta(seconds=1)
+    if scheduling.pending:
+        rejected += scheduling.dispatch_batch(heuristic)[1]
+    return rejected
+
+
+def test_events_match_ticks():
+    """
+    EventSimulation makes the same assignments and leaves the vehicles at the same positions as the tick loop,
+    one request at a time and in batches.
+    """
+    G = grid_graph()
+    rng = random.Random(0)
+    nodes = list(G.nodes())
+    start = datetime(2015, 1, 1)
+    end = start + timedelta(hours=1)
+    positions = [rng.choice(nodes) for _ in range(8)]
+    trips = sorted([(start + timedelta(seconds=rng.randrange(1200)), rng.choice(nodes), rng.choice(nodes))
+                    for _ in range(30)], key=lambda trip: trip[0])
+
+    def run(loop, batch_window):
+        G.graph["route_cache"].clear()
+        scheduling = Scheduling(G, batch_window=batch_window)
+        for i, position in enumerate(positions):
+            scheduling.add_vehicle(Vehicle(position, 40.0, 10.0, 20, True, 4, i))
+        requests = [Request(a, b, 0, 1, time) for time, a, b in trips]
+        if loop == "ticks":
+            rejected = tick_loop(scheduling, requests, start, end, astar.diste)
+        else:
+            rejected = EventSimulation(scheduling, requests, start, end, astar.diste).run()
+        logs = [[(trip["start_time"], trip["starting"], trip["ending"]) for trip in v.log + v.trips]
+                for v in scheduling.vehicles]
+        return rejected, logs, [tuple(v.position) for v in scheduling.vehicles]
+
+    for batch_window in (None, 30):
+        expected = run("ticks", batch_window)
+        assert expected[0] < len(trips) and any(expected[1])
+        assert run("events", batch_window) == expected
+
+
+def run_grid_checks():
+    """
+    Runs every test_ function of this file and returns True if they all pass.
+    """
+    failed = 0
+    for name, check in list(globals().items()):
+        if name.startswith("test_") and callable(check):
+            try:
+                check()
+                print(f"{name}: ok")
+            except AssertionError:
+                failed += 1
+                print(f"{name}: FAILED")
+    return failed == 0
+
+
 if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "ch":
+        exit(0 if check_hierarchy(int(sys.argv[2])) else 1)
+    if len(sys.argv) == 3 and sys.argv[1] == "alt":
+        exit(0 if check_landmarks(int(sys.argv[2])) else 1)
+    if len(sys.argv) == 2 and sys.argv[1] == "grid":
+        exit(0 if run_grid_checks() else 1)
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "batch":
+        batch_routing(int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) == 4 else None)
+        exit()
     if len(sys.argv) != 3:
-        print("Usage: test.py [# of test runs] [output file name]")
+        print("Usage: test.py [# of test runs] [output file name]\n       test.py ch [# of node pairs]\n"
+              "       test.py alt [# of node pairs]\n       test.py grid\n"
+              "       test.py batch [# of trips] [# of workers]")
         exit()
 
+    G, trips = astar.load_data(reset=False, graph=False, trip=False, abbr=False)
     original_stdout = sys.stdout
     sys.stdout = open(sys.argv[2], 'w')
 
     for i in range(int(sys.argv[1])):
         print("STARTING TRIP %d" % i)
         start = datetime.now()
-        no_plot_main()
+        no_plot_main(G)
         end = datetime.now()
         print("Time:", end - start)
         print("DONE TRIP %d" % i)
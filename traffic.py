@@ -1,67 +1,143 @@
 import csv
 import matplotlib.pyplot as plt
 import networkx as nx
+import numpy as np
 
 
-def process_traffic(path):
+HOURS = 24
+
+
+class TrafficVolumes():
+    """
+    Hourly traffic volume of every street of the traffic counts, one row per street.
+
+    ===Attributes===
+    names: list of street names, names[row]
+    rows: dict mapping every street name to its row
+    volume: float32 array (S, 24), volume of every street at every hour (0 for hours without counts)
+    counts: int64 array (S), number of count rows averaged into every street
+    """
+    names: list
+    rows: dict
+    volume: np.ndarray
+    counts: np.ndarray
+
+    def __init__(self, names, volume, counts):
+        self.names = list(names)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.volume = np.asarray(volume, dtype=np.float32).reshape(-1, HOURS)
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return self.volume[self.rows[name]]
+
+    def get(self, name):
+        """
+        Returns the float32 array (24) of volumes of the street name, None if it has no counts.
+
+        Parameters: (self, name)
+            name - string
+        """
+        row = self.rows.get(name)
+        return None if row is None else self.volume[row]
+
+    def lookup(self, names):
+        """
+        Returns an int64 array with the row of every name, -1 for streets without counts.
+
+        Parameters: (self, names)
+            names - list of strings
+        """
+        return np.array([self.rows.get(name, -1) for name in names], dtype=np.int64)
+
+
+def process_traffic(path, names=None, statistic="mean"):
     """
     Process the given clean Traffic Data file.
-    Returns dictionary of street names, with list of traffic volume throughout a 24HR period. 
+    Returns the TrafficVolumes() of every street throughout a 24HR period.
 
-    Duplicate keys are merged and corresponding values averaged according to time.
+    Rows of the same street are reduced hour by hour with statistic.
 
-    Parameters: (path)
+    Parameters: (path, names, statistic)
     path - string
+    names - StreetNames() used to key the streets by their canonical name, None to keep them uppercase
+    statistic - "mean", "median" or a percentile between 0 and 100
     """
-    return extract_data(path)
+    roadways, counts = extract_data(path)
+    return group_volumes(roadways, counts, names, statistic)
 
 
 def extract_data(path):
     """
     ******Reads manually formatted files**********
     Given clean CSV in format: Roadway Name, Traffic Data per hour (24 HR TIME, 24 HRS)
-    Returns a dictionary in the format: {'Roadway_Name': ['Traffic Figures from 0-23 HR']}
-    
-    Duplicate keys, value pairs are merged and averaged.
+    Returns (roadways, counts): the list of roadway names and a float64 array (rows, 24) of the counts
+    from 0-23 HR, nan for blank counts.
 
     Parameters: (path)
     path - string
     """
-    traffic = {}
-    with open(path, newline='') as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            row[0] = row[0].upper()
-            if (row[0]) not in traffic:
-                traffic[row[0]] = row[1:]
-            else:
-                old_list = traffic[row[0]]
-                new_values = row[1:]
-                traffic[row[0]] = merge_lists(old_list, new_values)
-
-    del traffic['ROADWAY NAME']
-    return traffic
-
-
-def merge_lists(old_list, new_list):
+    hours = range(1, HOURS + 1)
+    roadways = np.loadtxt(path, delimiter=",", skiprows=1, usecols=0, dtype=str, quotechar='"', ndmin=1)
+    try:
+        counts = np.loadtxt(path, delimiter=",", skiprows=1, usecols=hours, quotechar='"', ndmin=2)
+    except ValueError:
+        # Blank counts, parsed value by value
+        counts = np.loadtxt(path, delimiter=",", skiprows=1, usecols=hours, quotechar='"', ndmin=2,
+                            converters=lambda value: float(value) if value.strip() else np.nan)
+    return roadways.tolist(), counts.reshape(-1, HOURS)
+
+
+def group_volumes(roadways, counts, names=None, statistic="mean"):
     """
-    Returns an averaged list of traffic values in a 24HR window, given two lists. 
-
-    Parameters: (old_list, new_list)
-    old_list = list
-    new_list = list    
+    Returns the TrafficVolumes() of counts grouped by street. The rows of every street are reduced hour by hour
+    with statistic, ignoring blank (nan) counts, so the result doesn't depend on the order of the rows.
+    Hours without any count are 0.
+
+    Parameters: (roadways, counts, names, statistic)
+    roadways - list of strings, street of every row of counts
+    counts - float64 array (rows, 24)
+    names - StreetNames(), None to only uppercase the names
+    statistic - "mean", "median" or a percentile between 0 and 100
     """
-    final = []
-    for i in range(24):
-        if not old_list[i]:
-            old_list[i] = 0
-        if not new_list[i]:
-            new_list[i] = 0
-
-        x = (int(old_list[i]) + int(new_list[i]))
-        final.append(x // 2)
-
-    return final
+    keys = np.array([names.normalize(r) if names is not None else r.upper() for r in roadways], dtype=str)
+    streets, group = np.unique(keys, return_inverse=True)
+    group = group.reshape(-1)
+    counts = np.asarray(counts, dtype=np.float64).reshape(-1, HOURS)
+    valid = ~np.isnan(counts)
+    n = np.zeros((len(streets), HOURS))
+    np.add.at(n, group, valid)
+
+    if statistic == "mean":
+        total = np.zeros((len(streets), HOURS))
+        np.add.at(total, group, np.where(valid, counts, 0))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            volume = total / n
+    else:
+        q = 50.0 if statistic == "median" else float(statistic)
+        if not 0 <= q <= 100:
+            raise ValueError(f"Unknown traffic statistic {statistic}")
+        # Sort every hour by (street, count), blanks last within a street, and interpolate between the two
+        # ranks around the percentile like np.percentile
+        starts = np.zeros(len(streets), dtype=np.int64)
+        np.cumsum(np.bincount(group, minlength=len(streets))[:-1], out=starts[1:])
+        keyed = np.where(valid, counts, np.inf)
+        order = np.lexsort((keyed, np.broadcast_to(group[:, np.newaxis], counts.shape)), axis=0)
+        ordered = np.take_along_axis(keyed, order, axis=0)
+        rank = (n - 1).clip(min=0) * q / 100
+        lo = starts[:, np.newaxis] + np.floor(rank).astype(np.int64)
+        hi = starts[:, np.newaxis] + np.ceil(rank).astype(np.int64)
+        a, b = ordered[lo, np.arange(HOURS)], ordered[hi, np.arange(HOURS)]
+        with np.errstate(invalid="ignore"):
+            volume = a + (b - a) * (rank - np.floor(rank))
+    volume = np.where(n > 0, volume, 0)
+    return TrafficVolumes([str(s) for s in streets], volume, np.bincount(group, minlength=len(streets)))
 
 
 def clean_data(path):
@@ -0,0 +1,130 @@
+import numpy as np
+import astar
+from csr import CSRGraph, seconds_of_day
+
+
+def routing_graph(G):
+    """
+    Returns the CSR copy of G used for routing, building and caching it in G.graph["csr"] if needed.
+
+    Parameters: (G)
+        G - networkx.graph()
+    """
+    if G.graph.get("csr") is None:
+        G.graph["csr"] = CSRGraph.from_networkx(G)
+    return G.graph["csr"]
+
+
+def node_ids(G, points):
+    """
+    Returns a list with the CSR id of every point. Points that aren't nodes are snapped to the closest node.
+
+    Parameters: (G, points)
+        G - networkx.graph()
+        points - list of (lat, lon) or float array (K, 2)
+    """
+    csr = routing_graph(G)
+    ids = []
+    for p in points:
+        p = (float(p[0]), float(p[1]))
+        if p not in csr.ids:
+            p = astar.find_closest_node(G, p)
+        ids.append(csr.ids[p])
+    return ids
+
+
+def road_distance(csr, path):
+    """
+    Returns the road distance in metres of a path of ids. Like admission_control.get_distance, edges with the
+    exact same distance are only counted once.
+
+    Parameters: (csr, path)
+        csr - CSRGraph()
+        path - list of ids
+    """
+    distances = {}
+    for u, v in zip(path, path[1:]):
+        distances[csr.distance[csr.edge(u, v)]] = True
+    return round(sum(distances) * 0.3048, 2)
+
+
+def _tree_path(parent, node):
+    """
+    Returns the ids from node to the root of a Dijkstra parent tree.
+    """
+    path = [node]
+    while parent[node] != -1:
+        node = parent[node]
+        path.append(node)
+    return path
+
+
+def travel_time_matrix(G, sources, targets, distances=False, cutoff=None, depart=None):
+    """
+    Returns a (len(sources), len(targets)) float array of shortest path costs (weight attribute), inf when
+    there is no path. If distances=True also returns the road distance matrix in metres.
+
+    One search is run per node on the smaller side, reversed from the targets when there are fewer of them,
+    and every search stops once all the nodes on the other side are settled or the cost goes over cutoff.
+    Many-to-many requests use bucket queries on the contraction hierarchy when G.graph["ch"] is loaded.
+    If depart is given and the graph has hourly volumes, the weights of the hour of depart are used for the
+    whole matrix (reversed searches can't know when an edge is entered) and the hierarchy is skipped.
+
+    Parameters: (G, sources, targets, distances, cutoff, depart)
+        G - networkx.graph()
+        sources - list of (lat, lon) or float array (S, 2)
+        targets - list of (lat, lon) or float array (T, 2)
+        distances - bool
+        cutoff - float
+        depart - datetime, None for the static weights
+    """
+    csr = routing_graph(G)
+    src = node_ids(G, sources)
+    dst = node_ids(G, targets)
+    costs = np.full((len(src), len(dst)), np.inf)
+    dist = np.full((len(src), len(dst)), np.inf) if distances else None
+    ch = G.graph.get("ch")
+    hour = None
+    if depart is not None and csr.volume is not None:
+        hour = int(seconds_of_day(depart) // 3600)
+        ch = None
+
+    if len(src) > 1 and len(dst) > 1 and ch is not None:
+        buckets = {}
+        for j, t in enumerate(dst):
+            for v, c in ch.upward(t).items():
+                buckets.setdefault(v, []).append((j, c))
+        for i, s in enumerate(src):
+            row = costs[i]
+            for v, c in ch.upward(s).items():
+                for j, c2 in buckets.get(v, ()):
+                    if c + c2 < row[j]:
+                        row[j] = c + c2
+        if cutoff is not None:
+            costs[costs > cutoff] = np.inf
+        if distances:
+            for i, j in zip(*np.nonzero(np.isfinite(costs))):
+                dist[i, j] = road_distance(csr, ch.query(src[i], dst[j])[1])
+    elif len(dst) <= len(src):
+        for j, t in enumerate(dst):
+            # Nodes of other components would never be settled and keep the search going
+            reachable = [s for s in src if csr.connected(s, t)]
+            settled, parent = csr.dijkstra(t, cutoff=cutoff, targets=reachable, hour=hour)
+            for i, s in enumerate(src):
+                if s in settled:
+                    costs[i, j] = settled[s]
+                    if distances:
+                        dist[i, j] = road_distance(csr, _tree_path(parent, s))
+    else:
+        for i, s in enumerate(src):
+            reachable = [t for t in dst if csr.connected(s, t)]
+            settled, parent = csr.dijkstra(s, cutoff=cutoff, targets=reachable, hour=hour)
+            for j, t in enumerate(dst):
+                if t in settled:
+                    costs[i, j] = settled[t]
+                    if distances:
+                        dist[i, j] = road_distance(csr, _tree_path(parent, t)[::-1])
+
+    if distances:
+        return costs, dist
+    return costs
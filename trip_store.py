@@ -0,0 +1,281 @@
+import os
+from copy import copy
+from itertools import islice
+import numpy as np
+from request import Request
+
+# Columnar on-disk store for the taxi trips. A store is a directory with:
+#   nodes.npy       float64 (N, 2), coordinates of the nodes the trips are snapped to
+#   chunks.npy      int64 (C, 3), (rows, first pickup, last pickup) of every chunk, times in epoch seconds
+#   chunk_XXXXX.npy structured array of TRIP_DTYPE, one file per chunk
+# Chunks are sorted by pickup time internally and are loaded with mmap_mode="r".
+
+TRIP_DTYPE = np.dtype([("pickup_time", "<i8"), ("pickup", "<i4"), ("dropoff", "<i4"), ("seats", "<i2")])
+COLUMNS = ("tpep_pickup_datetime", "passenger_count", "pickup_latitude", "pickup_longitude",
+           "dropoff_latitude", "dropoff_longitude")
+
+
+def _parse_chunk(lines, positions):
+    """
+    Returns (times, seats, pickups, dropoffs) numpy columns for a list of CSV lines. Rows that can't be parsed
+    are dropped.
+
+    Parameters: (lines, positions)
+        lines - list of strings
+        positions - list of the column number of every name in COLUMNS
+    """
+    rows = [line.rstrip("\n").split(",") for line in lines]
+    width = max(positions) + 1
+    rows = [row for row in rows if len(row) >= width]
+    try:
+        cols = [[row[p] for row in rows] for p in positions]
+        times = np.array(cols[0], dtype="datetime64[s]").astype(np.int64)
+        seats = np.array(cols[1], dtype=np.float64).astype(np.int16)
+        coords = np.array(cols[2:], dtype=np.float64).T
+    except ValueError:
+        # Fall back to row by row parsing to skip the bad rows
+        good = []
+        for row in rows:
+            try:
+                good.append((np.datetime64(row[positions[0]], "s").astype(np.int64), int(float(row[positions[1]])))
+                            + tuple(float(row[p]) for p in positions[2:]))
+            except ValueError:
+                continue
+        table = np.array(good, dtype=np.float64).reshape(-1, 6)
+        times = table[:, 0].astype(np.int64)
+        seats = table[:, 1].astype(np.int16)
+        coords = table[:, 2:]
+    return times, seats, coords[:, 0:2], coords[:, 2:4]
+
+
+def ingest_trips(G, csv_path="NYC/2015_taxi_data.csv", path="trips", chunk_rows=1000000, limit=None, margin=0.05):
+    """
+    Streams the taxi CSV into a trip store. The file is read chunk_rows lines at a time, parsed into typed
+    columns and every pickup and dropoff of a chunk is snapped in one batch with the spatial index.
+    Trips with a pickup or dropoff more than margin degrees outside the map (like the 0, 0 rows) are dropped.
+    Returns the TripStore.
+
+    Parameters: (G, csv_path, path, chunk_rows, limit, margin)
+        G - networkx.graph() with G.graph["index"]
+        csv_path - string
+        path - string, directory of the store
+        chunk_rows - int
+        limit - int, most trips to load (None for all)
+        margin - float (degrees)
+    """
+    index = G.graph["index"]
+    lo = index.coords.min(axis=0) - margin
+    hi = index.coords.max(axis=0) + margin
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.startswith("chunk_"):
+            os.remove(os.path.join(path, name))
+    np.save(os.path.join(path, "nodes.npy"), index.coords)
+
+    chunks = []
+    total = 0
+    with open(csv_path) as rFile:
+        header = rFile.readline().rstrip("\n").split(",")
+        positions = [header.index(name) for name in COLUMNS]
+        while limit is None or total < limit:
+            size = chunk_rows if limit is None else min(chunk_rows, limit - total)
+            lines = list(islice(rFile, size))
+            if not lines:
+                break
+            times, seats, pickups, dropoffs = _parse_chunk(lines, positions)
+            inside = (np.all((pickups >= lo) & (pickups <= hi), axis=1)
+                      & np.all((dropoffs >= lo) & (dropoffs <= hi), axis=1))
+            times, seats, pickups, dropoffs = times[inside], seats[inside], pickups[inside], dropoffs[inside]
+            if not len(times):
+                continue
+
+            chunk = np.empty(len(times), dtype=TRIP_DTYPE)
+            chunk["pickup_time"] = times
+            chunk["seats"] = seats
+            snapped = index.nearest_index(np.concatenate([pickups, dropoffs]))
+            chunk["pickup"] = snapped[:len(times)]
+            chunk["dropoff"] = snapped[len(times):]
+            chunk = chunk[np.argsort(chunk["pickup_time"], kind="stable")]
+            np.save(os.path.join(path, "chunk_%05d.npy" % len(chunks)), chunk)
+            chunks.append((len(chunk), chunk["pickup_time"][0], chunk["pickup_time"][-1]))
+            total += len(chunk)
+            print("Loaded " + str(total) + " trips.")
+
+    np.save(os.path.join(path, "chunks.npy"), np.array(chunks, dtype=np.int64).reshape(-1, 3))
+    return TripStore(path)
+
+
+def snap_store(store, index, path):
+    """
+    Returns a copy of store saved in path with every trip snapped to the nearest node of index, for a graph other
+    than the one the store was ingested for (like the simplified graph). The trips are moved from the node they
+    were snapped to, so the CSV isn't read again. The copy in path is reused if it was made for the same nodes.
+
+    Parameters: (store, index, path)
+        store - TripStore()
+        index - spatial_index.SpatialIndex() of the graph
+        path - string, directory of the copy
+    """
+    try:
+        snapped = TripStore(path)
+        if np.array_equal(snapped.nodes, index.coords) and np.array_equal(snapped.chunks, store.chunks):
+            return snapped
+    except (OSError, ValueError):
+        pass
+    print("Snapping trips to the graph...")
+    nearest = index.nearest_index(store.nodes)
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        if name.startswith("chunk_"):
+            os.remove(os.path.join(path, name))
+    np.save(os.path.join(path, "nodes.npy"), index.coords)
+    for c in range(len(store.chunks)):
+        chunk = np.array(store.chunk(c))
+        chunk["pickup"] = nearest[chunk["pickup"]]
+        chunk["dropoff"] = nearest[chunk["dropoff"]]
+        np.save(os.path.join(path, "chunk_%05d.npy" % c), chunk)
+    np.save(os.path.join(path, "chunks.npy"), store.chunks)
+    print("Done.")
+    return TripStore(path)
+
+
+def snap_requests(trips, index):
+    """
+    Returns copies of the Request() in trips with their start and stop moved to the nearest node of index.
+
+    Parameters: (trips, index)
+        trips - list of Request()
+        index - spatial_index.SpatialIndex() of the graph
+    """
+    if not trips:
+        return list(trips)
+    nodes = index.nearest_many(np.array([p for t in trips for p in (t.start, t.stop)], dtype=np.float64))
+    snapped = []
+    for i, trip in enumerate(trips):
+        trip = copy(trip)
+        trip.start, trip.stop = nodes[2 * i], nodes[2 * i + 1]
+        snapped.append(trip)
+    return snapped
+
+
+class TripStore():
+    """
+    Read only view of a trip store written by ingest_trips. Chunks are memory mapped and Request() objects are
+    only created for the trips that are asked for. Indexing follows the order of the chunks, so store[:n] is
+    the first n trips like the old trips list.
+
+    ===Attributes===
+    path: directory of the store
+    nodes: float64 array (N, 2), coordinates of the nodes trips are snapped to
+    chunks: int64 array (C, 3), (rows, first pickup, last pickup) of every chunk
+    offsets: int64 array (C + 1), index of the first trip of every chunk
+    """
+    path: str
+    nodes: np.ndarray
+    chunks: np.ndarray
+    offsets: np.ndarray
+
+    def __init__(self, path="trips"):
+        self.path = path
+        self.nodes = np.load(os.path.join(path, "nodes.npy"))
+        self.chunks = np.load(os.path.join(path, "chunks.npy")).reshape(-1, 3)
+        self.offsets = np.zeros(len(self.chunks) + 1, dtype=np.int64)
+        np.cumsum(self.chunks[:, 0], out=self.offsets[1:])
+        self._cache = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def chunk(self, c):
+        """
+        Returns the structured array of chunk c, memory mapped.
+
+        Parameters: (self, c)
+            c - int
+        """
+        if c not in self._cache:
+            self._cache[c] = np.load(os.path.join(self.path, "chunk_%05d.npy" % c), mmap_mode="r")
+        return self._cache[c]
+
+    def rows(self, start=0, stop=None):
+        """
+        Returns a structured array with the trips [start, stop).
+
+        Parameters: (self, start, stop)
+            start - int
+            stop - int
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        for c in range(len(self.chunks)):
+            lo, hi = max(start, self.offsets[c]), min(stop, self.offsets[c + 1])
+            if lo < hi:
+                parts.append(self.chunk(c)[lo - self.offsets[c]:hi - self.offsets[c]])
+        return np.concatenate(parts) if parts else np.empty(0, dtype=TRIP_DTYPE)
+
+    def requests(self, rows):
+        """
+        Returns a list of Request() for a structured array of trips.
+
+        Parameters: (self, rows)
+            rows - structured array of TRIP_DTYPE
+        """
+        pickups = self.nodes[rows["pickup"]].tolist()
+        dropoffs = self.nodes[rows["dropoff"]].tolist()
+        times = rows["pickup_time"].astype("datetime64[s]").tolist()
+        return [Request(tuple(p), tuple(d), 0, int(s), t)
+                for p, d, s, t in zip(pickups, dropoffs, rows["seats"].tolist(), times)]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self.requests(self.rows(start, stop))[::step]
+            return self.requests(self.rows(start, stop))
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("trip index out of range")
+        return self.requests(self.rows(key, key + 1))[0]
+
+    def __iter__(self):
+        for c in range(len(self.chunks)):
+            yield from self.requests(self.chunk(c))
+
+    def between(self, start, end):
+        """
+        Returns a structured array with the trips picked up in [start, end), sorted by pickup time. Only the
+        chunks whose time range overlaps are read.
+
+        Parameters: (self, start, end)
+            start - datetime
+            end - datetime
+        """
+        lo = np.datetime64(start, "s").astype(np.int64)
+        hi = np.datetime64(end, "s").astype(np.int64)
+        parts = []
+        for c in np.flatnonzero((self.chunks[:, 1] < hi) & (self.chunks[:, 2] >= lo)).tolist():
+            times = self.chunk(c)["pickup_time"]
+            parts.append(self.chunk(c)[np.searchsorted(times, lo):np.searchsorted(times, hi)])
+        if not parts:
+            return np.empty(0, dtype=TRIP_DTYPE)
+        rows = np.concatenate(parts)
+        return rows[np.argsort(rows["pickup_time"], kind="stable")]
+
+    def iter_between(self, start, end, window=3600):
+        """
+        Yields Request() for the trips picked up in [start, end) in pickup time order, window seconds of trips
+        at a time so only one window is in memory.
+
+        Parameters: (self, start, end, window)
+            start - datetime
+            end - datetime
+            window - int (seconds)
+        """
+        step = np.timedelta64(window, "s")
+        lo = np.datetime64(start, "s")
+        hi = np.datetime64(end, "s")
+        while lo < hi:
+            yield from self.requests(self.between(lo.item(), min(lo + step, hi).item()))
+            lo += step
+
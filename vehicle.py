@@ -1,4 +1,4 @@
-from astar import diste, print_trip_info, find_closest_node, draw_graph, distance_to_meters
+from astar import diste, print_trip_info, find_closest_node, find_path, draw_graph, distance_to_meters
 import networkx as nx
 import math
 import matplotlib.pyplot as plt
@@ -21,6 +21,8 @@ class Vehicle():
     seats: the number of seats in the vehicle
     trips: list of trip dictionaries (keys: "starting", "ending", "path")
     id: number representing the vehicle
+    fleet: Fleet() storing the position and availability of the vehicle, None if it is stored here
+    row: row of the vehicle in fleet
     """
     position: tuple
     maximum_speed: int
@@ -34,8 +36,12 @@ class Vehicle():
     log: list
     temp_path: list
     id: int
+    fleet: object
+    row: int
 
     def __init__(self, position, maximum_speed, fuel, current_speed, available, seats, id=0):
+        self.fleet = None
+        self.row = -1
         self.position = position
         self.maximum_speed = maximum_speed
         self.fuel = fuel
@@ -49,6 +55,32 @@ class Vehicle():
         self.temp_path = []
         self.id = id
 
+    @property
+    def position(self):
+        if self.fleet is not None:
+            return tuple(self.fleet.position[self.row].tolist())
+        return self._position
+
+    @position.setter
+    def position(self, position):
+        if self.fleet is not None:
+            self.fleet.set_position(self.row, position)
+        else:
+            self._position = position
+
+    @property
+    def available(self):
+        if self.fleet is not None:
+            return bool(self.fleet.available[self.row])
+        return self._available
+
+    @available.setter
+    def available(self, available):
+        if self.fleet is not None:
+            self.fleet.set_available(self.row, available)
+        else:
+            self._available = available
+
     def is_available(self):
         """
         Return self.available.
@@ -74,7 +106,7 @@ class Vehicle():
             closest_intersection_to_pos = find_closest_node(G, self.position)
             closest_intersection_to_p = find_closest_node(G, p)
             try:
-                path = nx.astar_path(G, closest_intersection_to_pos, closest_intersection_to_p, heuristic)
+                path = find_path(G, closest_intersection_to_pos, closest_intersection_to_p, heuristic)[1]
                 return print_trip_info(closest_intersection_to_pos, closest_intersection_to_p, path, G)[2]
             except:
                 print("No path")
@@ -95,12 +127,14 @@ class Vehicle():
         closest_intersection_to_pos = find_closest_node(G, self.position)
         closest_intersection_to_starting = find_closest_node(G, starting)
         closest_intersection_to_ending = find_closest_node(G, ending)
-        trip = {"starting": starting, "ending": ending, "start_time": time, "end_time": time, "path": nx.astar_path(G, closest_intersection_to_pos, closest_intersection_to_starting, heuristic)[:-1] + nx.astar_path(G, closest_intersection_to_starting, closest_intersection_to_ending, heuristic)}
+        trip = {"starting": starting, "ending": ending, "start_time": time, "end_time": time, "path": find_path(G, closest_intersection_to_pos, closest_intersection_to_starting, heuristic, time)[1][:-1] + find_path(G, closest_intersection_to_starting, closest_intersection_to_ending, heuristic, time)[1]}
         self.trips.append(trip)
         print_trip_info(closest_intersection_to_pos, closest_intersection_to_ending, self.trips[0]["path"], G)
         self.available = False
         if self.temp_path is not None:
             self.temp_path.append(trip["path"].copy())
+        if self.fleet is not None and len(self.trips) == 1:
+            self.fleet.load_route(self.row, trip["path"], G)
 
     def complete_trip(self):
         """
@@ -127,6 +161,9 @@ class Vehicle():
             s - float
         """
         # Idea: travel as many full edges as we can and then do part of one edge.
+        if self.fleet is not None:
+            self.fleet.move(G, s, [self.row])
+            return
         if not len(self.trips):
             return
         if self.trips[0]["end_time"] is not None: